@@ -0,0 +1,656 @@
+#!/usr/bin/python
+"""
+    Micro-benchmarks of the generation pipeline. Each benchmark can run on
+    a frame produced by the flowextractor (--input) or on a synthetic frame.
+"""
+
+import os
+import sys
+import argparse
+import time
+import tempfile
+import pickle
+import zlib
+import datetime
+import resource
+from multiprocessing import cpu_count
+from ipaddress import ip_network, IPv4Address
+import numpy as np
+
+from flowStatReader import FlowStatReader
+from frameReader import decode_frame, MappedFrame
+from frameReader import ADDR_STRUCT, STATS_STRUCT, LIST_STRUCT
+from frameReader import PKT_TYPE, ARR_TYPE
+import estimator
+import util
+from flows import Flow, FlowKey, IntAddress
+from flowIndex import FlowIndex
+from estimator import FrameEstimator
+from distances import DistanceEngine, condensed_to_dict
+from clustering import ClusterEngine, Cluster, clustering, find_min_dist_clusters
+import sketch
+from replayEngine import ReplayEngine
+
+def write_synthetic_frame(filename, nb_flow, nb_pkt, seed=0):
+    rand = np.random.RandomState(seed)
+    with open(filename, "wb") as f:
+        for i in xrange(nb_flow):
+            nb = int(rand.randint(1, 2*nb_pkt))
+            f.write(ADDR_STRUCT.pack(0x0a000001 + i, 0x0a100001 + (i % 16)))
+            pkt_dist = rand.randint(60, 1500, nb).astype(PKT_TYPE)
+            arr_dist = rand.exponential(100, nb).astype(ARR_TYPE)
+            f.write(STATS_STRUCT.pack(1024 + i % 60000, 502, 6, int(pkt_dist.sum()),
+                                      nb, 1500000000 + i, rand.randint(0, 999999),
+                                      float(arr_dist.sum()), nb))
+            f.write(pkt_dist.tobytes())
+            f.write(LIST_STRUCT.pack(nb))
+            f.write(arr_dist.tobytes())
+
+def best_time(func, repeat, *args):
+    best = None
+    res = None
+    for _ in xrange(repeat):
+        start = time.time()
+        res = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, res
+
+def read_per_field(filename):
+    reader = FlowStatReader("bin")
+    prefix = ip_network(unicode("10.0.0.0/8")).hosts()
+    flowdict = {}
+    flows = []
+    reader.open_file(filename)
+    while not reader.finish:
+        flows.append(reader.read_flow_binary(prefix, flowdict))
+    reader.close_file()
+    return flows
+
+def bench_decoder(filename, repeat):
+    t_field, flows_field = best_time(read_per_field, repeat, filename)
+    t_frame, flows_frame = best_time(decode_frame, repeat, filename)
+
+    assert len(flows_field) == len(flows_frame)
+    for a, b in zip(flows_field, flows_frame):
+        assert list(a[-2]) == b[-2].tolist() and list(a[-1]) == b[-1].tolist()
+
+    nb_pkt = sum(len(f[-2]) for f in flows_frame)
+    print "Frame {}: {} flows, {} packets".format(filename, len(flows_frame),
+                                                  nb_pkt)
+    print "Per-field decoder: {:.4f}s".format(t_field)
+    print "Frame decoder:     {:.4f}s (x{:.1f})".format(t_frame,
+                                                      t_field/max(t_frame, 1e-9))
+
+def keys_from_decoder(filename):
+    return [f[:5] for f in decode_frame(filename)]
+
+def keys_from_index(filename):
+    return MappedFrame(filename).keys()
+
+def bench_index(filename, repeat):
+    index_name = MappedFrame(filename, cache_index=False).index_name
+    cached = os.path.exists(index_name)
+    if cached:
+        os.remove(index_name)
+    t_build, _ = best_time(lambda: MappedFrame(filename), 1)
+    t_decode, keys_decode = best_time(keys_from_decoder, repeat, filename)
+    t_index, keys_index = best_time(keys_from_index, repeat, filename)
+    assert keys_decode == keys_index
+
+    frame = MappedFrame(filename)
+    t_one, _ = best_time(frame.arrays, repeat, len(frame)//2)
+
+    print "Keys of {} flows from full decoding: {:.4f}s".format(len(keys_index),
+                                                               t_decode)
+    print "Index built and cached in {:.4f}s".format(t_build)
+    print "Keys from cached index: {:.4f}s".format(t_index)
+    print "Arrays of one flow: {:.6f}s".format(t_one)
+    if not cached:
+        os.remove(index_name)
+
+def same_generators(fitted_a, fitted_b, nb_sample=100):
+    for (pkt_a, arr_a), (pkt_b, arr_b) in zip(fitted_a, fitted_b):
+        for gen_a, gen_b in ((pkt_a, pkt_b), (arr_a, arr_b)):
+            np.random.seed(0)
+            sample_a = gen_a.generate(nb_sample)
+            np.random.seed(0)
+            sample_b = gen_b.generate(nb_sample)
+            if not np.array_equal(sample_a, sample_b):
+                return False
+    return True
+
+def bench_fit(filename, repeat, max_workers):
+    flows = MappedFrame(filename).flows()
+    t_serial, fitted_serial = best_time(FrameEstimator().fit, repeat, flows)
+    print "Fitting {} flows".format(len(flows))
+    print "Serial:    {:.4f}s".format(t_serial)
+
+    workers = 2
+    while workers <= max_workers:
+        est = FrameEstimator(workers)
+        try:
+            t_pool, fitted_pool = best_time(est.fit, repeat, flows)
+        finally:
+            est.close()
+        assert same_generators(fitted_serial, fitted_pool)
+        print "{:2d} workers: {:.4f}s (x{:.1f})".format(workers, t_pool,
+                                                      t_serial/max(t_pool, 1e-9))
+        workers *= 2
+
+def bench_sampler(filename, repeat):
+    samples = [arr_dist for (_, _, _, _, _, _, _, _, _, _, arr_dist)
+               in MappedFrame(filename).flows()
+               if len(arr_dist) > estimator.MIN_SAMPLE_SIZE]
+    print "Sampling the inter-arrival times of {} flows".format(len(samples))
+    print "{:10} {:>10} {:>12} {:>12} {:>8} {:>8}".format(
+        "sampler", "time (s)", "pickled (B)", "zlib (B)", "KS", "KS kde")
+    # Sample of the KernelDensity of each flow, which the others approximate
+    np.random.seed(1)
+    reference = [estimator.kde_estim(data, estimator.NB_ITER,
+                                     estimator.KDE_NAME)[0][0][0].sample(
+                                         10 * len(data)).ravel()
+                 for data in samples]
+    for sampler in estimator.SAMPLERS:
+        gens = [estimator.kde_estim(data, estimator.NB_ITER, sampler)[0][0][0]
+                for data in samples]
+        fit = [(gen, len(data)) for gen, data in zip(gens, samples)]
+
+        def generate():
+            return [gen.generate(n) if not hasattr(gen, 'sample')
+                    else gen.sample(n).ravel() for gen, n in fit]
+
+        np.random.seed(0)
+        t_gen, generated = best_time(generate, repeat)
+        pickled = [pickle.dumps(gen, pickle.HIGHEST_PROTOCOL) for gen in gens]
+        size = sum(len(p) for p in pickled)
+        size_zlib = sum(len(zlib.compress(p)) for p in pickled)
+        # Mean distance between the generated and the empirical samples
+        ks = np.mean([util.distance_ks(g, d) for g, d in zip(generated, samples)])
+        ks_kde = np.mean([util.distance_ks(g, r)
+                          for g, r in zip(generated, reference)])
+        print "{:10} {:10.4f} {:12d} {:12d} {:8.4f} {:8.4f}".format(
+            sampler, t_gen, size, size_zlib, ks, ks_kde)
+
+def bench_arrmode(filename, repeat):
+    arr_dists = [arr_dist for (_, _, _, _, _, _, _, _, _, _, arr_dist)
+                 in MappedFrame(filename).flows() if len(arr_dist) > 0]
+    fitted = [(estimator.fit_arr(arr_dist), util.dist_sum(arr_dist), arr_dist)
+              for arr_dist in arr_dists]
+    print "Generating the inter-arrival times of {} flows".format(len(fitted))
+    print "{:10} {:>10} {:>10} {:>14}".format("mode", "time (s)", "KS",
+                                             "total error")
+    mode = Flow.ARR_MODE
+    try:
+        for arr_mode in Flow.ARR_MODES:
+            Flow.ARR_MODE = arr_mode
+
+            def generate():
+                return [Flow.generate_arrs(gen, emp_arr, len(arr_dist))
+                        for gen, emp_arr, arr_dist in fitted]
+
+            np.random.seed(0)
+            t_gen, generated = best_time(generate, repeat)
+            ks = np.mean([util.distance_ks(g, d)
+                          for g, (_, _, d) in zip(generated, fitted)])
+            error = np.mean([abs(1 - g.sum()/emp_arr)
+                             for g, (_, emp_arr, _) in zip(generated, fitted)])
+            print "{:10} {:10.4f} {:10.4f} {:14.6f}".format(arr_mode, t_gen, ks,
+                                                          error)
+    finally:
+        Flow.ARR_MODE = mode
+
+def pairwise_loop(samples, fun):
+    norms = [util.normalize_data(s.tolist()) for s in samples]
+    return [fun(norms[i], norms[j]) for i in xrange(len(norms))
+            for j in xrange(i+1, len(norms))]
+
+def bench_distances(filename, repeat):
+    samples = [arr_dist for (_, _, _, _, _, _, _, _, _, _, arr_dist)
+               in MappedFrame(filename).flows() if len(arr_dist) > 0]
+    n = len(samples)
+    print "Distances between {} flows ({} pairs)".format(n, n*(n-1)//2)
+    for metric, fun in (("ks", util.distance_ks),
+                        ("ks_mod", util.distance_ks_mod)):
+        t_loop, ref = best_time(pairwise_loop, 1, samples, fun)
+        t_engine, res = best_time(lambda: DistanceEngine(samples, metric).condensed(),
+                                  repeat)
+        err = np.abs(np.array(ref) - res)
+        print "{:7} loop: {:.4f}s, engine: {:.4f}s (x{:.1f}), error max {:.4f} mean {:.4f}".format(
+            metric, t_loop, t_engine, t_loop/max(t_engine, 1e-9), err.max(),
+            err.mean())
+
+    # Hellinger distance of the binned samples
+    engine = DistanceEngine(samples, "hellinger")
+    pmf = engine.pmf.astype(np.float64)
+    t_loop, ref = best_time(
+        lambda: [util.hellinger3(pmf[i], pmf[j]) for i in xrange(n)
+                 for j in xrange(i+1, n)], 1)
+    t_engine, res = best_time(engine.condensed, repeat)
+    err = np.abs(np.array(ref) - res)
+    print "{:7} loop: {:.4f}s, engine: {:.4f}s (x{:.1f}), error max {:.4f}".format(
+        "hellinger", t_loop, t_engine, t_loop/max(t_engine, 1e-9), err.max())
+
+def random_condensed(nb_point, seed=0):
+    # Distances in [0, 1] between random points of the plane
+    from scipy.spatial.distance import pdist
+    points = np.random.RandomState(seed).rand(nb_point, 2)
+    return (pdist(points)/np.sqrt(2)).astype(np.float32)
+
+def greedy_clustering(distances, n, dist):
+    # Closest pair of clusters found by a full scan at each merge
+    clusters = [Cluster(x) for x in distances.keys()]
+    while len(clusters) > n:
+        i, j, mindist = find_min_dist_clusters(clusters, distances)
+        if mindist >= dist:
+            break
+        clusters[i].merge_cluster(clusters[j])
+        del clusters[j]
+    return clusters
+
+def bench_clustering(sizes, max_mem):
+    from scipy.cluster.hierarchy import linkage
+    nb_point = 100
+    condensed = random_condensed(nb_point)
+    distances = condensed_to_dict(range(nb_point), condensed)
+    for n, dist in ((1, 0.05), (10, 1)):
+        ref = set(c.flows for c in greedy_clustering(distances, n, dist))
+        assert ref == set(c.flows for c in clustering(distances, n, dist))
+    for method in ClusterEngine.LINKAGES:
+        heights = [d for _, _, d in ClusterEngine(condensed, nb_point,
+                                                  method).merges()]
+        ref = linkage(condensed.astype(np.float64), method)[:, 2]
+        assert np.allclose(sorted(heights), sorted(ref), atol=1e-6)
+    print "Same clusters as the greedy algorithm and merges as scipy"
+
+    for nb_point in sizes:
+        nb_pair = nb_point*(nb_point-1)//2
+        condensed = None
+        for method in ClusterEngine.LINKAGES:
+            # Lance-Williams updates a float64 copy of the matrix
+            mem = nb_pair * (4 if method == "single" else 12)
+            if mem > max_mem:
+                print "{:6d} flows {:9}: skipped, needs {:.1f} GB".format(
+                    nb_point, method, mem/1e9)
+                continue
+            if condensed is None:
+                condensed = random_condensed(nb_point)
+            engine = ClusterEngine(condensed, nb_point, method)
+            t_run, clusters = best_time(engine.run, 1, 10, 0.05)
+            print "{:6d} flows {:9}: {:.3f}s, {} clusters".format(
+                nb_point, method, t_run, len(clusters))
+
+def family_samples(nb_flow, nb_pkt, seed=0):
+    # Inter-arrival samples drawn from a few families of distributions
+    rand = np.random.RandomState(seed)
+    families = [lambda n: rand.exponential(1, n),
+                lambda n: rand.uniform(0, 1, n),
+                lambda n: rand.normal(10, 1, n),
+                lambda n: np.concatenate((rand.normal(0, 1, n//2),
+                                          rand.normal(8, 1, n - n//2))),
+                lambda n: rand.lognormal(0, 1, n),
+                lambda n: rand.gamma(9, 1, n)]
+    return [families[rand.randint(len(families))](rand.randint(10, 2*nb_pkt))
+            for _ in xrange(nb_flow)]
+
+def pair_recall(exact, approx):
+    # Fraction of the pairs of flows clustered together by the exact
+    # clustering that are also together in the approximate one
+    labels = np.empty(sum(len(c) for c in approx), dtype=np.int64)
+    for label, members in enumerate(approx):
+        labels[members] = label
+    together = 0
+    total = 0
+    for members in exact:
+        counts = np.bincount(labels[members])
+        together += (counts * (counts - 1) // 2).sum()
+        total += len(members) * (len(members) - 1) // 2
+    return together / float(total) if total else 1.0
+
+def bench_lsh(nb_flow, nb_pkt, n=10, dist=0.05):
+    samples = family_samples(nb_flow, nb_pkt)
+    nb_pair = nb_flow*(nb_flow-1)//2
+
+    def exact():
+        condensed = DistanceEngine(samples, "ks").condensed()
+        return ClusterEngine(condensed, nb_flow).run(n, dist)
+
+    t_exact, ref = best_time(exact, 1)
+    print "{} flows, exact: {:.3f}s, {} clusters".format(nb_flow, t_exact,
+                                                        len(ref))
+    print "{:>6} {:>6} {:>10} {:>9} {:>8} {:>9}".format("tables", "width",
+                                                         "pairs (%)", "time (s)",
+                                                         "recall", "clusters")
+    for tables in (2, 4, 8):
+        for width in (0.1, 0.25, 0.5, 1.0):
+            t_approx, res = best_time(
+                lambda: sketch.approximate_clustering(samples, n, dist,
+                                                      tables=tables, width=width), 1)
+            rows, _ = sketch.lsh_candidates(sketch.sketches(samples),
+                                            tables=tables, width=width)
+            print "{:6d} {:6.2f} {:10.2f} {:9.3f} {:8.3f} {:9d}".format(
+                tables, width, 100.0*len(rows)/nb_pair, t_approx,
+                pair_recall(ref, res), len(res))
+
+def bench_clusterfit(nb_flow, nb_pkt, n=6, dist=0.2, linkage="average"):
+    # Flows of the same family differ by the scale of their inter-arrivals
+    rand = np.random.RandomState(1)
+    samples = [np.abs(s) * rand.lognormal(0, 1)
+               for s in family_samples(nb_flow, nb_pkt)]
+    fitter = FrameEstimator()
+
+    def cluster():
+        condensed = DistanceEngine(samples, "ks").condensed()
+        return ClusterEngine(condensed, nb_flow, linkage).run(n, dist)
+
+    def fit_flows():
+        return [fitter.fit_arr(s) for s in samples]
+
+    def fit_clusters():
+        gens = [None] * nb_flow
+        for points in members:
+            for i, gen in zip(points, fitter.fit_cluster([samples[i]
+                                                          for i in points])):
+                gens[i] = gen
+        return gens
+
+    t_cluster, members = best_time(cluster, 1)
+    print "{} flows, {} clusters ({} linkage) in {:.4f}s".format(
+        nb_flow, len(members), linkage, t_cluster)
+    print "{:8} {:8} {:>10} {:>10}".format("sampler", "mode", "fit (s)", "KS")
+    sampler = estimator.SAMPLER
+    try:
+        for name in estimator.SAMPLERS:
+            estimator.SAMPLER = name
+            for mode, fit in (("flow", fit_flows), ("cluster", fit_clusters)):
+                t_fit, gens = best_time(fit, 1)
+                np.random.seed(0)
+                ks = np.mean([util.distance_ks(s, Flow.generate_arrs(
+                    gen, s.sum(), len(s))) for gen, s in zip(gens, samples)])
+                print "{:8} {:8} {:10.4f} {:10.4f}".format(name, mode, t_fit,
+                                                           ks)
+    finally:
+        estimator.SAMPLER = sampler
+
+class DictFlowKey(object):
+    # Layout of FlowKey before __slots__, for comparison
+
+    def __init__(self, srcip, dstip, sport, dport, proto):
+        self.srcip = srcip
+        self.dstip = dstip
+        self.sport = sport
+        self.dport = dport
+        self.proto = proto
+
+    def __eq__(self, other):
+        return (self.srcip == other.srcip and self.dstip == other.dstip and
+                self.sport == other.sport and self.dport == other.dport and
+                self.proto == other.proto)
+
+    def __hash__(self):
+        return hash((self.srcip, self.dstip, self.sport, self.dport,
+                     self.proto))
+
+class DictFlow(object):
+    # Layout of Flow before __slots__, key attributes are delegated
+
+    def __init__(self, key):
+        for attr in Flow.state_attr:
+            self.__dict__[attr] = None
+        self.key = key
+
+    def __getattr__(self, attr):
+        if attr in Flow.key_attr:
+            return getattr(self.key, attr)
+        elif attr in self.__dict__:
+            return self.__dict__[attr]
+        else:
+            raise AttributeError("Object has no attribute %s" % attr)
+
+def object_size(obj, seen):
+    # Size of obj and of the objects it references, each counted once
+    if obj is None or id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        return size + sum(object_size(v, seen) for v in obj.values())
+    if hasattr(obj, "__dict__"):
+        size += object_size(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for attr in getattr(cls, "__slots__", ()):
+            if hasattr(obj, attr):
+                size += object_size(getattr(obj, attr), seen)
+    return size
+
+def indexed_flows(keys):
+    # Flows built in the table of their index, as in FlowHandler
+    index = FlowIndex()
+    for k in keys:
+        index.add(Flow(FlowKey(*k), table=index.table))
+    return index.values()
+
+def bench_flowkey(filename, repeat):
+    # dict: layout before __slots__, slots: flows with their statistics in
+    # a list, table: flows with their statistics in a shared FlowTable
+    keys = MappedFrame(filename).keys()
+    layouts = (("dict", lambda keys: [DictFlow(DictFlowKey(
+                    IPv4Address(k[0]), IPv4Address(k[1]), k[2], k[3], k[4]))
+                                      for k in keys]),
+               ("slots", lambda keys: [Flow(FlowKey(*k)) for k in keys]),
+               ("table", indexed_flows))
+    print "{} flows".format(len(keys))
+    print "{:6} {:>12} {:>10} {:>10} {:>10}".format("layout", "bytes/flow",
+                                                    "build (s)", "attr (s)",
+                                                    "dict (s)")
+    for name, make in layouts:
+        t_build, flows = best_time(lambda: make(keys), repeat)
+        seen = set()
+        size = sum(object_size(flow, seen) for flow in flows)
+
+        def access():
+            for flow in flows:
+                (flow.srcip, flow.dstip, flow.sport, flow.dport, flow.proto,
+                 flow.nb_pkt, flow.emp_arr)
+
+        def lookup():
+            table = {flow.key: flow for flow in flows}
+            for flow in flows:
+                table[flow.key]
+
+        t_access, _ = best_time(access, repeat)
+        t_lookup, _ = best_time(lookup, repeat)
+        print "{:6} {:12.1f} {:10.4f} {:10.4f} {:10.4f}".format(
+            name, size/float(len(flows)), t_build, t_access, t_lookup)
+
+def bench_flowtable(filename, repeat):
+    # Frame reset and expiry of the flows, per object against the columns
+    keys = MappedFrame(filename).keys()
+    index = FlowIndex(Flow(FlowKey(*k)) for k in keys)
+    flows = index.values()
+    for i, flow in enumerate(flows):
+        flow.set_stats(1.0, 100, 10, None)
+        flow.last_frame = i % 4
+    print "{} flows".format(len(flows))
+
+    def reset_objects():
+        for flow in flows:
+            flow.reset_flow()
+
+    def reset_columns():
+        index.table.reset_frame(index.rows())
+
+    def expired_objects():
+        return [flow.key for flow in flows if flow.last_frame < 2]
+
+    def expired_columns():
+        rows = index.rows()
+        return index.table.keys[rows[index.column("last_frame", rows) < 2]]
+
+    print "{:8} {:>12} {:>12}".format("op", "objects (s)", "columns (s)")
+    for name, objects, columns in (("reset", reset_objects, reset_columns),
+                                   ("expiry", expired_objects, expired_columns)):
+        t_obj, res_obj = best_time(objects, repeat)
+        t_col, res_col = best_time(columns, repeat)
+        if res_obj is not None:
+            assert list(res_obj) == list(res_col)
+        print "{:8} {:12.4f} {:12.4f}".format(name, t_obj, t_col)
+
+def replay_flows(nb_flow, nb_pkt, interval, seed=0, net=0):
+    # TCP flows between loopback addresses, 16 servers, nb_pkt packets in
+    # each direction, every interval ms on average. The servers are in
+    # 127.(2*net + 1)/16, the clients in 127.(2*net + 2)/16
+    rand = np.random.RandomState(seed)
+    pkt_dist = rand.randint(60, 1500, nb_pkt)
+    arr_dist = rand.exponential(interval, nb_pkt)
+    estim_pkt = estimator.fit_pkt(pkt_dist)
+    estim_arr = estimator.fit_arr(arr_dist)
+    first = datetime.datetime.utcnow()
+    flows = []
+    for i in xrange(nb_flow):
+        key = FlowKey(IntAddress(0x7f020001 + (net << 17) + i),
+                      IntAddress(0x7f010001 + (net << 17) + i % 16),
+                      40000, 502, 6, first, 502)
+        flow = Flow(key, arr_dist.sum()/1000.0, int(pkt_dist.sum()), nb_pkt,
+                    arr_dist=arr_dist, in_first=first)
+        flow.in_nb_pkt = nb_pkt
+        flow.in_emp_arr = flow.emp_arr
+        flow.estim_pkt = flow.in_estim_pkt = estim_pkt
+        flow.estim_arr = flow.in_estim_arr = estim_arr
+        flows.append(flow)
+    return flows
+
+def replay_engine(flows, timeout):
+    engine = ReplayEngine()
+    for flow in flows:
+        engine.establish_conn_client_server(flow, last=True)
+    engine.wait_termination(timeout)
+    return 0, engine.nb_done
+
+def replay_processes(flows, timeout):
+    # Process per endpoint, as run by FlowHandler in local mode
+    from networkHandler import LocalHandler
+    handler = LocalHandler()
+    locks = {}
+    threads = []
+    for flow in flows:
+        pipes = [handler.get_process_pipename(flow.srcip, flow.sport, flow.proto),
+                 handler.get_process_pipename(flow.dstip, flow.dport, flow.proto)]
+        for pipe in pipes:
+            if pipe not in locks:
+                if not os.path.exists(pipe):
+                    os.mkfifo(pipe)
+                locks[pipe] = util.PipeLock()
+        res = handler.establish_conn_client_server(flow, locks[pipes[0]],
+                                                   locks[pipes[1]], True)
+        if res:
+            threads.extend(res)
+    for thr in threads:
+        thr.join()
+    deadline = time.time() + timeout
+    clients = handler.processes.values()
+    while time.time() < deadline and any(p.poll() is None for p in clients):
+        time.sleep(0.05)
+    nb_done = sum(1 for p in clients if p.poll() == 0)
+    # The servers run until killed, only the processes started here are
+    servers = handler.servers.values()
+    for proc in clients + servers:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+    for pipe in locks:
+        os.remove(pipe)
+    return len(clients) + len(servers), nb_done
+
+def bench_replay(nb_flow, nb_pkt, interval=10, timeout=60):
+    print "{} flows of {} packets each way, {}ms apart".format(nb_flow, nb_pkt,
+                                                               interval)
+    print "{:10} {:>10} {:>10} {:>10} {:>10}".format("model", "processes",
+                                                     "flows done", "time (s)",
+                                                     "cpu (s)")
+    for net, (name, replay) in enumerate((("engine", replay_engine),
+                                          ("processes", replay_processes))):
+        # Same flows on other addresses, the ports of the previous model
+        # can still be in TIME_WAIT
+        flows = replay_flows(nb_flow, nb_pkt, interval, net=net)
+        before = [resource.getrusage(who) for who in (resource.RUSAGE_SELF,
+                                                      resource.RUSAGE_CHILDREN)]
+        t_replay, (nb_proc, nb_done) = best_time(replay, 1, flows, timeout)
+        after = [resource.getrusage(who) for who in (resource.RUSAGE_SELF,
+                                                     resource.RUSAGE_CHILDREN)]
+        cpu = sum(a.ru_utime + a.ru_stime - b.ru_utime - b.ru_stime
+                  for a, b in zip(after, before))
+        print "{:10} {:10d} {:10d} {:10.3f} {:10.3f}".format(
+            name, nb_proc, nb_done, t_replay, cpu)
+
+def main(bench, filename, repeat, nb_flow, nb_pkt, workers, sizes=None,
+         max_mem=None):
+    tmpname = None
+    if bench == "clustering":
+        bench_clustering(sizes, max_mem)
+        return
+    if bench == "lsh":
+        bench_lsh(nb_flow, nb_pkt)
+        return
+    if bench == "clusterfit":
+        bench_clusterfit(nb_flow, nb_pkt)
+        return
+    if bench == "replay":
+        bench_replay(nb_flow, nb_pkt)
+        return
+    if filename is None:
+        fd, tmpname = tempfile.mkstemp(suffix=".bin")
+        os.close(fd)
+        write_synthetic_frame(tmpname, nb_flow, nb_pkt)
+        filename = tmpname
+    try:
+        if bench == "decoder":
+            bench_decoder(filename, repeat)
+        elif bench == "index":
+            bench_index(filename, repeat)
+        elif bench == "fit":
+            bench_fit(filename, repeat, workers)
+        elif bench == "sampler":
+            bench_sampler(filename, repeat)
+        elif bench == "arrmode":
+            bench_arrmode(filename, repeat)
+        elif bench == "distances":
+            bench_distances(filename, repeat)
+        elif bench == "flowkey":
+            bench_flowkey(filename, repeat)
+        elif bench == "flowtable":
+            bench_flowtable(filename, repeat)
+    finally:
+        if tmpname is not None:
+            os.remove(tmpname)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", dest="bench", action="store",
+                        choices=["decoder", "index", "fit", "sampler", "arrmode",
+                                 "distances", "clustering", "lsh",
+                                 "clusterfit", "flowkey", "flowtable", "replay"],
+                        default="decoder", help="benchmark to run")
+    parser.add_argument("--input", type=str, dest="input", action="store",
+                        help="frame file from the extractor (synthetic if not set)")
+    parser.add_argument("--repeat", type=int, dest="repeat", action="store",
+                        default=3, help="number of repetitions")
+    parser.add_argument("--nflow", type=int, dest="nflow", action="store",
+                        default=500, help="number of flows of the synthetic frame")
+    parser.add_argument("--npkt", type=int, dest="npkt", action="store",
+                        default=1000, help="mean number of packets per flow")
+    parser.add_argument("--workers", type=int, dest="workers", action="store",
+                        default=cpu_count(),
+                        help="maximum number of processes for the fit benchmark")
+    parser.add_argument("--sizes", type=str, dest="sizes", action="store",
+                        default="1000,10000,50000",
+                        help="numbers of flows of the clustering benchmark")
+    parser.add_argument("--maxmem", type=float, dest="maxmem", action="store",
+                        default=2.0,
+                        help="memory for the distance matrices in GB")
+    args = parser.parse_args()
+
+    main(args.bench, args.input, args.repeat, args.nflow, args.npkt,
+         args.workers, [int(x) for x in args.sizes.split(",")],
+         args.maxmem * 1e9)
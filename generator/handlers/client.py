@@ -18,6 +18,7 @@ from threading import Thread, ThreadError
 from traceback import format_exception
 from util import Sender, Receiver
 from util import timeout_decorator, get_tcp_info
+from util import signal_ready_once
 import flowDAO as flowDAO
 
 parser = argparse.ArgumentParser()
@@ -26,6 +27,8 @@ parser.add_argument("--daddr", type=str, dest="d_addr", action="store", help="de
 parser.add_argument("--sport", type=int, dest="sport", action="store", help="source port of the client")
 parser.add_argument("--dport", type=int, dest="dport", action="store", help="destination port of the server")
 parser.add_argument("--proto", type=str, dest="proto", action="store", help="protocol used for the flow")
+parser.add_argument("--ready", action="store_true",
+                    help="write a byte to stdout once the socket is bound")
 group = parser.add_mutually_exclusive_group(required=True)
 group.add_argument("--pipe", action="store_true")
 group.add_argument("--sock", action="store_true")
@@ -93,7 +96,7 @@ class FlowClient(object):
     def __init__(self, client_ip, client_port, server_ip, server_port,
                  TCP, is_pipe_entry, pipename=None, ip=None, port=None,
                  arr_gen=None, pkt_gen=None, first=None, rem_first=None,
-                 nbr_pkt=None, rem_nbr_pkt=None):
+                 nbr_pkt=None, rem_nbr_pkt=None, ready=False):
 
         self.is_tcp = TCP
 
@@ -131,8 +134,13 @@ class FlowClient(object):
         except socket.error as err:
             logger.debug("Unable to bind to %s:%s: %s", client_ip,
                          client_port, err)
+            if ready:
+                signal_ready_once(False)
             return
 
+        if ready:
+            signal_ready_once()
+
         if is_pipe_entry:
             logger.debug("Initializing pipe")
             if not os.path.exists(pipename):
@@ -291,9 +299,8 @@ class FlowClient(object):
 
         sender.reset_params(nbr_pkt, arr_gen, pkt_gen, first_arr)
 
-    def wait_sender(self, sender, timeout=0.005):
-        while not sender.done:
-            time.sleep(timeout)
+    def wait_sender(self, sender):
+        sender.wait_frame()
 
     def generate_flow_threaded(self):
 
@@ -361,11 +368,9 @@ class FlowClient(object):
             self.wait_sender(sender)
 
             if res_gen.last:
-                sender.queue.put(True)
+                sender.stop()
                 logger.debug("Flow Receiver completely done, %s:%s", self.server_ip,
                              self.server_port)
-                if sender.is_alive():
-                    sender.join()
 
                 if receiver.is_alive():
                     receiver.join()
@@ -385,9 +390,11 @@ if __name__ == "__main__":
 
     if args.pipe:
         client = FlowClient(s_addr, sport, d_addr, dport, proto == "tcp",
-                            args.pipe, pipename=args.pipename)
+                            args.pipe, pipename=args.pipename,
+                            ready=args.ready)
     else:
         client = FlowClient(s_addr, sport, d_addr, dport, proto == "tcp",
-                            args.pipe, ip=args.ip, port=args.port)
+                            args.pipe, ip=args.ip, port=args.port,
+                            ready=args.ready)
     client.generate_flow_threaded()
     client.finish()
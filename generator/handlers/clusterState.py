@@ -0,0 +1,158 @@
+"""
+    Clusters of the flows maintained across frames. The clusters are the
+    single linkage cut at a distance threshold, i.e. the connected components
+    of the graph linking the flows closer than the threshold (the same as
+    clustering.clustering_matrix(keys, condensed, 1, dist)).
+
+    At each frame, only the flows whose binned sample changed are compared
+    with the others, and only the components they belong to are rebuilt.
+"""
+
+from collections import deque
+import numpy as np
+
+from distances import DistanceEngine, histograms, GRID_SIZE, BLOCK_CELLS
+from clustering import to_clusters
+
+
+class ClusterState(object):
+
+    def __init__(self, dist, metric="ks", grid_size=GRID_SIZE, capacity=1024):
+        self.dist = dist
+        self.metric = metric
+        self.grid_size = grid_size
+        self.engine = DistanceEngine(None, metric, hists=(
+            np.zeros(capacity, dtype=np.int64),
+            np.zeros((capacity, grid_size))))
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.free = range(capacity - 1, -1, -1)
+        self.slots = {}
+        self.keys = {}
+        # Neighbours closer than dist
+        self.edges = {}
+        self.component = {}
+        self.members = {}
+        self.next_component = 0
+        # Number of flows compared at the last update
+        self.nb_updated = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _grow(self):
+        engine = self.engine
+        capacity = len(self.alive)
+        self.engine = DistanceEngine(None, self.metric, hists=(
+            np.concatenate((engine.sizes, np.zeros(capacity, dtype=np.int64))),
+            np.concatenate((engine.pmf, np.zeros_like(engine.pmf)))))
+        self.alive = np.concatenate((self.alive, np.zeros(capacity, dtype=bool)))
+        self.free.extend(xrange(2*capacity - 1, capacity - 1, -1))
+
+    def _set_row(self, slot, size, pmf):
+        engine = self.engine
+        engine.sizes[slot] = size
+        engine.pmf[slot] = pmf
+        engine.cdf[slot] = np.cumsum(pmf)
+        engine.sqrt_pmf[slot] = np.sqrt(pmf)
+
+    def _unlink(self, slot, affected):
+        for other in self.edges.pop(slot, ()):
+            self.edges[other].discard(slot)
+        affected.add(slot)
+
+    def _remove(self, key, affected):
+        slot = self.slots.pop(key)
+        del self.keys[slot]
+        self._unlink(slot, affected)
+        self.alive[slot] = False
+        self.free.append(slot)
+
+    def _link(self, changed):
+        alive = np.flatnonzero(self.alive)
+        changed = np.array(sorted(changed))
+        step = max(1, BLOCK_CELLS // max(len(alive) * self.grid_size, 1))
+        for start in xrange(0, len(changed), step):
+            rows = changed[start:start + step]
+            # Same rounding as the condensed matrix
+            dists = self.engine.block(rows, alive).astype(np.float32)
+            for i, j in zip(*np.nonzero(dists < self.dist)):
+                a, b = int(rows[i]), int(alive[j])
+                if a != b:
+                    self.edges.setdefault(a, set()).add(b)
+                    self.edges.setdefault(b, set()).add(a)
+
+    def _rebuild(self, affected):
+        # Components of the affected flows are dropped, the flows are then
+        # reassigned by a traversal which absorbs the components it reaches
+        for slot in list(affected):
+            comp = self.component.pop(slot, None)
+            if comp is not None and comp in self.members:
+                for other in self.members.pop(comp):
+                    self.component.pop(other, None)
+                    if other in self.keys:
+                        affected.add(other)
+
+        for slot in affected:
+            if slot not in self.keys or slot in self.component:
+                continue
+            comp = self.next_component
+            self.next_component += 1
+            members = set()
+            queue = deque([slot])
+            self.component[slot] = comp
+            while queue:
+                cur = queue.popleft()
+                members.add(cur)
+                for other in self.edges.get(cur, ()):
+                    old = self.component.get(other)
+                    if old == comp:
+                        continue
+                    if old is not None:
+                        for absorbed in self.members.pop(old, ()):
+                            self.component[absorbed] = comp
+                            members.add(absorbed)
+                        continue
+                    self.component[other] = comp
+                    queue.append(other)
+            self.members[comp] = members
+
+    def sync(self, keys, samples):
+        """
+            Update the state with the current flows, keys and samples as
+            returned by distances.flow_samples.
+        """
+        affected = set()
+        current = set(keys)
+        for key in [k for k in self.slots if k not in current]:
+            self._remove(key, affected)
+
+        sizes, pmf = histograms(samples, self.grid_size)
+        changed = set()
+        for key, size, row in zip(keys, sizes, pmf):
+            slot = self.slots.get(key)
+            if slot is not None:
+                if (self.engine.sizes[slot] == size and
+                        np.array_equal(self.engine.pmf[slot], row)):
+                    continue
+                self._unlink(slot, affected)
+            else:
+                if not self.free:
+                    self._grow()
+                slot = self.free.pop()
+                self.slots[key] = slot
+                self.keys[slot] = key
+                self.alive[slot] = True
+                affected.add(slot)
+            self._set_row(slot, size, row)
+            changed.add(slot)
+
+        if changed:
+            self._link(changed)
+        self._rebuild(affected)
+        self.nb_updated = len(changed)
+
+    def clusters(self):
+        members = [sorted(m) for m in self.members.values()]
+        keys = [self.keys[slot] for slot in sorted(self.keys)]
+        index = {slot: i for i, slot in enumerate(sorted(self.keys))}
+        return to_clusters(keys, [[index[s] for s in m] for m in members])
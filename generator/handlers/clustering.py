@@ -141,6 +141,225 @@ def clusters_from_flows(clusters, fa, fb):
             return cluster_a, cluster_b
     if cluster_a is None or cluster_b is None:
         raise ValueError("{} or {} does no belong to a cluster")
+
+
+class UnionFind(object):
+
+    """
+        Cluster of each point, the root of a set is the row of the cluster
+        in the distance matrix of ClusterEngine.
+    """
+
+    def __init__(self, n):
+        self.parent = np.arange(n)
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, a, b):
+        # b is attached to a
+        self.parent[self.find(b)] = self.find(a)
+
+    def roots(self):
+        return np.array([self.find(i) for i in xrange(len(self.parent))])
+
+
+class NearestHeap(object):
+
+    """
+        Indexed priority queue of the distance of each cluster to its nearest
+        neighbour. An entry is invalidated by pushing a new one for the same
+        cluster, stale entries are skipped when popped.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.stamps = {}
+
+    def push(self, i, dist):
+        stamp = self.stamps.get(i, 0) + 1
+        self.stamps[i] = stamp
+        heapq.heappush(self.heap, (dist, i, stamp))
+
+    def remove(self, i):
+        self.stamps[i] = self.stamps.get(i, 0) + 1
+
+    def pop(self):
+        while self.heap:
+            dist, i, stamp = heapq.heappop(self.heap)
+            if self.stamps.get(i) == stamp:
+                del self.stamps[i]
+                return i, dist
+        return None, None
+
+
+def condensed_rows(i, n):
+    # Index of the distances (i, j) for all j in a condensed matrix, the
+    # index of (i, i) is not meaningful
+    cols = np.arange(n)
+    return np.where(cols < i, n*cols - cols*(cols+1)//2 + (i - cols - 1),
+                    n*i - i*(i+1)//2 + (cols - i - 1))
+
+
+class ClusterEngine(object):
+
+    """
+        Agglomerative clustering on a condensed distance matrix (see the
+        distances module). The two closest clusters are merged until there
+        are n clusters left or the closest ones are at dist or more.
+
+        single, complete and average linkage are updated with the
+        Lance-Williams formula on a copy of the matrix. Single linkage can
+        also be computed from a minimum spanning tree, reading one row of
+        the matrix at a time (it can stay memory-mapped).
+    """
+
+    LINKAGES = ["single", "complete", "average"]
+
+    def __init__(self, condensed, nb_point, linkage="single"):
+        if linkage not in ClusterEngine.LINKAGES:
+            raise ValueError("The {} is not a valid linkage".format(linkage))
+        self.condensed = condensed
+        self.nb_point = nb_point
+        self.linkage = linkage
+
+    def merges(self):
+        """
+            Generate the merges (a, b, distance) in increasing distance,
+            cluster b is merged in cluster a.
+        """
+        if self.nb_point < 2:
+            return iter([])
+        if self.linkage == "single":
+            return self._mst_merges()
+        return self._lance_williams_merges()
+
+    def _row(self, i):
+        row = np.asarray(self.condensed[condensed_rows(i, self.nb_point)],
+                         dtype=np.float64)
+        row[i] = np.inf
+        return row
+
+    def _mst_merges(self):
+        # Prim's algorithm, the edges of the tree in increasing order are the
+        # merges of the single linkage
+        n = self.nb_point
+        in_tree = np.zeros(n, dtype=bool)
+        best = np.full(n, np.inf)
+        origin = np.zeros(n, dtype=np.int64)
+        edges = []
+        cur = 0
+        for _ in xrange(n - 1):
+            in_tree[cur] = True
+            row = self._row(cur)
+            closer = (row < best) & ~in_tree
+            best[closer] = row[closer]
+            origin[closer] = cur
+            best[cur] = np.inf
+            candidates = np.where(in_tree, np.inf, best)
+            nxt = int(np.argmin(candidates))
+            edges.append((candidates[nxt], int(origin[nxt]), nxt))
+            cur = nxt
+
+        edges.sort()
+        uf = UnionFind(n)
+        for dist, a, b in edges:
+            root_a = uf.find(a)
+            root_b = uf.find(b)
+            root_a, root_b = min(root_a, root_b), max(root_a, root_b)
+            uf.union(root_a, root_b)
+            yield root_a, root_b, dist
+
+    def _lance_williams_merges(self):
+        n = self.nb_point
+        dist = np.array(self.condensed, dtype=np.float64)
+        alive = np.ones(n, dtype=bool)
+        size = np.ones(n)
+        nearest = np.zeros(n, dtype=np.int64)
+        nearest_dist = np.zeros(n)
+        heap = NearestHeap()
+
+        def update_nearest(i):
+            row = dist[condensed_rows(i, n)]
+            row[~alive] = np.inf
+            row[i] = np.inf
+            nearest[i] = np.argmin(row)
+            nearest_dist[i] = row[nearest[i]]
+            heap.push(i, nearest_dist[i])
+
+        for i in xrange(n):
+            update_nearest(i)
+
+        for _ in xrange(n - 1):
+            i, d = heap.pop()
+            a, b = min(i, nearest[i]), max(i, nearest[i])
+            index_a = condensed_rows(a, n)
+            index_b = condensed_rows(b, n)
+            dist_a = dist[index_a]
+            dist_b = dist[index_b]
+            if self.linkage == "complete":
+                merged = np.maximum(dist_a, dist_b)
+            else:
+                merged = (size[a]*dist_a + size[b]*dist_b)/(size[a] + size[b])
+            others = alive.copy()
+            others[a] = False
+            others[b] = False
+            dist[index_a[others]] = merged[others]
+
+            alive[b] = False
+            heap.remove(b)
+            size[a] += size[b]
+            yield a, b, d
+
+            if not others.any():
+                break
+            # Linkages are reducible: merging a and b can only increase the
+            # distance of the clusters whose nearest neighbour was a or b
+            update_nearest(a)
+            for c in np.where(others & ((nearest == a) | (nearest == b)))[0]:
+                update_nearest(c)
+
+    def run(self, n, dist):
+        """
+            Return the list of clusters, each one is the list of the index of
+            its points.
+        """
+        uf = UnionFind(self.nb_point)
+        nb_cluster = self.nb_point
+        for a, b, d in self.merges():
+            if nb_cluster <= n or d >= dist:
+                break
+            uf.union(a, b)
+            nb_cluster -= 1
+
+        members = OrderedDict()
+        for i, root in enumerate(uf.roots()):
+            members.setdefault(root, []).append(i)
+        return members.values()
+
+
+def to_clusters(keys, members):
+    clusters = []
+    for points in members:
+        cluster = Cluster(keys[points[0]])
+        cluster.flows = frozenset(keys[i] for i in points)
+        clusters.append(cluster)
+    return clusters
+
+
+def clustering_matrix(keys, condensed, n, dist, linkage="single"):
+    """
+        Cluster the flows from the keys and the condensed matrix returned
+        by FlowHandler.compute_flows_distance_matrix.
+    """
+    engine = ClusterEngine(condensed, len(keys), linkage)
+    return to_clusters(keys, engine.run(n, dist))
+
+
 '''
 Cluster Algorithm
 -----------------
@@ -161,14 +380,15 @@ Algo:
 
 def clustering(distances, n, dist):
 
-    clusters = [Cluster(x) for x in distances.keys()]
-    min_dists = compute_all_min_distance_heap(distances)
-    min_d = 0
-
-    while len(clusters) > n and min_d < dist:
-        c = heapq.heappop(min_dists)
-        min_d = c.dist
-        cluster_a, cluster_b = clusters_from_flows(clusters, c.flow_a, c.flow_b)
-        cluster_a.merge_cluster(cluster_b)
-        clusters.remove(cluster_b)
-    return clusters
+    # Single linkage on the nested dictionnary of distances
+    keys = distances.keys()
+    nb = len(keys)
+    condensed = np.ones(nb*(nb-1)//2)
+    position = {k: i for i, k in enumerate(keys)}
+    for f in distances:
+        i = position[f]
+        for g, d in distances[f].items():
+            j = position[g]
+            a, b = min(i, j), max(i, j)
+            condensed[nb*a - a*(a+1)//2 + (b - a - 1)] = d
+    return clustering_matrix(keys, condensed, n, dist)
@@ -0,0 +1,88 @@
+import heapq
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import pdist
+
+from clustering import (ClusterEngine, Cluster, clustering,
+                        compute_all_min_distance_heap, clusters_from_flows)
+
+# Points on a line: three groups, all the gaps are different
+POSITIONS = [0.0, 0.01, 0.03, 0.3, 0.34, 0.39, 0.7, 0.76, 0.83]
+KEYS = ["f{}".format(i) for i in range(len(POSITIONS))]
+
+
+def previous_clustering(distances, n, dist):
+    # Greedy clustering replaced by ClusterEngine: each flow is merged with
+    # its nearest following flow, in increasing distance
+    clusters = [Cluster(x) for x in distances.keys()]
+    min_dists = compute_all_min_distance_heap(distances)
+    min_d = 0
+
+    while len(clusters) > n and min_d < dist:
+        c = heapq.heappop(min_dists)
+        min_d = c.dist
+        cluster_a, cluster_b = clusters_from_flows(clusters, c.flow_a, c.flow_b)
+        cluster_a.merge_cluster(cluster_b)
+        clusters.remove(cluster_b)
+    return clusters
+
+
+def line_distances(missing=()):
+    # Nested dictionary of FlowHandler: the distance of each flow to the
+    # following ones
+    distances = OrderedDict()
+    for i, a in enumerate(KEYS):
+        distances[a] = OrderedDict()
+        for j in range(i + 1, len(KEYS)):
+            if (i, j) not in missing:
+                distances[a][KEYS[j]] = abs(POSITIONS[i] - POSITIONS[j])
+    return distances
+
+
+def as_sets(clusters):
+    return sorted(sorted(c.flows) for c in clusters)
+
+
+class ClusteringTest(unittest.TestCase):
+
+    def test_same_clusters_as_previous(self):
+        distances = line_distances()
+        for n in range(1, len(KEYS) + 1):
+            self.assertEqual(as_sets(clustering(distances, n, 1.0)),
+                             as_sets(previous_clustering(distances, n, 1.0)))
+
+    def test_groups(self):
+        clusters = as_sets(clustering(line_distances(), 3, 1.0))
+        self.assertEqual(clusters, [KEYS[0:3], KEYS[3:6], KEYS[6:9]])
+
+    def test_dist(self):
+        # No merge at dist or above, the previous implementation made the
+        # first one
+        clusters = as_sets(clustering(line_distances(), 1, 0.2))
+        self.assertEqual(clusters, [KEYS[0:3], KEYS[3:6], KEYS[6:9]])
+        clusters = as_sets(clustering(line_distances(), 1, 0.3))
+        self.assertEqual(clusters, [KEYS[0:6], KEYS[6:9]])
+
+    def test_missing_pairs(self):
+        # Pairs without a distance are never merged
+        missing = set((i, j) for i in range(3) for j in range(3, 9))
+        clusters = as_sets(clustering(line_distances(missing), 1, 1.0))
+        self.assertEqual(clusters, [KEYS[0:3], KEYS[3:9]])
+
+    def test_linkages(self):
+        # Merge distances of the engine and of scipy on a fixed matrix
+        rand = np.random.RandomState(7)
+        points = rand.random_sample((12, 2))
+        condensed = pdist(points)
+        for method in ClusterEngine.LINKAGES:
+            engine = ClusterEngine(condensed, len(points), method)
+            merged = [d for _, _, d in engine.merges()]
+            expected = linkage(condensed, method)[:, 2]
+            np.testing.assert_allclose(sorted(merged), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,327 @@
+"""
+    Pairwise distances between the inter-arrival distributions of the flows.
+    Every sample is normalized (see util.normalize_data) and binned on a
+    common grid of [0, 1], so the distance of every pair is computed with
+    numpy on blocks of rows instead of one Python call per pair.
+
+    The result is a condensed float32 matrix, in the order of scipy's pdist:
+    the distance between keys[i] and keys[j], i < j, is at
+    condensed_index(i, j, len(keys)). For large flow sets, the matrix is
+    computed by a pool of processes into a memory-mapped file (see
+    compute_on_disk).
+"""
+
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+from multiprocessing import Pool
+import numpy as np
+
+# Number of bins of the common grid
+GRID_SIZE = 256
+# Number of float32 cells (rows x columns x bins) computed at once
+BLOCK_CELLS = 1 << 22
+
+METRICS = ["ks", "ks_mod", "hellinger"]
+
+
+def normalize_sample(data):
+    # Same as util.normalize_data, on an array
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) == 0:
+        return data
+    low = data.min()
+    vrange = data.max() - low
+    if vrange == 0:
+        return np.zeros(len(data))
+    return (data - low)/vrange
+
+
+def histograms(samples, grid_size=GRID_SIZE):
+    """
+        Return the number of values of each sample and the (n, grid_size)
+        matrix of the probability of each bin.
+    """
+    sizes = np.array([len(s) for s in samples], dtype=np.int64)
+    values = np.concatenate([normalize_sample(s) for s in samples] +
+                            [np.empty(0)])
+    bins = np.minimum((values * grid_size).astype(np.int64), grid_size - 1)
+    rows = np.repeat(np.arange(len(samples)), sizes)
+    counts = np.bincount(rows * grid_size + bins,
+                         minlength=len(samples) * grid_size)
+    counts = counts.reshape((len(samples), grid_size)).astype(np.float32)
+    return sizes, counts / np.maximum(sizes, 1)[:, None]
+
+
+def condensed_index(i, j, n):
+    if i > j:
+        i, j = j, i
+    return n*i - i*(i+1)//2 + (j - i - 1)
+
+
+def condensed_to_dict(keys, condensed):
+    """
+        Nested dictionnary of the distances, in the format returned by
+        FlowHandler.compute_flows_distances.
+    """
+    distances = OrderedDict()
+    n = len(keys)
+    for i in xrange(n):
+        start = condensed_index(i, i+1, n) if i < n - 1 else 0
+        row = condensed[start:start + n - i - 1].tolist()
+        distances[keys[i]] = OrderedDict(zip(keys[i+1:], row))
+    return distances
+
+
+class DistanceEngine(object):
+
+    """
+        Distances between all pairs of a list of samples, on the common grid.
+    """
+
+    def __init__(self, samples, metric="ks", grid_size=GRID_SIZE, hists=None):
+        if metric not in METRICS:
+            raise ValueError("The {} is not a valid distance".format(metric))
+        self.metric = metric
+        if hists is None:
+            hists = histograms(samples, grid_size)
+        self.sizes, self.pmf = hists
+        self.cdf = np.cumsum(self.pmf, axis=1)
+        self.sqrt_pmf = np.sqrt(self.pmf)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def block(self, rows, cols):
+        """
+            Distances between the samples of the slices rows and cols, as a
+            (len(rows), len(cols)) float32 matrix.
+        """
+        if self.metric == "hellinger":
+            # sum (sqrt(p) - sqrt(q))^2 / 2 = 1 - sum sqrt(p*q)
+            coef = np.dot(self.sqrt_pmf[rows], self.sqrt_pmf[cols].T)
+            return np.sqrt(np.maximum(1 - coef, 0)).astype(np.float32)
+
+        diff = np.abs(self.cdf[rows][:, None, :] - self.cdf[cols][None, :, :])
+        if self.metric == "ks":
+            return diff.max(axis=2)
+
+        # ks_mod: mean difference weighted by the pooled sample
+        size_a = self.sizes[rows].astype(np.float32)[:, None, None]
+        size_b = self.sizes[cols].astype(np.float32)[None, :, None]
+        pooled = (size_a * self.pmf[rows][:, None, :] +
+                  size_b * self.pmf[cols][None, :, :]) / np.maximum(size_a + size_b, 1)
+        return (diff * pooled).sum(axis=2).astype(np.float32)
+
+    def pairs(self, rows, cols):
+        """
+            Distances between rows[k] and cols[k] for every k, computed by
+            chunks of pairs.
+        """
+        res = np.empty(len(rows), dtype=np.float32)
+        step = max(1, BLOCK_CELLS // self.cdf.shape[1])
+        for start in xrange(0, len(rows), step):
+            a = rows[start:start + step]
+            b = cols[start:start + step]
+            if self.metric == "hellinger":
+                coef = np.einsum('ij,ij->i', self.sqrt_pmf[a], self.sqrt_pmf[b])
+                res[start:start + step] = np.sqrt(np.maximum(1 - coef, 0))
+                continue
+            diff = np.abs(self.cdf[a] - self.cdf[b])
+            if self.metric == "ks":
+                res[start:start + step] = diff.max(axis=1)
+            else:
+                size_a = self.sizes[a].astype(np.float32)[:, None]
+                size_b = self.sizes[b].astype(np.float32)[:, None]
+                pooled = (size_a * self.pmf[a] + size_b * self.pmf[b]) / \
+                         np.maximum(size_a + size_b, 1)
+                res[start:start + step] = (diff * pooled).sum(axis=1)
+        return res
+
+    def block_rows(self):
+        # Number of rows compared at once with all the others
+        if self.metric == "hellinger":
+            return max(1, BLOCK_CELLS // max(len(self), 1))
+        return max(1, BLOCK_CELLS // max(len(self) * self.cdf.shape[1], 1))
+
+    def fill(self, res, start, stop):
+        # Write the distances of the rows [start, stop) with the following
+        # ones, they are contiguous in the condensed matrix
+        n = len(self)
+        block = self.block(slice(start, stop), slice(start, n))
+        for i in xrange(start, min(stop, n - 1)):
+            begin = condensed_index(i, i+1, n)
+            res[begin:begin + n - i - 1] = block[i - start, i - start + 1:]
+
+    def condensed(self):
+        n = len(self)
+        res = np.empty(n*(n-1)//2, dtype=np.float32)
+        step = self.block_rows()
+        for start in xrange(0, n, step):
+            self.fill(res, start, min(start + step, n))
+        return res
+
+    def pair_blocks(self):
+        """
+            Bounds of the row blocks of fill(). The first rows are compared
+            with more samples than the last ones, so the blocks get larger
+            to keep the same memory footprint.
+        """
+        n = len(self)
+        cells = BLOCK_CELLS if self.metric == "hellinger" else \
+                BLOCK_CELLS // self.cdf.shape[1]
+        bounds = []
+        start = 0
+        while start < n - 1:
+            stop = min(start + max(1, cells // (n - start)), n - 1)
+            bounds.append((start, stop))
+            start = stop
+        return bounds
+
+    def fingerprint(self):
+        h = hashlib.sha1(self.metric)
+        h.update(self.sizes.tobytes())
+        h.update(self.pmf.tobytes())
+        return h.hexdigest()
+
+
+def row_distances(condensed, i, n):
+    """
+        Distances of the i-th sample with all the others (0 with itself),
+        only this row is read from a memory-mapped matrix.
+    """
+    cols = np.arange(n)
+    index = np.where(cols < i, n*cols - cols*(cols+1)//2 + (i - cols - 1),
+                     n*i - i*(i+1)//2 + (cols - i - 1))
+    index[i] = 0
+    row = np.asarray(condensed[index], dtype=np.float32)
+    row[i] = 0
+    return row
+
+
+# Engine and matrix of a worker process of compute_on_disk
+_worker = {}
+
+def _init_worker(metric, sizes, pmf, filename, length):
+    _worker['engine'] = DistanceEngine(None, metric, hists=(sizes, pmf))
+    _worker['matrix'] = np.memmap(filename, dtype=np.float32, mode='r+',
+                                  shape=(length,))
+
+def _fill_block(task):
+    block_id, start, stop = task
+    _worker['engine'].fill(_worker['matrix'], start, stop)
+    _worker['matrix'].flush()
+    return block_id
+
+
+def open_on_disk(filename):
+    """
+        Return the keys and the read-only memory-mapped condensed matrix
+        written by compute_on_disk, or None if it is not complete.
+    """
+    with open(filename + ".meta", 'rb') as fh:
+        meta = pickle.load(fh)
+    done = np.fromfile(filename + ".done", dtype=np.uint8)
+    if len(done) != len(meta['bounds']) or not done.all():
+        return None
+    n = len(meta['keys'])
+    if n < 2:
+        return meta['keys'], np.empty(0, dtype=np.float32)
+    return meta['keys'], np.memmap(filename, dtype=np.float32, mode='r',
+                                   shape=(n*(n-1)//2,))
+
+
+def compute_on_disk(keys, samples, filename, metric="ks", workers=None,
+                    grid_size=GRID_SIZE):
+    """
+        Compute the condensed matrix into filename, a row block at a time in
+        a pool of processes. The completed blocks are recorded in
+        filename.done, so an interrupted computation on the same samples
+        only computes the missing blocks when restarted.
+    """
+    engine = DistanceEngine(samples, metric, grid_size)
+    n = len(engine)
+    length = n*(n-1)//2
+    bounds = engine.pair_blocks()
+    meta = {'keys': keys, 'metric': metric, 'grid_size': grid_size,
+            'fingerprint': engine.fingerprint(), 'bounds': bounds}
+
+    resume = False
+    try:
+        with open(filename + ".meta", 'rb') as fh:
+            old_meta = pickle.load(fh)
+        resume = (old_meta['fingerprint'] == meta['fingerprint'] and
+                  old_meta['bounds'] == bounds and
+                  os.path.getsize(filename) == length * 4)
+    except (IOError, OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+
+    if not resume:
+        with open(filename, 'wb') as fh:
+            fh.truncate(length * 4)
+        np.zeros(len(bounds), dtype=np.uint8).tofile(filename + ".done")
+    # Keys of the current flows, the samples are the same if resumed
+    with open(filename + ".meta", 'wb') as fh:
+        pickle.dump(meta, fh, pickle.HIGHEST_PROTOCOL)
+
+    if length == 0:
+        return open_on_disk(filename)
+
+    done = np.memmap(filename + ".done", dtype=np.uint8, mode='r+',
+                     shape=(len(bounds),))
+    tasks = [(b, start, stop) for b, (start, stop) in enumerate(bounds)
+             if not done[b]]
+
+    initargs = (metric, engine.sizes, engine.pmf, filename, length)
+    if workers is not None and workers > 1:
+        pool = Pool(workers, _init_worker, initargs)
+        try:
+            for block_id in pool.imap_unordered(_fill_block, tasks):
+                done[block_id] = 1
+                done.flush()
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(*initargs)
+        for task in tasks:
+            done[_fill_block(task)] = 1
+            done.flush()
+        _worker.clear()
+    del done
+    return open_on_disk(filename)
+
+
+def flow_samples(flows):
+    """
+        Keys and inter-arrival samples of the flows and of their reverse
+        direction, in the order of FlowHandler.compute_flows_distances.
+    """
+    keys = []
+    samples = []
+    for flow in flows:
+        if flow.arr_dist is None:
+            raise ValueError("No empirical sample for {}, storeEmp is "
+                             "needed to cluster the flows".format(flow))
+        keys.append(flow.key)
+        samples.append(flow.arr_dist)
+        if flow.in_arr_dist is not None:
+            keys.append(flow.get_reverse())
+            samples.append(flow.in_arr_dist)
+    return keys, samples
+
+
+def flow_distances(flows, metric="ks", grid_size=GRID_SIZE):
+    """
+        Return the keys of the flows (both directions) and the condensed
+        float32 matrix of their distances.
+    """
+    keys, samples = flow_samples(flows)
+    return keys, DistanceEngine(samples, metric, grid_size).condensed()
+
+
+def flow_distances_on_disk(flows, filename, metric="ks", workers=None,
+                           grid_size=GRID_SIZE):
+    keys, samples = flow_samples(flows)
+    return compute_on_disk(keys, samples, filename, metric, workers, grid_size)
@@ -0,0 +1,302 @@
+"""
+    Pool of endpoint workers started ahead of the flows. A worker is an
+    endpointd.py process which already imported its modules, the end of a
+    new flow is handed to a warm worker instead of a new process. Once the
+    ends of a worker are closed after their last schedule, the worker is
+    recycled for the next flows of its network namespace.
+"""
+
+import os
+import logging
+import select
+import time
+import zlib
+import cPickle as pickle
+from collections import deque
+from subprocess import Popen, PIPE
+from threading import Thread, Condition
+
+from util import write_message, read_signal
+from util import READY, DONE, TimedoutException
+
+logger = logging.getLogger()
+
+
+class Worker(object):
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.fd = proc.stdout.fileno()
+        # pid of the process whose network namespace the worker entered
+        self.netns = None
+        # (ip, port, proto) of the ends run by the worker
+        self.keys = set()
+
+    def send(self, command, timeout=1):
+        """
+            Send a command, return whether the worker acknowledged it. A
+            done byte read before the acknowledgement is about the ends of
+            the previous frames, the worker is busy again.
+        """
+        data = zlib.compress(pickle.dumps(command))
+        write_message(self.proc.stdin.fileno(), data)
+        signal = read_signal(self.fd, timeout)
+        while signal == DONE:
+            signal = read_signal(self.fd, timeout)
+        return signal == READY
+
+    def __str__(self):
+        return "worker {}".format(self.proc.pid)
+
+
+class EndpointPool(object):
+
+    """
+        The pool keeps target workers warm, started in the background. Each
+        end is identified by its (ip, port, proto), all its schedules are
+        sent to the same worker until this one is recycled.
+    """
+
+    # Seconds for a new worker to import its modules
+    START_TIMEOUT = 30
+    # Warm workers kept at most, whatever the look-ahead
+    MAX_SIZE = 64
+    # Workers started together, the next ones once they are warm
+    START_BATCH = 8
+
+    def __init__(self, cmd=None, size=0, max_size=None):
+        self.cmd = cmd or ["python", "-u", "endpointd.py", "--worker"]
+        self.max_size = EndpointPool.MAX_SIZE if max_size is None \
+                        else max_size
+        # Warm workers which did not enter a namespace
+        self.idle = deque()
+        # netns -> recycled workers, they stay in their namespace
+        self.recycled = {}
+        # fd -> worker running ends, it is recycled on its done byte
+        self.busy = {}
+        self.poller = select.poll()
+        # (ip, port, proto) -> worker running the end
+        self.assigned = {}
+        self.target = min(size, self.max_size)
+        self.starting = 0
+        self.stopping = False
+        self.cond = Condition()
+        self.nb_started = 0
+        self.nb_warm = 0
+        self.nb_cold = 0
+        self.nb_reused = 0
+        self.thread = Thread(target=self._refill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def resize(self, size, shrink=True):
+        """
+            Number of warm workers to keep, from the look-ahead of the
+            flows. The workers in excess are stopped in the background,
+            unless shrink is False.
+        """
+        size = min(size, self.max_size)
+        with self.cond:
+            if shrink or size > self.target:
+                self.target = size
+            self.cond.notify_all()
+
+    def wait_warm(self, timeout=None):
+        # Wait for the workers of the current target to be started
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while len(self.idle) < self.target:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                self.cond.wait(remaining)
+            return len(self.idle) >= self.target
+
+    def open(self, key, netns, command, timeout=1):
+        """
+            Send the command of the end key to the worker running it, or to
+            a new worker of the namespace of netns. Return the process of
+            the worker, None if it could not open the end.
+        """
+        self.collect()
+        worker = self.assigned.get(key)
+        new = worker is None
+        if new:
+            worker = self.acquire(netns)
+            if worker is None:
+                return None
+            self.assigned[key] = worker
+            worker.keys.add(key)
+        try:
+            ready = worker.send(command, timeout)
+        except TimedoutException as err:
+            logger.debug("%s: %s", worker, err.msg)
+            ready = False
+        if ready:
+            return worker.proc
+        logger.debug("Unable to open %s:%s (%s) in %s", key[0], key[1],
+                     key[2], worker)
+        if new:
+            worker.keys.discard(key)
+            del self.assigned[key]
+            if not worker.keys:
+                self._recycle(worker)
+        return None
+
+    def acquire(self, netns=None):
+        with self.cond:
+            workers = self.recycled.get(netns)
+            if workers:
+                worker = workers.pop()
+                self.nb_reused += 1
+            elif self.idle:
+                worker = self.idle.popleft()
+                self.nb_warm += 1
+            else:
+                worker = None
+            self.cond.notify_all()
+        if worker is None:
+            # Pool too small, the end waits for a new process
+            worker = self._start()
+            if not self._wait_started(worker):
+                return None
+            self.nb_cold += 1
+        if worker.netns != netns:
+            try:
+                entered = worker.send(("netns", netns))
+            except TimedoutException as err:
+                logger.debug("%s: %s", worker, err.msg)
+                entered = False
+            if not entered:
+                logger.debug("%s could not enter namespace of %s", worker,
+                             netns)
+                self._stop(worker)
+                return None
+            worker.netns = netns
+        self.busy[worker.fd] = worker
+        self.poller.register(worker.fd, select.POLLIN | select.POLLHUP)
+        return worker
+
+    def collect(self):
+        # Recycle the workers which wrote their done byte
+        if not self.busy:
+            return
+        for fd, _ in self.poller.poll(0):
+            worker = self.busy.get(fd)
+            if worker is None:
+                continue
+            signal = os.read(fd, 1)
+            if signal == DONE:
+                self._recycle(worker)
+            elif not signal:
+                logger.debug("%s exited", worker)
+                self._forget(worker)
+
+    def _recycle(self, worker):
+        self._forget(worker)
+        with self.cond:
+            if worker.netns is None:
+                self.idle.append(worker)
+            else:
+                self.recycled.setdefault(worker.netns, []).append(worker)
+            # The pool can be above its target after a smaller frame
+            self.cond.notify_all()
+
+    def _forget(self, worker):
+        if self.busy.pop(worker.fd, None) is not None:
+            self.poller.unregister(worker.fd)
+        for key in worker.keys:
+            del self.assigned[key]
+        worker.keys.clear()
+
+    def _start(self):
+        proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE)
+        self.nb_started += 1
+        return Worker(proc)
+
+    def _wait_started(self, worker):
+        try:
+            if read_signal(worker.fd, EndpointPool.START_TIMEOUT) == READY:
+                return True
+        except TimedoutException as err:
+            logger.debug("%s: %s", worker, err.msg)
+        logger.debug("%s failed to start", worker)
+        self._stop(worker)
+        return False
+
+    def _stop(self, worker):
+        if worker.proc.poll() is None:
+            worker.proc.kill()
+        worker.proc.wait()
+
+    def _nb_recycled(self):
+        return sum(len(workers) for workers in self.recycled.values())
+
+    def _trim(self):
+        # Warm workers in excess of the target, called with cond held
+        extra = []
+        while len(self.idle) > self.target:
+            extra.append(self.idle.pop())
+        nb_recycled = self._nb_recycled()
+        while nb_recycled > self.target:
+            netns = max(self.recycled, key=lambda n: len(self.recycled[n]))
+            extra.append(self.recycled[netns].pop())
+            if not self.recycled[netns]:
+                del self.recycled[netns]
+            nb_recycled -= 1
+        return extra
+
+    def _refill(self):
+        while True:
+            with self.cond:
+                while (not self.stopping and
+                       len(self.idle) + self.starting >= self.target and
+                       len(self.idle) <= self.target and
+                       self._nb_recycled() <= self.target):
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                extra = self._trim()
+                need = max(0, min(EndpointPool.START_BATCH,
+                                  self.target - len(self.idle) -
+                                  self.starting))
+                self.starting += need
+            for worker in extra:
+                self._retire(worker)
+            # Started together, they import their modules in parallel
+            workers = [self._start() for _ in xrange(need)]
+            for worker in workers:
+                started = self._wait_started(worker)
+                with self.cond:
+                    self.starting -= 1
+                    if started:
+                        self.idle.append(worker)
+                    self.cond.notify_all()
+
+    def close(self):
+        """
+            Close the control channel of the workers, they stop once their
+            ends are done.
+        """
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join()
+        workers = list(self.idle) + self.busy.values()
+        for recycled in self.recycled.values():
+            workers.extend(recycled)
+        for worker in workers:
+            self._retire(worker)
+
+    def _retire(self, worker):
+        # Closing its control channel stops a worker once its ends are done
+        out, _ = worker.proc.communicate()
+        logger.info("Endpoint %s: %s", worker, out.lstrip(DONE).strip())
+
+    def __str__(self):
+        return ("Endpoint pool: {} workers started, {} ends opened by a warm "
+                "worker, {} by a recycled one, {} by a new one".format(
+                    self.nb_started, self.nb_warm, self.nb_reused,
+                    self.nb_cold))
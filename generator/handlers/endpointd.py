@@ -0,0 +1,171 @@
+#!/usr/bin/python
+"""
+    Endpoint daemon of an emulated host. A single process runs all the
+    client and server ports of its host in a ReplayEngine, instead of a
+    client.py or server.py process per port.
+
+    The ends to open are read from stdin, the control channel of the
+    daemon. Each command is a length prefixed, compressed pickle of
+        ("server" | "client", proto, (ip, port), (peer ip, peer port), gen)
+    where gen is the FlowLazyGen schedule of the end. Ports of a previous
+    command are reused, their schedule is appended to the ones pending.
+    Each command is acknowledged on stdout by a readiness byte, once the
+    socket of the end is bound (and listening for a server).
+    The daemon stops once stdin is closed and its ends are done.
+
+    With --worker, the daemon is a worker of an EndpointPool. It signals
+    that it is ready once its modules are imported, and its first command
+    can be ("netns", pid) to enter the network namespace of the process
+    pid (a Mininet host). Once its ends are closed after a last schedule,
+    it closes its listening sockets and writes a done byte, it can then
+    be given other ends.
+"""
+import os
+import sys
+import ctypes
+import ctypes.util
+import logging
+from logging.handlers import RotatingFileHandler
+import argparse
+import cPickle as pickle
+import zlib
+from threading import Thread, Event, Lock
+from traceback import format_exception
+from util import read_message, signal_ready, signal_done
+from replayEngine import ReplayEngine
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--name", type=str, dest="name", action="store",
+                    help="name of the host running the daemon")
+parser.add_argument("--timeout", type=float, dest="timeout", action="store",
+                    default=30,
+                    help="seconds to wait for the ends still open once the "
+                         "control channel is closed")
+parser.add_argument("--worker", action="store_true",
+                    help="run as a worker of an endpoint pool")
+
+args = parser.parse_args()
+
+COMMANDS = ("server", "client")
+
+CLONE_NEWNET = 0x40000000
+
+def init_logger(name):
+    logg = logging.getLogger()
+    logg.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s :: %(levelname)s :: %(message)s')
+    log_name = '../logs/endpointd_%s.log' % name
+    if os.path.exists(log_name):
+        os.remove(log_name)
+    file_handler = RotatingFileHandler(log_name, 'a', 1000000, 1)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(formatter)
+    logg.addHandler(file_handler)
+    return logg
+
+logger = init_logger(args.name or "worker_{}".format(os.getpid()))
+
+def log_exception(etype, val, tb):
+    logger.exception("%s", "".join(format_exception(etype, val, tb)))
+
+sys.excepthook = log_exception
+
+def enter_netns(pid):
+    # The threads started afterwards, the one of the engine included, are
+    # in the namespace too
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = os.open("/proc/{}/ns/net".format(pid), os.O_RDONLY)
+    try:
+        if libc.setns(fd, CLONE_NEWNET) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    finally:
+        os.close(fd)
+
+class EndpointDaemon(object):
+
+    def __init__(self, worker=False):
+        self.worker = worker
+        # Started on the first end, once in the right namespace
+        self.engine = None
+        self.netns = None
+        self.nb_cmd = 0
+        # A command is opened and acknowledged while holding the lock
+        self.lock = Lock()
+        # An end received its last schedule since the last done byte
+        self.last = Event()
+
+    def serve(self, control):
+        if self.worker:
+            watcher = Thread(target=self.watch_done)
+            watcher.daemon = True
+            watcher.start()
+            signal_ready()
+        while True:
+            data = read_message(control)
+            if not data:
+                break
+            command = pickle.loads(zlib.decompress(data))
+            with self.lock:
+                signal_ready(self.run(command))
+            self.nb_cmd += 1
+
+    def run(self, command):
+        role = command[0]
+        if role == "netns":
+            return self.enter(command[1])
+        if role not in COMMANDS:
+            logger.debug("Unknown command %s", role)
+            return False
+        _, proto, local, peer, gen = command
+        logger.debug("Opening %s %s:%s for %s:%s", role, local[0], local[1],
+                     peer[0], peer[1])
+        if self.engine is None:
+            self.engine = ReplayEngine()
+        if role == "server":
+            task = self.engine.open_server(proto, local, peer, gen)
+        else:
+            task = self.engine.open_client(proto, local, peer, gen)
+        task.ready.wait()
+        if gen.last and not task.failed:
+            self.last.set()
+        return not task.failed
+
+    def enter(self, pid):
+        if pid == self.netns:
+            return True
+        if self.engine is not None:
+            logger.debug("Ends already open outside of namespace of %s", pid)
+            return False
+        try:
+            enter_netns(pid)
+        except OSError as err:
+            logger.debug("Unable to enter namespace of %s: %s", pid, err)
+            return False
+        self.netns = pid
+        return True
+
+    def watch_done(self):
+        while True:
+            self.last.wait()
+            self.engine.drain()
+            with self.lock:
+                # No end opened since the drain
+                if self.engine.drained.is_set():
+                    self.last.clear()
+                    self.engine.close_listeners()
+                    logger.debug("Ends done, %s", self.engine)
+                    signal_done()
+
+    def stop(self, timeout):
+        logger.info("Control channel closed after %d commands", self.nb_cmd)
+        if self.engine is None:
+            return
+        if not self.engine.drain(timeout):
+            logger.debug("Ends still open after %ss", timeout)
+        self.engine.wait_termination(0)
+
+if __name__ == "__main__":
+    daemon = EndpointDaemon(args.worker)
+    daemon.serve(sys.stdin.fileno())
+    daemon.stop(args.timeout)
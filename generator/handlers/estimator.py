@@ -0,0 +1,278 @@
+"""
+    Fitting of the packet size and inter-arrival distributions of the flows.
+    The functions are defined at module level so the fitting of a frame can
+    be dispatched to a multiprocessing pool.
+"""
+
+import os
+import pickle
+import hashlib
+import tempfile
+from threading import RLock
+from collections import OrderedDict
+from multiprocessing import Pool
+import numpy as np
+from scipy import stats
+from sklearn.neighbors import KernelDensity
+
+import util
+from flows import (Distribution, DiscreteGen, ContinuousGen, QuantileGen,
+                   ScaledGen)
+
+# Minimum sample size for to consider continuous
+MIN_SAMPLE_SIZE = 50
+# Nb iteration to test MSE
+NB_ITER = 10
+# Flows sent to a worker at once
+CHUNK_SIZE = 8
+# Bandwidth of the kernel density estimation
+BANDWIDTH = 0.1
+KDE_NAME = "sci-kde"
+# Sampler of the estimated inter-arrival distribution:
+#   sci-kde: sklearn KernelDensity
+#   quantile: interpolation in a quantile table of the gaussian KDE
+#   jitter: quantile table of the sample plus gaussian noise of the kernel
+#           bandwidth
+SAMPLER = "quantile"
+SAMPLERS = [KDE_NAME, "quantile", "jitter"]
+# Estimation of the inter-arrival distributions:
+#   flow: one generator per flow
+#   cluster: one generator per cluster of flows, fitted on their pooled samples
+ESTIM_MODES = ["flow", "cluster"]
+
+
+def kde_estim(data, niter, sampler=None):
+    sampler = sampler or SAMPLER
+    try:
+        # List of the distribution represented as a tuple RV and weight
+        # [[(gamma,1)], [(beta, 1)], ...]
+        if sampler != KDE_NAME:
+            return [(QuantileGen(data, BANDWIDTH, jitter=sampler == "jitter"),
+                     1)], sampler
+        data_reshape = np.array(data).reshape(-1, 1)
+        kernel_d = KernelDensity(bandwidth=BANDWIDTH, kernel='gaussian')
+        kernel_d.fit(data_reshape)
+        return [(kernel_d, 1)], KDE_NAME
+
+    except ValueError:
+        print data
+
+
+def fit_pkt(pkt_dist):
+    return DiscreteGen(util.get_pmf(pkt_dist))
+
+
+def fit_arr(arr_dist, niter=NB_ITER):
+    if len(arr_dist) > MIN_SAMPLE_SIZE:
+        distribution, _ = kde_estim(arr_dist, niter)
+        return ContinuousGen(distribution)
+    return DiscreteGen(util.get_pmf(arr_dist))
+
+
+def pool_samples(samples):
+    """
+        Concatenate the samples divided by their mean. Return the pooled
+        sample and the mean of each sample, None if it cannot be scaled.
+    """
+    pooled = [np.empty(0)]
+    scales = []
+    for sample in samples:
+        data = np.asarray(sample, dtype=np.float64)
+        mean = data.mean() if len(data) > 0 else 0
+        if mean > 0:
+            pooled.append(data / mean)
+            scales.append(mean)
+        else:
+            scales.append(None)
+    return np.concatenate(pooled), scales
+
+
+def gen_nbytes(gen):
+    """
+        Approximate memory size of a generator: the size of its arrays,
+        including the sample kept by a KernelDensity or a gaussian_kde.
+    """
+    if isinstance(gen, np.ndarray):
+        return gen.nbytes
+    if isinstance(gen, (list, tuple)):
+        return sum(gen_nbytes(elem) for elem in gen)
+    if isinstance(gen, KernelDensity):
+        tree = getattr(gen, 'tree_', None)
+        if tree is None:
+            return 0
+        return sum(array.nbytes for array in tree.get_arrays())
+    if isinstance(gen, stats.gaussian_kde):
+        return gen.dataset.nbytes
+    if isinstance(gen, Distribution):
+        return sum(gen_nbytes(v) for v in gen.__dict__.itervalues())
+    return 0
+
+
+def arr_kind(niter):
+    # Kind of the inter-arrival generators in the store
+    return "arr:{}".format(niter)
+
+
+def fit_flow(dists):
+    pkt_dist, arr_dist = dists
+    return fit_pkt(pkt_dist), fit_arr(arr_dist)
+
+
+class DistStore(object):
+
+    """
+        LRU store of the fitted generators, keyed by a hash of the sample and
+        of the estimator settings. Identical samples repeat across frames and
+        across runs on the same dataset (see --savedist/--loaddist). size is
+        the approximate memory of the generators in bytes, see gen_nbytes().
+    """
+
+    # Memory of an entry besides its arrays: key, objects, dictionaries
+    ENTRY_BYTES = 512
+
+    def __init__(self, size=256 * 1024 * 1024):
+        self.size = size
+        self.dists = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # The prefetcher fits distributions from another thread
+        self.lock = RLock()
+
+    @staticmethod
+    def key(kind, data):
+        h = hashlib.sha1()
+        h.update("{}:{}:{}:{}:{}:{}:".format(kind, MIN_SAMPLE_SIZE,
+                                             BANDWIDTH, SAMPLER,
+                                             QuantileGen.TABLE_SIZE,
+                                             QuantileGen.KERNEL_POINTS))
+        # Same key for a list or an array of any type holding the same values
+        h.update(np.ascontiguousarray(data, dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            gen = self.dists.pop(key, None)
+            if gen is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.dists[key] = gen
+            return gen
+
+    def put(self, key, gen):
+        with self.lock:
+            self._remove(key)
+            self.dists[key] = gen
+            self.sizes[key] = gen_nbytes(gen) + DistStore.ENTRY_BYTES
+            self.nbytes += self.sizes[key]
+            # The last generator is kept even if it is larger than the store
+            while self.nbytes > self.size and len(self.dists) > 1:
+                self._remove(next(iter(self.dists)))
+
+    def _remove(self, key):
+        if self.dists.pop(key, None) is not None:
+            self.nbytes -= self.sizes.pop(key)
+
+    def fetch(self, kind, data, fit):
+        key = DistStore.key(kind, data)
+        gen = self.get(key)
+        if gen is None:
+            gen = fit(data)
+            self.put(key, gen)
+        return gen
+
+    def load(self, filename):
+        with open(filename, 'rb') as fh:
+            dists = pickle.load(fh)
+        with self.lock:
+            for key, gen in dists.items():
+                self.put(key, gen)
+
+    def save(self, filename):
+        dirname = os.path.dirname(os.path.abspath(filename))
+        fd, tmpname = tempfile.mkstemp(dir=dirname)
+        with self.lock:
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(self.dists, fh, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, filename)
+
+    def __len__(self):
+        return len(self.dists)
+
+    def __str__(self):
+        return "Distribution store: {} hits, {} misses, {:.1f}MB".format(
+            self.hits, self.misses, self.nbytes / 1048576.0)
+
+
+class FrameEstimator(object):
+
+    """
+        Fit the distributions of all the flows of a frame, either serially
+        or with a pool of worker processes. Samples already in the store are
+        not fitted again.
+    """
+
+    def __init__(self, workers=None, store=None):
+        self.workers = workers
+        self.store = store
+        self.pool = None
+        if workers is not None and workers > 1:
+            self.pool = Pool(workers)
+
+    def fit_pkt(self, pkt_dist):
+        if self.store is None:
+            return fit_pkt(pkt_dist)
+        return self.store.fetch("pkt", pkt_dist, fit_pkt)
+
+    def fit_arr(self, arr_dist, niter=NB_ITER):
+        if self.store is None:
+            return fit_arr(arr_dist, niter)
+        return self.store.fetch(arr_kind(niter), arr_dist,
+                                lambda data: fit_arr(data, niter))
+
+    def fit_cluster(self, samples):
+        """
+            Inter-arrival generators of the members of a cluster: a single
+            generator is fitted on the pooled samples and scaled to the mean
+            of each member.
+        """
+        pooled, scales = pool_samples(samples)
+        shared = self.fit_arr(pooled) if len(pooled) > 0 else None
+        return [ScaledGen(shared, scale) if scale is not None
+                else self.fit_arr(sample)
+                for sample, scale in zip(samples, scales)]
+
+    def fit(self, flows):
+        """
+            flows is a list of decoded records, the result is the list of
+            (pkt, arr) generators in the same order.
+        """
+        dists = [(pkt_dist, arr_dist) for (_, _, _, _, _, _, _, _, _, pkt_dist,
+                                           arr_dist) in flows]
+        if self.pool is None:
+            return [(self.fit_pkt(p), self.fit_arr(a)) for p, a in dists]
+
+        if self.store is None:
+            # Views on the memory-mapped frame are copied when sent to the
+            # worker
+            return self.pool.map(fit_flow, dists, CHUNK_SIZE)
+
+        keys = [(DistStore.key("pkt", p),
+                 DistStore.key(arr_kind(NB_ITER), a)) for p, a in dists]
+        fitted = [(self.store.get(kp), self.store.get(ka)) for kp, ka in keys]
+        missing = [i for i, (gp, ga) in enumerate(fitted)
+                   if gp is None or ga is None]
+        res = self.pool.map(fit_flow, [dists[i] for i in missing], CHUNK_SIZE)
+        for i, gens in zip(missing, res):
+            fitted[i] = gens
+            self.store.put(keys[i][0], gens[0])
+            self.store.put(keys[i][1], gens[1])
+        return fitted
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
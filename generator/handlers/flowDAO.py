@@ -117,7 +117,7 @@ class FlowRequestSockReader(FlowDAOReader):
             try:
                 self.entry_point.listen(3)
                 conn, addr = self.entry_point.accept()
-                data = util.recv_msg_tcp(conn)
+                data, _ = util.recv_msg_tcp(conn)
                 self.queue.put(data)
                 conn.close()
             except socket.timeout:
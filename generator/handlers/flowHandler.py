@@ -10,7 +10,7 @@ import pickle
 import errno
 import pdb
 import tempfile
-from threading import RLock
+from threading import RLock, Thread
 from datetime import datetime
 from datetime import timedelta
 from collections import OrderedDict
@@ -20,17 +20,26 @@ import numpy as np
 import scipy.stats as stats
 from scipy.stats.kde import gaussian_kde
 from sklearn.mixture import GaussianMixture
-from sklearn.neighbors import KernelDensity
 from mininet.net import Mininet
 from mininet.clean import cleanup, sh
 from mininet.cli import CLI
 
 import util 
-from flows import Flow, FlowKey, FlowCategory
+import estimator
+from flows import Flow, FlowKey, FlowCategory, IntAddress
+from flowIndex import FlowIndex, canonical_key
+from flowLifecycle import FlowLifecycle
 from flows import DiscreteGen, ContinuousGen
 from simulator import Simulator
 from networkHandler import LocalHandler, NetworkHandler, GenTopo
+from replayEngine import ReplayEngine
 from flowStatReader import FlowStatReader
+from frameReader import FrameCache, is_index_file
+from estimator import FrameEstimator, DistStore
+from distances import flow_distances, flow_distances_on_disk, flow_samples
+from clustering import clustering_matrix, to_clusters
+from sketch import approximate_clustering
+from clusterState import ClusterState
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -52,6 +61,23 @@ if __name__ == "__main__":
                         help="load distribution from previous run")
     parser.add_argument("--numflow", type=int, dest="numflow", action="store",
                         help="limit number of flow generated (debug)")
+    parser.add_argument("--workers", type=int, dest="workers", action="store",
+                        help="number of processes fitting the distributions")
+    parser.add_argument("--arrmode", choices=Flow.ARR_MODES, dest="arrmode",
+                        action="store", default=Flow.ARR_MODE,
+                        help="match the total inter-arrival time by best of "
+                             "several trials or by rescaling one draw")
+    parser.add_argument("--estimmode", choices=estimator.ESTIM_MODES,
+                        dest="estimmode", action="store",
+                        default=estimator.ESTIM_MODES[0],
+                        help="fit the inter-arrival distribution of each flow "
+                             "or of each cluster of flows")
+    parser.add_argument("--engine", choices=["process", "loop", "pool"],
+                        dest="engine", action="store", default="process",
+                        help="run each endpoint in its own process, or in "
+                             "local mode all of them in one event loop and in "
+                             "mininet mode those of each host in one daemon, "
+                             "or each of them in a worker started ahead")
     args = parser.parse_args()
 
 def swap_bytes(array, swap_size):
@@ -67,27 +93,54 @@ def substract_time(t1, t2):
     raise ValueError("%s is before %s "% (t2, t1))
 
 
+class FramePrefetcher(Thread):
+
+    """
+        Parse a frame and fit the distributions of its flows in background,
+        while the previous frame is being replayed.
+    """
+
+    def __init__(self, handler, filename):
+        Thread.__init__(self)
+        self.daemon = True
+        self.handler = handler
+        self.filename = filename
+        # (pkt, arr) generators, in the order of the records of the frame
+        self.fitted = None
+
+    def run(self):
+        frame = self.handler.frame_cache.get(self.filename)
+        self.fitted = self.handler.fit_frame(frame)
+
+
 class FlowHandler(object):
 
     # Nb iteration to test MSE
-    NB_ITER = 10
+    NB_ITER = estimator.NB_ITER
     NB_CLUSTER = 5
     MIN_DIST = 0.2
     # Minimum sample size for to consider continuous
-    MIN_SAMPLE_SIZE = 50
+    MIN_SAMPLE_SIZE = estimator.MIN_SAMPLE_SIZE
+    # Number of parsed frames kept in memory
+    FRAME_CACHE_SIZE = 3
+    # Memory of the fitted distributions kept (and in output_dist), in MB
+    DIST_STORE_MB = 256
+    ESTIM_MODE = "flow"
 
     """
         This is the main class coordinating the creation/deletion of flows
     """
 
     def __init__(self, config, mode="mininet", read="bin", saveflow=None, loadflow=None,
-                 savedist=None, loaddist=None):
+                 savedist=None, loaddist=None, workers=None, arr_mode=None,
+                 estim_mode=None, engine="process"):
 
         with open(config, 'r') as stream:
             try:
                 conf = yaml.load(stream)
                 self.dir = conf['input']
-                self.dir_stats = util.sorted_nicely((os.listdir(conf['input'])))
+                self.dir_stats = util.sorted_nicely([x for x in os.listdir(conf['input'])
+                                                     if not is_index_file(x)])
                 self.frame_index = 0
                 filename = os.path.join(self.dir, self.dir_stats[self.frame_index])
                 appli = conf['application']
@@ -102,6 +155,7 @@ class FlowHandler(object):
                 self.do_attack = conf['doAttack']
                 self.attack_frame = conf['attackFrame']
                 self.read_mode = read
+                self.engine = engine
                 if self.mininet_mode:
                     self.prefixv4 = ip_network(unicode(conf['prefixv4'])).hosts()
                 else:
@@ -120,21 +174,50 @@ class FlowHandler(object):
                 self.pipelock = {}
 
                 self.safe_mode = conf['safeMode']
+                Flow.ARR_TOLERANCE = conf.get('arrTolerance', Flow.ARR_TOLERANCE)
+                Flow.TRIAL_BLOCK = conf.get('trialBlock', Flow.TRIAL_BLOCK)
+                if arr_mode is not None:
+                    Flow.ARR_MODE = arr_mode
                 self.attacker_ip = None
-                self.index = 0
+                self.frame_cache = FrameCache(FlowHandler.FRAME_CACHE_SIZE)
+                self.prefetcher = None
 
                 assert not ((loadflow is not None) and (saveflow is not None))
                 assert not ((loaddist is not None) and (savedist is not None))
 
+                self.dist_store = DistStore(int(
+                    conf.get('distStoreMB', FlowHandler.DIST_STORE_MB) * 1048576))
+                if loaddist is not None and os.path.exists(conf['input_dist']):
+                    self.dist_store.load(conf['input_dist'])
+                self.output_dist = conf['output_dist'] if savedist is not None else None
+                # Pool is forked before any thread is started
+                self.estimator = FrameEstimator(workers, self.dist_store)
+                self.estim_mode = FlowHandler.ESTIM_MODE if estim_mode is None \
+                                  else estim_mode
+                # The flows are clustered on their empirical samples
+                if (self.estim_mode == "cluster" or
+                        conf.get('incrementalClustering', False)):
+                    self.keep_emp = True
+
                 if loadflow is not None:
                     input_pck = conf['input_flow']
                     with open(input_pck, 'rb') as fh:
                         self.flows = pickle.load(fh)
+                    if not isinstance(self.flows, FlowIndex):
+                        # Flows saved as a dictionnary
+                        self.flows = FlowIndex(self.flows.values())
                 elif saveflow is not None:
                     output_pck = conf['output_flow']
                     self.flows = self.retrieve_flows(filename, output_pck)
                 else:
                     self.flows = self.retrieve_flows(filename)
+                self.lifecycle = FlowLifecycle(self.flows)
+
+                self.cluster_state = None
+                if conf.get('incrementalClustering', False):
+                    self.cluster_state = ClusterState(FlowHandler.MIN_DIST)
+                    self.update_cluster_state()
+                self.estimate_frame_clusters()
                 # Last category that was spawn
                 self.last_cat = None
 
@@ -154,143 +237,95 @@ class FlowHandler(object):
                 line = "{}\t{}\n".format(k, v)
                 f.write(line)
 
-    def read(self, _type, readsize, f):
-        self.index += readsize
-        return struct.unpack(_type, f.read(readsize))[0]
-
     def change_ip(self, address):
 
         if address in self.mapping_address:
             return self.mapping_address[address]
         else:
-            res = next(self.prefixv4)
+            res = IntAddress(int(next(self.prefixv4)))
             self.mapping_address[address] = res
             return res
 
-    def get_flow_key(self, srcip, dstip, sport, dport, proto, first):
+    def get_flow_cat(self, sport, dport):
         # Service running in the trace must be on server side
-        client_flow = None
-        server_flow = None
         if sport in self.categories:
-            client_flow = FlowKey(dstip, srcip, dport, sport, proto, None, sport)
-            server_flow = FlowKey(srcip, dstip, sport, dport, proto, first, sport)
+            return sport
         elif dport in self.categories:
-            client_flow = FlowKey(srcip, dstip, sport, dport, proto, first, dport)
-            server_flow = FlowKey(dstip, srcip, dport, sport, proto, None, dport)
-
-        if server_flow is None and client_flow is None:
-            client_flow = FlowKey(srcip, dstip, sport, dport, proto, first, 0)
-            server_flow = FlowKey(dstip, srcip, dport, sport, proto, None, 0)
-
-        return (server_flow, client_flow)
-
-    def read_flow(self, f):
-        addr = IPv4Address(self.read('>I', 4, f))
-        srcip = self.change_ip(addr)
-        addr = IPv4Address(self.read('>I', 4, f))
-        dstip = self.change_ip(addr)
-        sport = self.read('H', 2, f)
-        dport = self.read('H', 2, f)
-        proto = self.read('B', 1, f)
-        self.read('BBB', 3, f) # Padding
-
-        size = self.read('Q', 8, f)
-        nb_pkt = self.read('Q', 8, f)
-
-        first_sec = self.read('Q', 8, f)
-        first_micro = self.read('Q', 8, f)
-        timestamp = datetime.fromtimestamp(first_sec)
-        first = timestamp + timedelta(microseconds=first_micro)
-
-        duration = (self.read('f', 4, f))/float(1000)
-
-        size_list = self.read('Q', 8, f)
-
-        pkt_dist = []
-        while size_list > 0:
-            val = self.read('H', 2, f)
-            pkt_dist.append(val)
-            size_list -= 1
-
-        size_list = self.read('Q', 8, f)
-        arr_dist = []
-        while size_list > 0:
-            val = self.read('f', 4, f)
-            arr_dist.append(val)
-            size_list -= 1
-        return (srcip, dstip, sport, dport, proto, size,
-                nb_pkt, first, duration, pkt_dist, arr_dist)
+            return dport
+        return 0
+
+    def new_flow(self, srcip, dstip, sport, dport, proto, first, duration,
+                 size, nb_pkt, pkt_dist, arr_dist, first_frame=0,
+                 last_frame=0, flows=None):
+        # The key of a flow is in the direction of its first record, which
+        # is the client one unless the source port is a service
+        flowkey = FlowKey(srcip, dstip, sport, dport, proto, first,
+                          self.get_flow_cat(sport, dport))
+        flow = Flow(flowkey, duration, size, nb_pkt, keep_emp=self.keep_emp,
+                    pkt_dist=pkt_dist, arr_dist=arr_dist,
+                    client_flow=sport not in self.categories,
+                    first_frame=first_frame, last_frame=last_frame,
+                    table=(flows if flows is not None else self.flows).table)
+        flow.emp_arr = util.dist_sum(arr_dist)
+        return flow
+
+    def add_reverse_to_cat(self, flow, size, nb_pkt, duration):
+        # Record of the reverse direction of a known flow
+        flow_cat = self.category_dist[flow.cat]
+        if flow.is_client_flow:
+            flow_cat.add_flow_client(flow.size, flow.nb_pkt, flow.dur)
+            flow_cat.add_flow_server(size, nb_pkt, duration)
+        else:
+            flow_cat.add_flow_client(size, nb_pkt, duration)
+            flow_cat.add_flow_server(flow.size, flow.nb_pkt, flow.dur)
+
+    def read_frame(self, filename):
+        for (srcip, dstip, sport, dport, proto, size, nb_pkt, first, duration,
+             pkt_dist, arr_dist) in self.frame_cache.get(filename).flows():
+            srcip = self.change_ip(IntAddress(srcip))
+            dstip = self.change_ip(IntAddress(dstip))
+            yield (srcip, dstip, sport, dport, proto, size,
+                   nb_pkt, first, duration, pkt_dist, arr_dist)
+
+    def fit_parallel(self, filename):
+        # With a single process, the distributions are fitted on demand
+        if self.estimator.pool is None:
+            return None
+        return self.fit_frame(self.frame_cache.get(filename))
 
     def retrieve_flows(self, filename, output_pck=None):
-        flows = OrderedDict()
-        with open(filename, "rb") as f:
-            filesize = os.path.getsize(filename)
-            self.index = 0
-            while self.index < filesize:
-                (srcip, dstip, sport, dport, proto, size, nb_pkt, first,
-                 duration, pkt_dist, arr_dist) = self.read_flow(f)
-
-                cur_flow = None
-
-                srv_flow, clt_flow = self.get_flow_key(srcip, dstip, sport, dport,
-                                                       proto, first)
-
-                flow_cat = self.category_dist[clt_flow.cat]
-                if not (clt_flow in flows or srv_flow in flows):
-                    if clt_flow.first is not None:
-                        flow = Flow(clt_flow, duration, size, nb_pkt,
-                                    keep_emp=self.keep_emp, pkt_dist=pkt_dist, arr_dist=arr_dist)
-                        flow.emp_arr = sum(arr_dist)
-                        flows[clt_flow] = flow
-                        self.estimate_distribution(flow, pkt_dist, arr_dist, FlowHandler.NB_ITER)
-                        cur_flow = flow
-
-                    elif srv_flow.first is not None:
-                        flow = Flow(srv_flow, duration, size, nb_pkt,
-                                    keep_emp=self.keep_emp, pkt_dist=pkt_dist,
-                                    arr_dist=arr_dist, client_flow=False)
-                        flow.emp_arr = sum(arr_dist)
-                        flows[srv_flow] = flow
-                        self.estimate_distribution(flow, pkt_dist, arr_dist, FlowHandler.NB_ITER)
-                        cur_flow = flow
-                    else:
-                        raise ValueError("Invalid time for flow first appearance")
-
-                elif clt_flow in flows:
-                    # If source ip are different, then its a server flow of an
-                    # already known flow
-                    if srcip != clt_flow.srcip:
-                        flow = flows[clt_flow]
-                        flow.set_reverse_stats(duration, size, nb_pkt, first,
-                                               keep_emp=self.keep_emp,
-                                               pkt_dist=pkt_dist,
-                                               arr_dist=arr_dist)
-                        flow.in_emp_arr = sum(arr_dist)
-                        self.estimate_distribution(flow, pkt_dist, arr_dist, FlowHandler.NB_ITER,
-                                                   clt=False)
-                        flow_cat.add_flow_client(flow.size, flow.nb_pkt,
-                                                 flow.dur)
-                        flow_cat.add_flow_server(size, nb_pkt, duration)
-                        cur_flow = flow
-                elif srv_flow in flows:
-                    if srcip != srv_flow.srcip:
-                        flow = flows[srv_flow]
-                        flow.set_reverse_stats(duration, size, nb_pkt, first,
-                                               keep_emp=self.keep_emp,
-                                               pkt_dist=pkt_dist,
-                                               arr_dist=arr_dist)
-                        flow.in_emp_arr = sum(arr_dist)
-                        self.estimate_distribution(flow, pkt_dist, arr_dist, FlowHandler.NB_ITER,
-                                                   clt=False)
-                        flow_cat.add_flow_client(size, nb_pkt, duration)
-                        flow_cat.add_flow_server(flow.size, flow.nb_pkt,
-                                                 flow.dur)
-                        cur_flow = flow
-
-                assert flow.estim_arr is not None and flow.estim_pkt is not None
-
-                src_pipe, dst_pipe = self.create_flow_pipename(cur_flow)
-                self.create_pipe(src_pipe, dst_pipe)
+        flows = FlowIndex()
+        fitted_frame = self.fit_parallel(filename)
+        for i, (srcip, dstip, sport, dport, proto, size, nb_pkt, first,
+                duration, pkt_dist, arr_dist) in enumerate(self.read_frame(filename)):
+
+            fitted = fitted_frame[i] if fitted_frame is not None else None
+
+            flow, same = flows.find_record(srcip, dstip, sport, dport, proto)
+            if flow is None:
+                flow = self.new_flow(srcip, dstip, sport, dport, proto, first,
+                                     duration, size, nb_pkt, pkt_dist, arr_dist,
+                                     flows=flows)
+                flows.add(flow)
+                self.estimate_distribution(flow, pkt_dist, arr_dist, FlowHandler.NB_ITER,
+                                           fitted=fitted)
+
+            elif not same:
+                # Server flow of an already known flow
+                flow.set_reverse_stats(duration, size, nb_pkt, first,
+                                       keep_emp=self.keep_emp,
+                                       pkt_dist=pkt_dist,
+                                       arr_dist=arr_dist)
+                flow.in_emp_arr = util.dist_sum(arr_dist)
+                self.estimate_distribution(flow, pkt_dist, arr_dist, FlowHandler.NB_ITER,
+                                           clt=False, fitted=fitted)
+                self.add_reverse_to_cat(flow, size, nb_pkt, duration)
+
+            assert flow.estim_pkt is not None and (flow.estim_arr is not None or
+                                                   self.estim_mode == "cluster")
+
+            src_pipe, dst_pipe = self.create_flow_pipename(flow)
+            self.create_pipe(src_pipe, dst_pipe)
 
         if output_pck is not None:
             with open(output_pck, 'wb') as fhr:
@@ -298,23 +333,18 @@ class FlowHandler(object):
 
         return flows
 
-    def get_next_frame_flow(self):
-        next_frame_flow = set()
+    def read_ahead(self):
+        # Flows of the next frame, the keys are read from its index
         if self.frame_index < len(self.dir_stats) - 1:
             filename = os.path.join(self.dir, self.dir_stats[self.frame_index +1])
+            frame = self.frame_cache.get(filename)
+            self.lifecycle.read_ahead(self.frame_index + 1, (
+                (self.change_ip(IntAddress(srcip)),
+                 self.change_ip(IntAddress(dstip)), sport, dport, proto)
+                for srcip, dstip, sport, dport, proto in frame.keys()))
 
-            with open(filename, "rb") as f:
-                filesize = os.path.getsize(filename)
-                self.index = 0
-                while self.index < filesize:
-                    (srcip, dstip, sport, dport, proto, size, nb_pkt, first,
-                     duration, pkt_dist, arr_dist) = self.read_flow(f)
-
-                    srv_flow, clt_flow = self.get_flow_key(srcip, dstip, sport,
-                                                           dport, proto, first)
-                    next_frame_flow.add(srv_flow)
-                    next_frame_flow.add(clt_flow)
-        return next_frame_flow
+    def is_last(self, flowkey):
+        return self.lifecycle.is_last(flowkey, self.frame_index)
 
     def create_flow_pipename(self, flow):
         tmpdir = tempfile.gettempdir()
@@ -327,6 +357,21 @@ class FlowHandler(object):
     def get_stats_file(self):
         return os.path.join(self.dir, self.dir_stats[self.frame_index])
 
+    def start_prefetch(self, frame_index):
+        if frame_index < len(self.dir_stats):
+            filename = os.path.join(self.dir, self.dir_stats[frame_index])
+            self.prefetcher = FramePrefetcher(self, filename)
+            self.prefetcher.start()
+
+    def get_prefetched(self, filename):
+        prefetcher = self.prefetcher
+        if prefetcher is None or prefetcher.filename != filename:
+            return None
+        self.prefetcher = None
+        # Only blocks if the previous frame was shorter than the estimation
+        prefetcher.join()
+        return prefetcher.fitted
+
     # Modify emp_arr and in_emp_arr
     def is_flow_to_reestimate(self, flow, nb_pkt, pkt_dist, arr_dist,
                               clt=True):
@@ -344,9 +389,9 @@ class FlowHandler(object):
             reestimate_pkt = ks_pkt < self.slice_ks_thresh
 
         if clt:
-            flow.emp_arr = sum(arr_dist)
+            flow.emp_arr = util.dist_sum(arr_dist)
         else:
-            flow.in_emp_arr = sum(arr_dist)
+            flow.in_emp_arr = util.dist_sum(arr_dist)
 
         if clt:
             old_arr_dist = flow.generate_client_arrs(nb_pkt)
@@ -361,10 +406,8 @@ class FlowHandler(object):
 
         return reestimate_pkt, reestimate_arr
 
-    def update_flow(self, flowkey, duration, size, nb_pkt, first,
-                    pkt_dist, arr_dist):
-
-        flow = self.flows[flowkey]
+    def update_flow(self, flow, duration, size, nb_pkt, first,
+                    pkt_dist, arr_dist, fitted=None):
 
         if self.slice_dist and flow.first_frame < self.frame_index:
             reestimate_pkt, reestimate_arr = self.is_flow_to_reestimate(flow,
@@ -376,15 +419,14 @@ class FlowHandler(object):
 
         flow.set_stats(duration, size, nb_pkt, first, keep_emp=self.keep_emp,
                        pkt_dist=pkt_dist, arr_dist=arr_dist)
-        flow.last_frame = self.frame_index
-        flow.emp_arr = sum(arr_dist)
+        self.lifecycle.update(flow, self.frame_index)
+        flow.emp_arr = util.dist_sum(arr_dist)
         self.estimate_distribution(flow, pkt_dist, arr_dist,
                                    FlowHandler.NB_ITER, estpkt=reestimate_pkt,
-                                   estarr=reestimate_arr)
+                                   estarr=reestimate_arr, fitted=fitted)
 
-    def update_reverse_stats(self, flowkey, duration, size, nb_pkt, first, 
-                             pkt_dist, arr_dist):
-        flow = self.flows[flowkey]
+    def update_reverse_stats(self, flow, duration, size, nb_pkt, first,
+                             pkt_dist, arr_dist, fitted=None):
         if self.slice_dist and flow.first_frame < self.frame_index:
             reestimate_pkt, reestimate_arr = self.is_flow_to_reestimate(flow,
                                                                         nb_pkt,
@@ -397,11 +439,12 @@ class FlowHandler(object):
         flow.set_reverse_stats(duration, size, nb_pkt, first,
                                keep_emp=self.keep_emp, pkt_dist=pkt_dist,
                                arr_dist=arr_dist)
-        flow.last_frame = self.frame_index
-        flow.in_emp_arr = sum(arr_dist)
+        self.lifecycle.update(flow, self.frame_index)
+        flow.in_emp_arr = util.dist_sum(arr_dist)
         self.estimate_distribution(flow, pkt_dist, arr_dist,
                                    FlowHandler.NB_ITER, clt=False,
-                                   estpkt=reestimate_pkt, estarr=reestimate_arr)
+                                   estpkt=reestimate_pkt, estarr=reestimate_arr,
+                                   fitted=fitted)
 
     def reset_flows(self):
         for k, v in self.flows.items():
@@ -409,126 +452,73 @@ class FlowHandler(object):
             flow.reset()
 
     def reset_flows_for_dist(self):
-        for k, v in self.flows.items():
-            flow = self.flows[k]
-            flow.reset_flow()
+        # Same as flow.reset_flow() on every flow
+        self.flows.table.reset_frame(self.flows.rows())
 
     def redefine_flows(self):
         self.reset_flows_for_dist()
         #self.reset_flows()
         filename = self.get_stats_file()
+        # Distributions fitted in background while the previous frame was
+        # replayed, if any
+        prefetched = self.get_prefetched(filename)
+        if prefetched is None:
+            prefetched = self.fit_parallel(filename)
+        # Key of the first record of each flow in the frame
         order = OrderedDict()
-        with open(filename, "rb") as f:
-            filesize = os.path.getsize(filename)
-            self.index = 0
-            while self.index < filesize:
-                (srcip, dstip, sport, dport, proto, size, nb_pkt, first,
-                 duration, pkt_dist, arr_dist) = self.read_flow(f)
-
-                cur_flow = None
-                srv_flow, clt_flow = self.get_flow_key(srcip, dstip, sport,
-                                                       dport, proto, first)
-
-                if srv_flow.first is not None and clt_flow not in order:
-                    order[srv_flow] = srv_flow
-                elif clt_flow.first is not None and srv_flow not in order:
-                    order[clt_flow] = clt_flow
-                else:
-                    pass
-
-                flow_cat = self.category_dist[clt_flow.cat]
-
-                # Flow discovered in previous time frame
-                if (clt_flow in self.flows and
-                        self.flows[clt_flow].first_frame < self.frame_index):
-
-                    # Current unidirectional flow is the one in the dictionnary?
-                    if clt_flow.srcip == srcip:
-                        self.update_flow(clt_flow, duration, size,
-                                         nb_pkt, first, pkt_dist, arr_dist)
-                    else:
-                        self.update_reverse_stats(clt_flow, duration, size,
-                                                  nb_pkt, first, pkt_dist,
-                                                  arr_dist)
-
-                    flow = self.flows[clt_flow]
-
-                if (srv_flow in self.flows and
-                        self.flows[srv_flow].first_frame < self.frame_index):
-
-                    if srv_flow.srcip == srcip:
-                        self.update_flow(srv_flow, duration, size, nb_pkt,
-                                         first, pkt_dist, arr_dist)
-                    else:
-                        self.update_reverse_stats(srv_flow, duration, size,
-                                                  nb_pkt, first, pkt_dist,
-                                                  arr_dist)
-
-                    flow = self.flows[srv_flow]
-
-                # Flow discovered in current frame
-                # Totally new flow
-
-                if not (clt_flow in self.flows or srv_flow in self.flows):
-                    if clt_flow.first is not None:
-                        tmp_flow = clt_flow
-                    elif srv_flow.first is not None:
-                        tmp_flow = srv_flow
-                    else:
-                        raise ValueError("Invalid time for first appearance")
-
-                    client_flow = clt_flow.first is not None
-
-                    flow = Flow(tmp_flow, duration, size, nb_pkt,
-                                keep_emp=self.keep_emp, pkt_dist=pkt_dist,
-                                arr_dist=arr_dist,
-                                client_flow=client_flow,
-                                first_frame=self.frame_index,
-                                last_frame=self.frame_index)
-
-                    flow.emp_arr = sum(arr_dist)
-                    self.flows[tmp_flow] = flow
-                    self.estimate_distribution(flow, pkt_dist, arr_dist,
-                                               FlowHandler.NB_ITER)
-                    cur_flow = flow
-                # Flow in one direction has already been discovered
+        for i, (srcip, dstip, sport, dport, proto, size, nb_pkt, first,
+                duration, pkt_dist, arr_dist) in enumerate(self.read_frame(filename)):
+
+            fitted = prefetched[i] if prefetched is not None else None
+            canonical = canonical_key(srcip, dstip, sport, dport, proto)[0]
+            if canonical not in order:
+                order[canonical] = FlowKey(srcip, dstip, sport, dport, proto,
+                                           first, self.get_flow_cat(sport, dport))
+
+            flow, same = self.flows.find_record(srcip, dstip, sport, dport,
+                                                proto)
+
+            # Flow discovered in previous time frame
+            if flow is not None and flow.first_frame < self.frame_index:
+                # Current unidirectional flow is the one in the dictionnary?
+                if same:
+                    self.update_flow(flow, duration, size, nb_pkt, first,
+                                     pkt_dist, arr_dist, fitted)
                 else:
-                    if clt_flow in self.flows:
-                        if srcip != clt_flow.srcip:
-
-                            self.update_reverse_stats(clt_flow, duration, size,
-                                                      nb_pkt, first, pkt_dist,
-                                                      arr_dist)
-                            flow = self.flows[clt_flow]
-                            flow_cat.add_flow_client(flow.size, flow.nb_pkt, flow.dur)
-                            flow_cat.add_flow_server(size, nb_pkt, duration)
-
-                            flow.in_emp_arr = sum(arr_dist)
-                            cur_flow = flow
-                    elif srv_flow in self.flows:
-                        if srcip != srv_flow.srcip:
-                            self.update_reverse_stats(srv_flow, duration, size,
-                                                      nb_pkt, first, pkt_dist,
-                                                      arr_dist)
-                            flow = self.flows[srv_flow]
-                            flow_cat.add_flow_client(size, nb_pkt, duration)
-                            flow_cat.add_flow_server(flow.size, flow.nb_pkt,
-                                                     flow.dur)
-                            flow.in_emp_arr = sum(arr_dist)
-                            cur_flow = flow
-                if cur_flow:
-                    src_pipe, dst_pipe = self.create_flow_pipename(cur_flow)
-                    self.create_pipe(src_pipe, dst_pipe)
+                    self.update_reverse_stats(flow, duration, size, nb_pkt,
+                                              first, pkt_dist, arr_dist,
+                                              fitted)
+                continue
+
+            # Flow discovered in current frame
+            # Totally new flow
+            if flow is None:
+                flow = self.new_flow(srcip, dstip, sport, dport, proto, first,
+                                     duration, size, nb_pkt, pkt_dist,
+                                     arr_dist, first_frame=self.frame_index,
+                                     last_frame=self.frame_index)
+                self.lifecycle.add(flow)
+                self.estimate_distribution(flow, pkt_dist, arr_dist,
+                                           FlowHandler.NB_ITER, fitted=fitted)
+            # Flow in one direction has already been discovered
+            elif not same:
+                self.update_reverse_stats(flow, duration, size, nb_pkt, first,
+                                          pkt_dist, arr_dist, fitted)
+                self.add_reverse_to_cat(flow, size, nb_pkt, duration)
+                flow.in_emp_arr = util.dist_sum(arr_dist)
+            else:
+                continue
+
+            src_pipe, dst_pipe = self.create_flow_pipename(flow)
+            self.create_pipe(src_pipe, dst_pipe)
 
         self.clear_frame()
-        return order.keys()
+        self.update_cluster_state()
+        self.estimate_frame_clusters()
+        return order.values()
 
     def clear_frame(self):
-        print "Clearing frame"
-        for k, v in self.flows.items():
-            if v.last_frame < self.frame_index:
-                print "Removing flow {}".format(k)
-                del self.flows[k]
+        return self.lifecycle.expire(self.frame_index)
 
     def create_pipe(self, src_pipe, dst_pipe):
 
@@ -616,6 +606,27 @@ class FlowHandler(object):
 
         return distances
 
+    def compute_flows_distance_matrix(self, metric="ks", output_pck=None,
+                                      output_mat=None):
+        '''
+            metric is one of distances.METRICS. Return the keys of the flows
+            in both directions and their condensed distance matrix. If
+            output_mat is set, the matrix is computed by the worker
+            processes into this file and returned memory-mapped, an
+            interrupted computation is resumed.
+        '''
+        if output_mat is not None:
+            return flow_distances_on_disk(self.flows.values(), output_mat,
+                                          metric, self.estimator.workers)
+
+        keys, condensed = flow_distances(self.flows.values(), metric)
+
+        if output_pck is not None:
+            with open(output_pck, 'wb') as fh:
+                pickle.dump((keys, condensed), fh)
+
+        return keys, condensed
+
 
     def create_categorie(self, appli):
         for k in appli:
@@ -625,64 +636,38 @@ class FlowHandler(object):
         self.categories[0] = {}
         self.category_dist[0] = FlowCategory(0)
 
-    def  _next_port_in_cat(self, next_sport, next_dport, randport):
-
-        if next_sport in self.categories:
-            return next_sport
-
-        elif next_dport in self.categories:
-            return next_dport
-        else:
-            return randport
-
-    def _add_to_cat(self, cur_port, next_port, interflow):
-
-        if next_port in self.categories[cur_port]:
-            self.categories[cur_port][next_port][0] += 1
-            self.categories[cur_port][next_port][1].append(interflow)
-        else:
-            self.categories[cur_port][next_port] = (1, [interflow])
-
-
     def compute_flow_corr(self):
-        i = 0
+        '''
+            Probability of the category of the next flow given the category
+            of the current one, and mean time between them, computed on the
+            columns of the flows in their order.
+        '''
         randport = 0
-        flowseq = self.flows.keys()
-        while i < len(flowseq) - 1:
-            flow = self.flows[flowseq[i]]
-            next_flow = self.flows[flowseq[i+1]] 
-            cur_dport = flow.dport
-            cur_sport = flow.sport
-            next_dport = next_flow.dport
-            next_sport = next_flow.sport
-
-            interflow = (next_flow.first - flow.first).total_seconds() 
-
-            if next_dport not in self.categories:
-                next_dport = 0
-
-            if next_sport not in self.categories:
-                next_sport = 0
-
-            if cur_dport in self.categories:
-                port = self._next_port_in_cat(next_sport, next_dport, randport)
-                self._add_to_cat(cur_dport, port, interflow)
-
-            elif cur_sport in self.categories:
-                port = self._next_port_in_cat(next_sport, next_dport, randport)
-                self._add_to_cat(cur_sport, port, interflow)
-
-            else:
-                port = self._next_port_in_cat(next_sport, next_dport, randport)
-                self._add_to_cat(randport, port, interflow)
-
-            i += 1
+        rows = self.flows.rows()
+        if len(rows) < 2:
+            return
+        cats = np.array(sorted(self.categories))
+        sports = self.flows.column("sport", rows).astype(np.int64)
+        dports = self.flows.column("dport", rows).astype(np.int64)
+        interflow = np.diff(self.flows.column("first", rows))
+
+        cur = np.where(np.in1d(dports, cats), dports,
+                       np.where(np.in1d(sports, cats), sports, randport))[:-1]
+        # A port which is not a category is the random port 0
+        nxt = np.where(np.in1d(sports, cats), sports,
+                       np.where(np.in1d(dports, cats), dports, randport))[1:]
+
+        pairs, inverse = np.unique(cur * 65536 + nxt, return_inverse=True)
+        counts = np.bincount(inverse)
+        means = np.bincount(inverse, weights=interflow) / counts
+        for pair, count, mean in zip(pairs.tolist(), counts.tolist(),
+                                     means.tolist()):
+            self.categories[pair // 65536][pair % 65536] = (count, mean)
 
         for k in self.categories:
             total = sum([x[0] for x in self.categories[k].values()])
             for c in self.categories[k]:
-                val = self.categories[k][c][0]
-                interflow = np.mean(self.categories[k][c][1])
+                val, interflow = self.categories[k][c]
                 self.categories[k][c] = (val/float(total), interflow)
 
     def get_next_cat(self):
@@ -757,18 +742,26 @@ class FlowHandler(object):
         if self.mininet_mode:
             topo = GenTopo(sw_cli, sw_host, sw_capt, ht_capt)
             net = Mininet(topo)
-            net_handler = NetworkHandler(net, lock)
+            net_handler = NetworkHandler(net, lock, engine=self.engine)
 
             net_handler.run(self.output, self.subnet)
         else:
             if not self.local_interface_created():
                 subprocess.call(["ifconfig", "lo:40", "172.16.0.0", "netmask", "255.255.0.0"])
-            net_handler = LocalHandler()
+            if self.engine == "loop":
+                net_handler = ReplayEngine()
+            else:
+                net_handler = LocalHandler(self.engine)
             print "Starting capturing packet"
             sniffer = subprocess.Popen(["sudo", "tcpdump", "-i", "lo", "net", "172.16",
                                         "-w", "{}".format(self.output)])
         time.sleep(1)
 
+        if self.engine == "pool":
+            # Workers of the ends of the first frame are started before it
+            net_handler.pool.resize(2 * len(self.flows))
+            net_handler.pool.wait_warm(net_handler.pool.START_TIMEOUT)
+
         #cleaner = RepeatedTimer(10, net_handler.remove_done_host)
 
         i = 0
@@ -777,22 +770,32 @@ class FlowHandler(object):
 
         thread_writting = []
 
-        new_flow = 0
-
         for frame in xrange(len(self.dir_stats)):
             print "Starting frame number {}".format(frame)
             self.frame_index = frame
-            next_frame_flow = self.get_next_frame_flow()
+            self.read_ahead()
+            if self.engine == "pool":
+                # At most a client and a server end for each flow starting
+                # in the next frame, started during this one. The workers
+                # of this frame are kept until its flows are established
+                net_handler.pool.resize(
+                    2 * self.lifecycle.nb_starting(frame + 1), shrink=False)
             frame_starting = time.time()
             frame_ending = frame_starting + self.frame_size
             if frame != 0:
                 print "Redefining flow"
+                before_redefining = time.time()
                 flowseq = self.redefine_flows()
                 assert len(self.flows) == len(flowseq)
+                print "Flows redefined in {}s".format(time.time() - before_redefining)
+                print self.lifecycle
 
             else:
                 flowseq = self.flows.keys()
 
+            # Next frame is estimated during the idle time of this one
+            self.start_prefetch(frame + 1)
+
             if self.do_attack and frame == self.attack_frame:
                 self.create_attack(net=self.subnet, size=30, nbr=1024,
                                    inter=0.150)
@@ -807,35 +810,20 @@ class FlowHandler(object):
                     break
 
                 # The order of the flow (and the directio) can change from frame to frame
-                if fk in self.flows:
-                    flow = self.flows[fk]
-                else:
-                    flow = self.flows[fk.get_reverse()]
+                flow, _ = self.flows.find(fk)
                 before_waiting = time.time()
-                last = False
-
                 # Flow not in next frame
-                if frame == len(self.dir_stats) - 1:
-                    last = True
-                else:
-                    last = fk not in next_frame_flow
-
-                if flow.first_frame < self.frame_index:
-                    print "Continuing flow {}, last:{}".format(flow, last)
-                else:
-                    print "Trying to establish flow nbr:{}  {},last:{}".format((new_flow+1), flow, last)
-                    new_flow += 1
+                last = self.is_last(fk)
 
                 src_pipe, dst_pipe = self.create_flow_pipename(flow)
                 res = net_handler.establish_conn_client_server(flow, self.pipelock[src_pipe],
                                                                self.pipelock[dst_pipe],
                                                                last)
                 if res:
-                    t_client, t_server = res
                     suc_flow += 1
                     print "Flow successfully established"
-                    thread_writting.append(t_client)
-                    thread_writting.append(t_server)
+                    # No writing thread when the endpoints run in a daemon
+                    thread_writting.extend(t for t in res if t is not None)
                 else:
                     print "Failed to establish flow"
                 time_to_establish = time.time() - before_waiting
@@ -851,6 +839,13 @@ class FlowHandler(object):
                     print "Waiting for %s" % waiting_time
                     time.sleep(waiting_time)
 
+            if self.engine == "pool":
+                net_handler.pool.resize(
+                    2 * self.lifecycle.nb_starting(frame + 1))
+
+            if self.engine == "loop" and not self.mininet_mode:
+                print net_handler.frame_lags()
+
             print "Waiting next frame"
             cur = time.time()
             tmp = cur - frame_ending
@@ -862,6 +857,8 @@ class FlowHandler(object):
             time.sleep(waiting_time)
 
 
+        print self.frame_cache
+
         for thr in thread_writting:
             if thr.is_alive():
                 thr.join()
@@ -878,51 +875,54 @@ class FlowHandler(object):
             #sniffer.terminate()
             time.sleep(1.5)
         self.export_mapping_ip()
+        self.estimator.close()
+        print self.dist_store
+        if self.output_dist is not None:
+            self.dist_store.save(self.output_dist)
         #cleaner.stop()
 
 
+    def fit_pkt(self, pkt_dist):
+        return self.estimator.fit_pkt(pkt_dist)
+
+    def fit_arr(self, arr_dist, niter):
+        return self.estimator.fit_arr(arr_dist, niter)
+
+    def fit_frame(self, frame):
+        if self.estim_mode == "cluster":
+            # Only decoded, the distributions depend on the clusters
+            frame.flows()
+            return None
+        return self.estimator.fit(frame.flows())
+
     def estimate_distribution(self, flow, pkt_dist, arr_dist, niter, clt=True,
-                              estpkt=True, estarr=True):
+                              estpkt=True, estarr=True, fitted=None):
+        # fitted: distributions (pkt, arr) already estimated for this sample
+        # In cluster mode, the inter-arrivals are fitted per cluster once the
+        # frame is read
+        estarr = estarr and self.estim_mode != "cluster"
         try:
+            if fitted is not None:
+                gen_pkt, gen_arr = fitted
+            else:
+                gen_pkt = self.fit_pkt(pkt_dist) if estpkt else None
+                gen_arr = self.fit_arr(arr_dist, niter) if estarr else None
             if clt:
                 if estpkt:
-                    flow.estim_pkt = DiscreteGen(util.get_pmf(pkt_dist))
+                    flow.estim_pkt = gen_pkt
                 if estarr:
-                    if len(arr_dist) > FlowHandler.MIN_SAMPLE_SIZE:
-                        distribution, _ = self.compare_empirical_estim(arr_dist,
-                                                                          niter)
-                        flow.estim_arr = ContinuousGen(distribution)
-                    else:
-                        flow.estim_arr = DiscreteGen(util.get_pmf(arr_dist))
-
+                    flow.estim_arr = gen_arr
             else:
                 if estpkt:
-                    flow.in_estim_pkt = DiscreteGen(util.get_pmf(pkt_dist))
+                    flow.in_estim_pkt = gen_pkt
                 if estarr:
-                    if len(arr_dist) > FlowHandler.MIN_SAMPLE_SIZE:
-                        distribution, _ = self.compare_empirical_estim(arr_dist,
-                                                                          niter)
-                        flow.in_estim_arr = ContinuousGen(distribution)
-                    else:
-                        flow.in_estim_arr = DiscreteGen(util.get_pmf(arr_dist))
+                    flow.in_estim_arr = gen_arr
         except TypeError:
             print flow
             pdb.set_trace()
 
     def compare_empirical_estim(self, data, niter):
-
-        try:
-            nb_sample = len(data)
-
-            # List of the distribution represented as a tuple RV and weight
-            # [[(gamma,1)], [(beta, 1)], ...]
-            data_reshape = np.array(data).reshape(-1, 1)
-            kernel_d = KernelDensity(bandwidth=0.1, kernel='gaussian')
-            kernel_d.fit(data_reshape)
-            return  [(kernel_d, 1)], "sci-kde"
-
-        except ValueError:
-            print data
+        return estimator.kde_estim(data, niter)
 
     def apply_dist_from_name(self, name, data):
 
@@ -953,57 +953,112 @@ class FlowHandler(object):
             kde = gaussian_kde(data)
             return [(kde, 1)]
 
-        elif name == "sci-kde":
-            kde = KernelDensity(data)
-            return [(kde, 1)]
+        elif name in estimator.SAMPLERS:
+            dist, _ = estimator.kde_estim(data, FlowHandler.NB_ITER, name)
+            return dist
 
         else:
             raise ValueError("The {} is not a valid distribution".format(name))
 
     def _estimate_cluster(self, data_arr, data_pkt, name):
         resname = name
-        if len(data_arr) > FlowHandler.MIN_SAMPLE_SIZE:
-            if resname == "":
-                dist, resname = self.compare_empirical_estim(data_arr,
-                                                             FlowHandler.NB_ITER)
-            else:
-                dist = self.apply_dist_from_name(name, data_arr)
-            gen_arr = ContinuousGen(dist)
+        if len(data_arr) > FlowHandler.MIN_SAMPLE_SIZE and resname != "":
+            gen_arr = self.dist_store.fetch(
+                "arr-" + name, data_arr,
+                lambda data: ContinuousGen(self.apply_dist_from_name(name, data)))
         else:
-            gen_arr = DiscreteGen(util.get_pmf(data_arr))
+            gen_arr = self.fit_arr(data_arr, FlowHandler.NB_ITER)
+            if len(data_arr) > FlowHandler.MIN_SAMPLE_SIZE:
+                resname = estimator.SAMPLER
 
-        gen_pkt = DiscreteGen(util.get_pmf(data_pkt))
+        gen_pkt = self.fit_pkt(data_pkt)
 
         return resname, gen_arr, gen_pkt
 
-    def estimate_cluster(self, clusters):
+    def update_cluster_state(self):
+        if self.cluster_state is not None:
+            keys, samples = flow_samples(self.flows.values())
+            self.cluster_state.sync(keys, samples)
+
+    def cluster_flows(self, n=None, dist=None, metric="ks", approximate=False):
+        '''
+            Single linkage clustering of the flows (both directions). In
+            approximate mode, only the flows whose quantile sketches collide
+            are compared (see sketch.py). With incrementalClustering, the
+            clusters maintained across frames are returned, they are all the
+            groups of flows closer than dist whatever n.
+        '''
+        n = FlowHandler.NB_CLUSTER if n is None else n
+        dist = FlowHandler.MIN_DIST if dist is None else dist
+        state = self.cluster_state
+        if (state is not None and not approximate and state.dist == dist and
+                state.metric == metric):
+            return state.clusters()
+        if approximate:
+            keys, samples = flow_samples(self.flows.values())
+            return to_clusters(keys, approximate_clustering(samples, n, dist,
+                                                            metric))
+        keys, condensed = self.compute_flows_distance_matrix(metric)
+        return clustering_matrix(keys, condensed, n, dist)
+
+    def cluster_member(self, flowkey):
+        # Flow of a key of a cluster and whether the key is its client side
+        flow, clt = self.flows.find(flowkey)
+        if flow is None:
+            raise ValueError("The flow {} is does not exist".format(flowkey))
+        return flow, clt
+
+    def estimate_cluster(self, clusters=None, approximate=False, pooled=False):
+        '''
+            Estimate the flows of each cluster with the same distribution
+            family. If pooled, a single inter-arrival generator is fitted
+            per cluster on the samples of all its flows.
+        '''
+        if clusters is None:
+            clusters = self.cluster_flows(approximate=approximate)
 
         for c in clusters:
+            if pooled:
+                self._estimate_cluster_pooled(c)
+                continue
             name = ""
-            for i, flowkey in enumerate(c.flows):
-                if flowkey in self.flows:
-                    flow = self.flows[flowkey]
-
-                elif flowkey.get_reverse() in self.flows:
-                    flow = self.flows[flowkey.get_reverse()]
-                else:
-                    raise ValueError("The flow {} is does not exist".format(flowkey))
+            for flowkey in c.flows:
+                flow, clt = self.cluster_member(flowkey)
 
-                if flowkey == flow.key:
+                if clt:
                     name, gen_arr, gen_pkt = self._estimate_cluster(flow.arr_dist,
                                                                     flow.pkt_dist,
                                                                     name)
                     flow.estim_arr = gen_arr
                     flow.estim_pkt = gen_pkt
-
-                elif flowkey == flow.key.get_reverse():
+                else:
                     name, gen_arr, gen_pkt = self._estimate_cluster(flow.in_arr_dist,
                                                                     flow.in_pkt_dist,
                                                                     name)
                     flow.in_estim_arr = gen_arr
                     flow.in_estim_pkt = gen_pkt
-                else:
-                    continue
+
+    def _estimate_cluster_pooled(self, cluster):
+        members = [self.cluster_member(flowkey) for flowkey in cluster.flows]
+        samples = [flow.arr_dist if clt else flow.in_arr_dist
+                   for flow, clt in members]
+        for (flow, clt), gen_arr in zip(members,
+                                        self.estimator.fit_cluster(samples)):
+            if clt:
+                flow.estim_arr = gen_arr
+            else:
+                flow.in_estim_arr = gen_arr
+
+    def estimate_frame_clusters(self):
+        # In cluster mode, the inter-arrival distributions of the frame are
+        # fitted once all its flows are known
+        if self.estim_mode != "cluster":
+            return
+        start = time.time()
+        clusters = self.cluster_flows()
+        self.estimate_cluster(clusters, pooled=True)
+        print "{} clusters estimated in {}s".format(len(clusters),
+                                                   time.time() - start)
 
 
 def test_flow_redefinition(config):
@@ -1033,7 +1088,7 @@ def test_flow_redefinition(config):
     for frame in xrange(len(handler.dir_stats)):
         print "Starting frame number {}".format(frame)
         handler.frame_index = frame
-        next_frame_flow = handler.get_next_frame_flow()
+        handler.read_ahead()
         frame_starting = time.time()
         frame_ending = frame_starting + handler.frame_size
         if frame != 0:
@@ -1046,18 +1101,10 @@ def test_flow_redefinition(config):
 
         for i, fk in enumerate(flowseq):
             # The order of the flow (and the directio) can change from frame to frame
-            if fk in handler.flows:
-                flow = handler.flows[fk]
-            else:
-                flow = handler.flows[fk.get_reverse()]
+            flow, _ = handler.flows.find(fk)
             before_waiting = time.time()
-            last = False
-
             # Flow not in next frame
-            if frame == len(handler.dir_stats) - 1:
-                last = True
-            else:
-                last = fk not in next_frame_flow
+            last = handler.is_last(fk)
 
             if flow.first_frame < handler.frame_index:
                 print "Continuing flow {}, last:{}".format(flow, last)
@@ -1098,7 +1145,7 @@ def test_flow_time_slice(config):
         for frame in xrange(len(handler.dir_stats)):
             print "Starting frame number {}".format(frame)
             handler.frame_index = frame
-            flow_next_frame = handler.get_next_frame_flow()
+            handler.read_ahead()
             if frame != 0:
                 handler.redefine_flows()
 
@@ -1107,10 +1154,7 @@ def test_flow_time_slice(config):
             for _, fk in enumerate(flowseq):
                 flow = handler.flows[fk]
 
-                if frame == len(handler.dir_stats) - 1:
-                    last = True
-                else:
-                    last = fk not in flow_next_frame
+                last = handler.is_last(fk)
                 if flow.first_frame < handler.frame_index:
                     print "Cont: {}, last:{}, src:{}, dst:{}".format(flow, last,
                                                                      flow.nb_pkt,
@@ -1131,7 +1175,7 @@ def test_attack(config):
         for frame in xrange(len(handler.dir_stats)):
             print "Starting frame number {}".format(frame)
             handler.frame_index = frame
-            flow_next_frame = handler.get_next_frame_flow()
+            handler.read_ahead()
             if frame != 0:
                 handler.redefine_flows()
 
@@ -1150,10 +1194,7 @@ def test_attack(config):
             for _, fk in enumerate(flowseq):
                 flow = handler.flows[fk]
                 
-                if frame == len(handler.dir_stats) - 1:
-                    last = True
-                else:
-                    last = fk not in flow_next_frame
+                last = handler.is_last(fk)
                 if flow.first_frame < handler.frame_index:
                     print "Cont: {}, last:{}, src:{}, dst:{}".format(flow, last,
                                                                      flow.nb_pkt,
@@ -1167,10 +1208,12 @@ def test_attack(config):
         pass
 
 def main(config, numflow=None, mode="mininet", read="bin", saveflow=None, loadflow=None,
-         savedist=None, loaddist=None):
+         savedist=None, loaddist=None, workers=None, arr_mode=None,
+         estim_mode=None, engine="process"):
     try:
         FlowHandler.clean_tmp()
-        handler = FlowHandler(config, mode, read, saveflow, loadflow, savedist, loaddist)
+        handler = FlowHandler(config, mode, read, saveflow, loadflow, savedist, loaddist,
+                              workers, arr_mode, estim_mode, engine)
         handler.run(numflow)
     finally:
         sh('pkill -f "python -u server.py"')
@@ -1181,7 +1224,8 @@ def main(config, numflow=None, mode="mininet", read="bin", saveflow=None, loadfl
 if __name__ == "__main__":
     main(args.config, args.numflow, args.mode, args.read,
          args.saveflow, args.loadflow, args.savedist,
-         args.loaddist)
+         args.loaddist, args.workers, args.arrmode, args.estimmode,
+         args.engine)
     #test_flow_time_slice(args.config)
     #test_attack(args.config)
     #test_flow_redefinition(args.config)
@@ -0,0 +1,120 @@
+"""
+    Flows indexed by a direction independent key: the endpoint pair, sorted,
+    and the protocol. A record or a FlowKey of either direction of a flow is
+    found with a single lookup, which also tells if it is in the direction
+    of the flow key.
+"""
+
+from collections import OrderedDict
+
+from flows import FlowTable
+
+
+def canonical_key(srcip, dstip, sport, dport, proto):
+    """
+        Return the canonical key of the endpoints and whether (srcip, sport)
+        is its first endpoint.
+    """
+    if srcip < dstip or (srcip == dstip and sport <= dport):
+        return (srcip, sport, dstip, dport, proto), True
+    return (dstip, dport, srcip, sport, proto), False
+
+
+def key_of(flowkey):
+    return canonical_key(flowkey.srcip, flowkey.dstip, flowkey.sport,
+                         flowkey.dport, flowkey.proto)
+
+
+class FlowIndex(object):
+
+    """
+        Ordered mapping of the flows of a frame. As a dictionary, it is keyed
+        by the FlowKey of each flow (in its direction), find() and
+        find_record() look up either direction. The statistics of the flows
+        are the rows of table, see rows().
+    """
+
+    def __init__(self, flows=()):
+        # canonical key -> (flow, direction of flow.key)
+        self.entries = OrderedDict()
+        self.table = FlowTable()
+        for flow in flows:
+            self.add(flow)
+
+    def add(self, flow):
+        canonical, forward = key_of(flow.key)
+        old = self.entries.get(canonical)
+        flow.attach(self.table)
+        self.table.indexed[flow.row] = True
+        if old is not None and old[0] is not flow:
+            # Same position as the replaced flow
+            self.table.seq[flow.row] = self.table.seq[old[0].row]
+            old[0].detach()
+        self.entries[canonical] = (flow, forward)
+
+    def find_record(self, srcip, dstip, sport, dport, proto):
+        """
+            Return the flow of these endpoints and whether they are in the
+            direction of its key, (None, None) if it is unknown.
+        """
+        canonical, forward = canonical_key(srcip, dstip, sport, dport, proto)
+        entry = self.entries.get(canonical)
+        if entry is None:
+            return None, None
+        return entry[0], entry[1] == forward
+
+    def find(self, flowkey):
+        return self.find_record(flowkey.srcip, flowkey.dstip, flowkey.sport,
+                                flowkey.dport, flowkey.proto)
+
+    def __contains__(self, flowkey):
+        flow, same = self.find(flowkey)
+        return flow is not None and same
+
+    def __getitem__(self, flowkey):
+        flow, same = self.find(flowkey)
+        if flow is None or not same:
+            raise KeyError(flowkey)
+        return flow
+
+    def __setitem__(self, flowkey, flow):
+        assert flowkey == flow.key
+        self.add(flow)
+
+    def __delitem__(self, flowkey):
+        flow, same = self.find(flowkey)
+        if flow is None or not same:
+            raise KeyError(flowkey)
+        del self.entries[key_of(flowkey)[0]]
+        flow.detach()
+
+    def rows(self):
+        # Rows of the flows in the table, in the order of the index
+        return self.table.indexed_rows()
+
+    def column(self, name, rows=None):
+        rows = self.rows() if rows is None else rows
+        return self.table.columns[name][rows]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for flow, _ in self.entries.itervalues():
+            yield flow.key
+
+    def keys(self):
+        return [flow.key for flow, _ in self.entries.itervalues()]
+
+    def values(self):
+        return [flow for flow, _ in self.entries.itervalues()]
+
+    def items(self):
+        return [(flow.key, flow) for flow, _ in self.entries.itervalues()]
+
+    def __getstate__(self):
+        return {'flows': self.values()}
+
+    def __setstate__(self, s):
+        self.__init__(s['flows'])
+
@@ -0,0 +1,79 @@
+"""
+    Lifetime of the flows of a FlowIndex across the frames. The flows are
+    bucketed by the last frame they appeared in, so the flows expiring at a
+    frame are found without walking the others. The next frame in which
+    each flow appears is read ahead from the index of the next frame.
+"""
+
+from flowIndex import canonical_key, key_of
+
+
+class FlowLifecycle(object):
+
+    def __init__(self, flows):
+        self.flows = flows
+        # last frame -> keys of the flows last seen in this frame
+        self.buckets = {}
+        # canonical key -> next frame read ahead in which the flow appears
+        self.next_frame = {}
+        # Flows of the first frame are counted as created
+        self.created = len(flows)
+        self.continued = 0
+        self.expired = 0
+        rows = flows.rows()
+        for key, frame in zip(flows.table.keys[rows],
+                              flows.column("last_frame", rows).tolist()):
+            self.buckets.setdefault(int(frame), set()).add(key)
+
+    def add(self, flow):
+        # Flow appearing for the first time, at its last_frame
+        self.flows.add(flow)
+        self.buckets.setdefault(flow.last_frame, set()).add(flow.key)
+        self.created += 1
+
+    def update(self, flow, frame):
+        # Flow of a previous frame appearing in frame
+        old = flow.last_frame
+        if old == frame:
+            return
+        self.buckets[old].discard(flow.key)
+        self.buckets.setdefault(frame, set()).add(flow.key)
+        flow.last_frame = frame
+        self.continued += 1
+
+    def expire(self, frame):
+        """
+            Remove the flows which did not appear since before frame, return
+            their keys.
+        """
+        expired = []
+        for old in [f for f in self.buckets if f < frame]:
+            for key in self.buckets.pop(old):
+                del self.flows[key]
+                canonical = key_of(key)[0]
+                if self.next_frame.get(canonical, frame) < frame:
+                    del self.next_frame[canonical]
+                expired.append(key)
+        self.expired += len(expired)
+        return expired
+
+    def read_ahead(self, frame, records):
+        # records are the (srcip, dstip, sport, dport, proto) of frame
+        for record in records:
+            self.next_frame[canonical_key(*record)[0]] = frame
+
+    def nb_starting(self, frame):
+        # Flows read ahead for frame which are not indexed yet
+        return sum(1 for canonical, nxt in self.next_frame.iteritems()
+                   if nxt == frame and canonical not in self.flows.entries)
+
+    def is_last(self, flowkey, frame):
+        # Flow not appearing in the frame following frame
+        return self.next_frame.get(key_of(flowkey)[0]) != frame + 1
+
+    def __len__(self):
+        return len(self.flows)
+
+    def __str__(self):
+        return "Flows: {} created, {} continued, {} expired".format(
+            self.created, self.continued, self.expired)
@@ -7,6 +7,7 @@ from datetime import timedelta
 from itertools import izip_longest
 from collections import OrderedDict
 from ipaddress import IPv4Address, ip_address, ip_network
+from frameReader import decode_frame
 
 
 class FlowStatReader(object):
@@ -80,6 +81,14 @@ class FlowStatReader(object):
         return (srcip, mod_src, dstip, mod_dst, sport, dport, proto, size,
                 nb_pkt, first, duration, pkt_dist, arr_dist)
 
+    def read_frame_binary(self, filename, addr_iter, flowdict):
+        for (src, dst, sport, dport, proto, size, nb_pkt, first, duration,
+             pkt_dist, arr_dist) in decode_frame(filename):
+            srcip, mod_src = self.change_ip(IPv4Address(src), addr_iter, flowdict)
+            dstip, mod_dst = self.change_ip(IPv4Address(dst), addr_iter, flowdict)
+            yield (srcip, mod_src, dstip, mod_dst, sport, dport, proto, size,
+                   nb_pkt, first, duration, pkt_dist, arr_dist)
+
     def readline_text(self):
         line = self.current_file.readline()
         self.line_index += 1
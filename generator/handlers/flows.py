@@ -1,8 +1,14 @@
 #!/usr/bin/python
+import socket
+import struct
 from abc import ABCMeta, abstractmethod
+from itertools import izip
+from ipaddress import ip_address
 import numpy as np
 import scipy.stats as stats
 from sklearn.neighbors import KernelDensity
+from datetime import timedelta
+from util import dist_sum, epoch
 
 def is_lower_than(a, b):
     if a < b:
@@ -12,6 +18,12 @@ def is_lower_than(a, b):
 
 vfunc = np.vectorize(is_lower_than)
 
+ADDR_STRUCT = struct.Struct('>I')
+
+def has_sample(dist):
+    # dist can be a list or a numpy array
+    return dist is not None and len(dist) > 0
+
 class Distribution(object):
 
     __metaclass__ = ABCMeta 
@@ -20,6 +32,10 @@ class Distribution(object):
     def generate(self, nsample):
         pass
 
+    def generate_batch(self, ntrial, nsample):
+        # One independent draw of nsample values per row
+        return np.array([self.generate(nsample) for _ in xrange(ntrial)])
+
     def __getstate__(self):
         return self.__dict__
 
@@ -29,14 +45,110 @@ class Distribution(object):
 
 class DiscreteGen(Distribution):
 
-    #Distribution is represented as a dictionnary of frequency (Counter)
+    #Distribution is given as a dictionnary of frequency (Counter) and is
+    #sampled with Walker's alias method
 
     def __init__(self, distribution):
-        self.distribution = distribution
+        self.set_alias(np.array(distribution.keys()),
+                       np.array(distribution.values(), dtype=np.float64))
+
+    def set_alias(self, values, probs):
+        k = len(values)
+        scaled = probs * (k / probs.sum()) if k > 0 else probs
+        prob = np.ones(k, dtype=np.float64)
+        alias = np.arange(k, dtype=np.int32)
+        small = [i for i in xrange(k) if scaled[i] < 1.0]
+        large = [i for i in xrange(k) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Remaining columns are full, up to rounding errors
+        self.values = values
+        self.prob = prob
+        self.alias = alias
 
     def generate(self, nsample):
-        val = self.distribution.keys()
-        return np.random.choice(val, nsample, p=self.distribution.values())
+        col = np.random.randint(0, len(self.values), nsample)
+        coin = np.random.random_sample(nsample)
+        return self.values[np.where(coin < self.prob[col], col, self.alias[col])]
+
+    def generate_batch(self, ntrial, nsample):
+        return self.generate(ntrial * nsample).reshape((ntrial, nsample))
+
+    def __getstate__(self):
+        return {'values': self.values, 'prob': self.prob, 'alias': self.alias}
+
+    def __setstate__(self, s):
+        if 'alias' in s:
+            self.__dict__.update(s)
+        else:
+            # Generator pickled with its Counter
+            self.__init__(s['distribution'])
+
+
+class QuantileGen(Distribution):
+
+    #Distribution represented by a table of its quantiles, sampled by
+    #inverse transform. The table is the one of the gaussian KDE of the
+    #sample. In jitter mode, it is the table of the sample and a gaussian
+    #noise of the kernel bandwidth is added: if the whole sample fits in
+    #the table, this is exactly sampling from the KDE.
+
+    TABLE_SIZE = 256
+    # Quantiles of the kernel added to each point of the sample
+    KERNEL_POINTS = 32
+
+    def __init__(self, data, bandwidth, jitter=False, size=None):
+        size = size or QuantileGen.TABLE_SIZE
+        data = np.sort(np.asarray(data, dtype=np.float64).ravel())
+        self.exact = jitter and len(data) <= size
+        if self.exact:
+            quantiles = data
+        else:
+            if not jitter:
+                data = QuantileGen.smooth(data, bandwidth, size)
+            quantiles = np.percentile(data, np.linspace(0, 100, size))
+        self.quantiles = quantiles.astype(np.float32)
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+
+    @staticmethod
+    def smooth(data, bandwidth, size):
+        # The sample convolved with the kernel: each point (or quantile of
+        # the sample if it is larger than the table) is shifted by equally
+        # probable quantiles of the gaussian
+        if len(data) > size:
+            data = np.percentile(data, np.linspace(0, 100, size))
+        nb = QuantileGen.KERNEL_POINTS
+        kernel = bandwidth * stats.norm.ppf((np.arange(nb) + 0.5) / nb)
+        return (data[:, np.newaxis] + kernel).ravel()
+
+    def generate(self, nsample):
+        last = len(self.quantiles) - 1
+        if self.jitter and self.exact:
+            sample = self.quantiles[np.random.randint(0, last + 1,
+                                                      nsample)].astype(np.float64)
+        else:
+            # Quantiles are equally spaced in probability, the interpolation
+            # does not need a search
+            pos = np.random.random_sample(nsample) * last
+            index = np.minimum(pos.astype(np.intp), max(last - 1, 0))
+            low = self.quantiles[index]
+            high = self.quantiles[np.minimum(index + 1, last)]
+            sample = low + (pos - index) * (high - low)
+        if self.jitter:
+            sample += self.bandwidth * np.random.standard_normal(nsample)
+        return sample
+
+    def generate_batch(self, ntrial, nsample):
+        return self.generate(ntrial * nsample).reshape((ntrial, nsample))
 
 
 class ContinuousGen(Distribution):
@@ -48,12 +160,25 @@ class ContinuousGen(Distribution):
     def __init__(self, distribution):
         self.distribution = distribution
 
+    def generate_batch(self, ntrial, nsample):
+        # A single distribution can be drawn at once, a mixture keeps the
+        # layout of generate() in each row
+        if len(self.distribution) == 1 and self.distribution[0][1] == 1:
+            d = self.distribution[0][0]
+            if isinstance(d, QuantileGen):
+                return d.generate_batch(ntrial, nsample)
+            elif isinstance(d, KernelDensity):
+                return d.sample(ntrial * nsample).reshape((ntrial, nsample))
+        return Distribution.generate_batch(self, ntrial, nsample)
+
     def generate(self, nsample):
         sample = []
         for rv in self.distribution:
             d, w = rv
             gensize = int(nsample * w)
-            if isinstance(d, stats.gaussian_kde):
+            if isinstance(d, QuantileGen):
+                gendata = d.generate(gensize)
+            elif isinstance(d, stats.gaussian_kde):
                 gendata = d.resample(size=gensize).reshape((gensize,))
             elif isinstance(d, KernelDensity):
                 gendata = d.sample(gensize).reshape((gensize,))
@@ -68,7 +193,9 @@ class ContinuousGen(Distribution):
             r = 0
             for k in xrange(diff):
                 d, w = self.distribution[r]
-                if isinstance(d, stats.gaussian_kde):
+                if isinstance(d, QuantileGen):
+                    gendata = d.generate(1)
+                elif isinstance(d, stats.gaussian_kde):
                     gendata = d.resample(size=1).reshape((1,))
                 elif isinstance(d, KernelDensity):
                     gendata = d.sample(gensize).reshape((gensize,))
@@ -79,19 +206,68 @@ class ContinuousGen(Distribution):
                     gendata))
         return sample
 
+class ScaledGen(ContinuousGen):
+
+    #Generator shared by a cluster of flows, fitted on their samples divided
+    #by their mean. Each flow scales it back with its own mean
+
+    def __init__(self, gen, scale):
+        self.gen = gen
+        self.scale = scale
+
+    def generate(self, nsample):
+        return np.asarray(self.gen.generate(nsample), dtype=np.float64) * self.scale
+
+    def generate_batch(self, ntrial, nsample):
+        return np.asarray(self.gen.generate_batch(ntrial, nsample),
+                          dtype=np.float64) * self.scale
+
+class IntAddress(int):
+
+    #IPv4 address stored as an integer (hashed and compared as one), printed
+    #in dotted notation
+
+    __slots__ = ()
+
+    def __str__(self):
+        return socket.inet_ntoa(ADDR_STRUCT.pack(self))
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __format__(self, spec):
+        return format(self.__str__(), spec)
+
+    def __reduce__(self):
+        return (IntAddress, (int(self),))
+
+
+def to_address(addr):
+    # addr can be an integer, an IPv4Address or a string
+    if addr is None or isinstance(addr, IntAddress):
+        return addr
+    if isinstance(addr, basestring):
+        addr = ip_address(unicode(addr))
+    return IntAddress(int(addr))
+
+
 class FlowKey(object):
 
+    KEY_SLOTS = ("srcip", "dstip", "sport", "dport", "proto", "first", "cat")
+
+    __slots__ = KEY_SLOTS + ("_hash",)
 
     def __init__(self, srcip=None, dstip=None, sport=None,
                  dport=None, proto=None, first=None, cat=None):
 
-        self.srcip = srcip
-        self.dstip = dstip
+        self.srcip = to_address(srcip)
+        self.dstip = to_address(dstip)
         self.sport = sport
         self.dport = dport
         self.proto = proto
         self.first = first
         self.cat = cat
+        self._hash = hash((self.srcip, self.dstip, sport, dport, proto))
 
     def  __lt__(self, other):
         return self.first < other.first
@@ -107,13 +283,15 @@ class FlowKey(object):
         return self.__str__()
 
     def __eq__(self, other):
-        return (self.srcip == other.srcip and self.dstip == other.dstip and
-                self.sport == other.sport and self.dport == self.dport and
-                self.proto == other.proto)
+        return (self._hash == other._hash and self.srcip == other.srcip and
+                self.dstip == other.dstip and self.sport == other.sport and
+                self.dport == other.dport and self.proto == other.proto)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
     def __hash__(self):
-        return hash((self.srcip, self.dstip, self.sport, self.dport,
-                     self.proto))
+        return self._hash
 
     def reverse(self, other):
         return (self.srcip == other.dstip and self.dstip == other.srcip and
@@ -127,29 +305,238 @@ class FlowKey(object):
         return FlowKey(self.dstip, self.srcip, self.dport, self.sport,
                        self.proto) 
     def __getstate__(self):
-        return  self.__dict__
+        return {attr: getattr(self, attr) for attr in FlowKey.KEY_SLOTS}
 
     def __setstate__(self, s):
-        self.__dict__.update(s)
+        # Keys pickled before __slots__ hold IPv4Address objects
+        self.__init__(*[s.get(attr) for attr in FlowKey.KEY_SLOTS])
+
+class FlowTable(object):
+
+    """
+        Columns of the statistics of a set of flows, each Flow is a view on
+        a row. The statistics which can be None are stored as float64 with
+        NaN for None, times as seconds since util.epoch.
+    """
+
+    KEY_COLUMNS = [("srcip", np.uint32), ("dstip", np.uint32),
+                   ("sport", np.uint16), ("dport", np.uint16),
+                   ("proto", np.uint8)]
+    # Statistics of the flows and how they are converted by Column
+    STAT_COLUMNS = [("dur", "float"), ("size", "int"), ("nb_pkt", "int"),
+                    ("first", "time"), ("emp_arr", "float"),
+                    ("in_dur", "float"), ("in_size", "int"),
+                    ("in_nb_pkt", "int"), ("in_first", "time"),
+                    ("in_emp_arr", "float"), ("first_frame", "frame"),
+                    ("last_frame", "frame")]
+    # Statistics of a frame, see Flow.reset_flow
+    FRAME_COLUMNS = ["dur", "size", "nb_pkt", "first", "emp_arr", "in_dur",
+                     "in_size", "in_nb_pkt", "in_first", "in_emp_arr"]
+
+    def __init__(self, capacity=1024):
+        self.columns = {}
+        for name, dtype in FlowTable.KEY_COLUMNS:
+            self.columns[name] = np.zeros(capacity, dtype=dtype)
+        for name, kind in FlowTable.STAT_COLUMNS:
+            dtype = np.int32 if kind == "frame" else np.float64
+            self.columns[name] = np.zeros(capacity, dtype=dtype)
+        self.keys = np.empty(capacity, dtype=object)
+        # Rows of the flows of a FlowIndex and their insertion order
+        self.indexed = np.zeros(capacity, dtype=bool)
+        self.seq = np.zeros(capacity, dtype=np.int64)
+        self.used = np.zeros(capacity, dtype=bool)
+        self.free = range(capacity - 1, -1, -1)
+        self.next_seq = 0
+
+    def __len__(self):
+        return int(self.used.sum())
+
+    def _grow(self):
+        capacity = len(self.used)
+        for name, column in self.columns.items():
+            self.columns[name] = np.concatenate((column, np.zeros_like(column)))
+        self.keys = np.concatenate((self.keys, np.empty(capacity, dtype=object)))
+        self.indexed = np.concatenate((self.indexed, np.zeros_like(self.indexed)))
+        self.seq = np.concatenate((self.seq, np.zeros_like(self.seq)))
+        self.used = np.concatenate((self.used, np.zeros_like(self.used)))
+        self.free.extend(xrange(2*capacity - 1, capacity - 1, -1))
+
+    @staticmethod
+    def empty_stats():
+        # Statistics of a new row, as a list in the order of STAT_COLUMNS
+        return [0 if kind == "frame" else np.nan
+                for _, kind in FlowTable.STAT_COLUMNS]
+
+    def alloc(self, flowkey=None, values=None):
+        # values: statistics of the row, see empty_stats
+        if not self.free:
+            self._grow()
+        row = self.free.pop()
+        self.used[row] = True
+        self.seq[row] = self.next_seq
+        self.next_seq += 1
+        self.keys[row] = flowkey
+        for name, _ in FlowTable.KEY_COLUMNS:
+            self.columns[name][row] = getattr(flowkey, name, None) or 0
+        self.set_stats(row, values if values is not None
+                       else FlowTable.empty_stats())
+        return row
+
+    def release(self, row):
+        self.used[row] = False
+        self.indexed[row] = False
+        self.keys[row] = None
+        self.free.append(row)
+
+    def copy_row(self, table, row, dest):
+        for name, column in self.columns.items():
+            column[dest] = table.columns[name][row]
+
+    def get_stats(self, row):
+        return [self.columns[name][row].item()
+                for name, _ in FlowTable.STAT_COLUMNS]
+
+    def set_stats(self, row, values):
+        columns = self.columns
+        for (name, _), value in izip(FlowTable.STAT_COLUMNS, values):
+            columns[name][row] = value
+
+    def indexed_rows(self):
+        rows = np.flatnonzero(self.indexed)
+        return rows[np.argsort(self.seq[rows], kind='mergesort')]
+
+    def reset_frame(self, rows):
+        for name in FlowTable.FRAME_COLUMNS:
+            self.columns[name][rows] = 0
+        for name in ("first", "emp_arr", "in_first", "in_emp_arr"):
+            self.columns[name][rows] = np.nan
+
+
+def stat_value(kind, value):
+    # Value of a statistic as stored in its column
+    if kind == "frame":
+        return int(value)
+    if value is None:
+        return np.nan
+    if kind == "time" and not isinstance(value, (int, long, float)):
+        return (value - epoch).total_seconds()
+    return float(value)
+
+
+class Column(object):
+
+    #Attribute of a Flow stored in the row of its FlowTable, or in the list
+    #of statistics of a flow without table
+
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        self.index = [n for n, _ in FlowTable.STAT_COLUMNS].index(name)
+
+    def __get__(self, flow, cls):
+        if flow is None:
+            return self
+        if flow.table is None:
+            value = flow.row[self.index]
+        else:
+            value = flow.table.columns[self.name][flow.row]
+        if self.kind == "frame":
+            return int(value)
+        if value != value:
+            return None
+        if self.kind == "int":
+            return int(value)
+        if self.kind == "time":
+            return epoch + timedelta(seconds=float(value))
+        return float(value)
+
+    def __set__(self, flow, value):
+        value = stat_value(self.kind, value)
+        if flow.table is not None:
+            flow.table.columns[self.name][flow.row] = value
+        else:
+            flow.row[self.index] = value
+
+
 
 class Flow(object):
 
-    key_attr = ["srcip", "dstip", "sport", "dport", "proto", "first", "cat"]
+    # Attributes of the key copied in the flow, first is then updated with
+    # the stats of each frame
+    key_attr = list(FlowKey.KEY_SLOTS)
+    # Those held by the object
+    obj_key_attr = [attr for attr in key_attr if attr != "first"]
+
+    __slots__ = ("srcip", "dstip", "sport", "dport", "proto", "cat", "key",
+                 "pkt_dist", "arr_dist", "in_pkt_dist", "in_arr_dist",
+                 "estim_pkt", "estim_arr", "in_estim_pkt", "in_estim_arr",
+                 "is_client_flow", "table", "row")
+
+    # Attributes held by the object, the statistics are in its table (row is
+    # its index) or, without table, in a list (row is the list)
+    obj_attr = ["key", "pkt_dist", "arr_dist", "in_pkt_dist", "in_arr_dist",
+                "estim_pkt", "estim_arr", "in_estim_pkt", "in_estim_arr",
+                "is_client_flow"]
+    # Attributes saved when pickled
+    state_attr = obj_attr + [name for name, _ in FlowTable.STAT_COLUMNS]
+
+    dur = Column("dur", "float")
+    size = Column("size", "int")
+    nb_pkt = Column("nb_pkt", "int")
+    first = Column("first", "time")
+    emp_arr = Column("emp_arr", "float")
+    in_dur = Column("in_dur", "float")
+    in_size = Column("in_size", "int")
+    in_nb_pkt = Column("in_nb_pkt", "int")
+    in_first = Column("in_first", "time")
+    in_emp_arr = Column("in_emp_arr", "float")
+    first_frame = Column("first_frame", "frame")
+    last_frame = Column("last_frame", "frame")
+    # Statistics given to __init__
+    INIT_COLUMNS = (dur, size, nb_pkt, emp_arr, in_first, first_frame,
+                    last_frame, first)
+    # Statistics of a new flow, in the order of FlowTable.STAT_COLUMNS
+    NEW_STATS = [0.0 if name in ("in_dur", "in_size", "in_nb_pkt") else value
+                 for (name, _), value in zip(FlowTable.STAT_COLUMNS,
+                                             FlowTable.empty_stats())]
 
     NB_TRIALS = 15
+    # Draw the trials as a (TRIAL_BLOCK, n) matrix instead of one by one,
+    # ARR_TOLERANCE is checked after each block
+    BATCH_TRIALS = True
+    TRIAL_BLOCK = 5
+    # Stop drawing trials once the total inter-arrival time is this close
+    # (relative difference) to the empirical one
+    ARR_TOLERANCE = 0
+    # trials: best of NB_TRIALS draws
+    # rescale: one draw scaled so that its total is the empirical one
+    ARR_MODES = ["trials", "rescale"]
+    ARR_MODE = "trials"
 
     def __init__(self, flowkey=None,duration=None, size=None,
                  nb_pkt=None, keep_emp=False, pkt_dist=None, arr_dist=None,
-                 in_first=None, client_flow=True, first_frame=0, last_frame=0):
+                 in_first=None, client_flow=True, first_frame=0, last_frame=0,
+                 table=None):
+
+        # fixed value, first is the one of the key, the other direction is
+        # set by its records
+        emp_arr = dist_sum(arr_dist) if has_sample(arr_dist) else None
+        values = list(Flow.NEW_STATS)
+        for column, value in izip(Flow.INIT_COLUMNS,
+                                  (duration, size, nb_pkt, emp_arr, in_first,
+                                   first_frame, last_frame,
+                                   getattr(flowkey, "first", None))):
+            if value is not None:
+                values[column.index] = stat_value(column.kind, value)
+        self.table = table
+        if table is not None:
+            self.row = table.alloc(flowkey, values)
+        else:
+            self.row = values
 
         self.key = flowkey
-
-        # fixed value
-        self.dur = duration
-        self.size = size
-        self.nb_pkt = nb_pkt
-
-        self.emp_arr = sum(arr_dist) if arr_dist else None
+        for attr in Flow.obj_key_attr:
+            setattr(self, attr, getattr(flowkey, attr, None))
 
         # empirical distribution
         # ipt are in millisecond
@@ -161,13 +548,8 @@ class Flow(object):
             self.arr_dist = None
 
         # value of the flow in other direction
-        self.in_dur = 0
-        self.in_size = 0
-        self.in_nb_pkt = 0
         self.in_pkt_dist = None
         self.in_arr_dist = None
-        self.in_first = in_first
-        self.in_emp_arr = None 
 
         #Estimated distribution
         self.estim_pkt = None
@@ -177,8 +559,6 @@ class Flow(object):
         self.in_estim_arr = None
 
         self.is_client_flow = client_flow
-        self.first_frame = first_frame
-        self.last_frame = last_frame
 
     def reset(self):
         # resetting value when moving to other slice
@@ -218,19 +598,43 @@ class Flow(object):
         self.in_emp_arr = None
 
 
-    def __getattr__(self, attr):
-        if attr in Flow.key_attr:
-            return getattr(self.key, attr)
-        elif attr in self.__dict__:
-            return self.__dict__[attr]
+    def attach(self, table):
+        # Move the statistics of the flow to a row of table
+        if table is self.table:
+            return
+        if self.table is None:
+            row = table.alloc(self.key, self.row)
         else:
-            raise AttributeError("Object has no attribute %s" % attr)
+            row = table.alloc(self.key)
+            table.copy_row(self.table, self.row, row)
+            self.table.release(self.row)
+        self.table = table
+        self.row = row
+
+    def detach(self):
+        # Release the row of the flow removed from its FlowIndex, the flow
+        # keeps its statistics in a list
+        if self.table is None:
+            return
+        values = self.table.get_stats(self.row)
+        self.table.release(self.row)
+        self.table = None
+        self.row = values
 
     def __getstate__(self):
-        return self.__dict__
+        return {attr: getattr(self, attr) for attr in Flow.state_attr}
 
     def __setstate__(self, s):
-        self.__dict__.update(s)
+        self.table = None
+        self.row = FlowTable.empty_stats()
+        for attr in Flow.obj_attr:
+            setattr(self, attr, None)
+        for attr in Flow.key_attr:
+            setattr(self, attr, getattr(s['key'], attr))
+        # Flows pickled before __slots__ only have first once it was set
+        for attr, value in s.items():
+            if attr in Flow.state_attr:
+                setattr(self, attr, value)
 
     """
         string representation
@@ -250,7 +654,7 @@ class Flow(object):
         self.size = size
         self.nb_pkt = nb_pkt
         self.first = first
-        self.emp_arr = sum(arr_dist) if arr_dist else None
+        self.emp_arr = dist_sum(arr_dist) if has_sample(arr_dist) else None
         if keep_emp:
             self.pkt_dist = pkt_dist
             self.arr_dist = arr_dist
@@ -266,7 +670,7 @@ class Flow(object):
         self.in_size = size
         self.in_nb_pkt = nb_pkt
         self.in_first = in_first
-        self.in_emp_arr = sum(arr_dist) if arr_dist else None
+        self.in_emp_arr = dist_sum(arr_dist) if has_sample(arr_dist) else None
         if keep_emp:
             self.in_pkt_dist = pkt_dist
             self.in_arr_dist = arr_dist
@@ -300,42 +704,77 @@ class Flow(object):
             return self.in_estim_pkt.generate(n)
         return []
 
-    def generate_client_arrs(self, n):
-        if self.estim_arr is None or self.emp_arr is None:
-            return []
-
+    @staticmethod
+    def _generate_trials(estim_arr, emp_arr, n):
         min_ratio = None
         min_gen_data = []
         for _ in xrange(Flow.NB_TRIALS):
-            if isinstance(self.estim_arr, ContinuousGen):
-                gen_data = vfunc(self.estim_arr.generate(n), 0)
+            if isinstance(estim_arr, ContinuousGen):
+                gen_data = vfunc(estim_arr.generate(n), 0)
             else:
-                gen_data = self.estim_arr.generate(n)
-            error_ratio = (sum(gen_data)/float(self.emp_arr))
+                gen_data = estim_arr.generate(n)
+            error_ratio = (sum(gen_data)/float(emp_arr))
             diff_ratio = abs(1 - error_ratio)
             if min_ratio is None or diff_ratio < min_ratio:
                 min_ratio = diff_ratio
                 min_gen_data = gen_data
+            if min_ratio <= Flow.ARR_TOLERANCE:
+                break
         return np.array(min_gen_data)
 
-    def generate_server_arrs(self, n):
-        if self.in_estim_arr is None or self.in_emp_arr is None:
-            return []
-
+    @staticmethod
+    def _generate_batch_trials(estim_arr, emp_arr, n):
         min_ratio = None
         min_gen_data = []
-        for _ in xrange(Flow.NB_TRIALS):
-            if isinstance(self.in_estim_arr, ContinuousGen):
-                gen_data = vfunc(self.in_estim_arr.generate(n), 0)
-            else:
-                gen_data = self.in_estim_arr.generate(n)
-            error_ratio = (sum(gen_data)/float(self.in_emp_arr))
-            diff_ratio = abs(1 - error_ratio)
-            if min_ratio is None or diff_ratio < min_ratio:
-                min_ratio = diff_ratio
-                min_gen_data = gen_data
+        remaining = Flow.NB_TRIALS
+        while remaining > 0:
+            ntrial = min(Flow.TRIAL_BLOCK, remaining)
+            remaining -= ntrial
+            gen_data = estim_arr.generate_batch(ntrial, n)
+            if isinstance(estim_arr, ContinuousGen):
+                gen_data = np.maximum(gen_data, 0)
+            diff_ratio = np.abs(1 - gen_data.sum(axis=1)/float(emp_arr))
+            best = np.argmin(diff_ratio)
+            if min_ratio is None or diff_ratio[best] < min_ratio:
+                min_ratio = diff_ratio[best]
+                min_gen_data = gen_data[best]
+            if min_ratio <= Flow.ARR_TOLERANCE:
+                break
         return np.array(min_gen_data)
 
+    @staticmethod
+    def _generate_rescaled(estim_arr, emp_arr, n):
+        gen_data = np.asarray(estim_arr.generate(n), dtype=np.float64)
+        if isinstance(estim_arr, ContinuousGen):
+            gen_data = np.maximum(gen_data, 0)
+        total = gen_data.sum()
+        if n == 0:
+            return gen_data
+        if total <= 0:
+            return np.full(n, emp_arr/float(n))
+        # Multiplying keeps the order and the relative shape of the sample
+        return gen_data * (emp_arr/total)
+
+    @staticmethod
+    def generate_arrs(estim_arr, emp_arr, n):
+        if Flow.ARR_MODE == "rescale":
+            return Flow._generate_rescaled(estim_arr, emp_arr, n)
+        # Keep the trial whose total inter-arrival time is the closest to
+        # the empirical one
+        if Flow.BATCH_TRIALS:
+            return Flow._generate_batch_trials(estim_arr, emp_arr, n)
+        return Flow._generate_trials(estim_arr, emp_arr, n)
+
+    def generate_client_arrs(self, n):
+        if self.estim_arr is None or self.emp_arr is None:
+            return []
+        return Flow.generate_arrs(self.estim_arr, self.emp_arr, n)
+
+    def generate_server_arrs(self, n):
+        if self.in_estim_arr is None or self.in_emp_arr is None:
+            return []
+        return Flow.generate_arrs(self.in_estim_arr, self.in_emp_arr, n)
+
     @staticmethod
     def remove_empty_pkt(psizes, iptimes):
         cum_wait = 0
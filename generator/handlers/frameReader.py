@@ -0,0 +1,231 @@
+import os
+import struct
+import tempfile
+from collections import OrderedDict
+from threading import RLock
+from datetime import datetime
+from datetime import timedelta
+import numpy as np
+
+# Layout of a flow record written by the flowextractor (see
+# extractor/flows.c): addresses are in network order, everything else
+# is written in host order.
+#
+#   srcip, dstip (>I) | sport, dport (H) | proto (B) + 3 padding bytes
+#   size, nb_pkt, first_sec, first_micro (Q) | duration (f)
+#   len(pkt_dist) (Q) | pkt_dist (H) * len
+#   len(arr_dist) (Q) | arr_dist (f) * len
+
+ADDR_STRUCT = struct.Struct('>II')
+STATS_STRUCT = struct.Struct('=HHB3xQQQQfQ')
+LIST_STRUCT = struct.Struct('=Q')
+
+PKT_TYPE = np.dtype('=u2')
+ARR_TYPE = np.dtype('=f4')
+
+# Offset index of a frame file, stored next to it
+INDEX_SUFFIX = ".idx"
+INDEX_TYPE = np.dtype([('offset', '<u8'), ('srcip', '<u4'), ('dstip', '<u4'),
+                       ('sport', '<u2'), ('dport', '<u2'), ('proto', 'u1'),
+                       ('nb_pkt_dist', '<u8'), ('nb_arr_dist', '<u8')])
+
+
+def _array_view(buf, dtype, count, offset):
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+
+
+def decode_flow(buf, offset):
+    """
+        Decode the flow record starting at offset in buf. Return the offset
+        of the next record and the flow statistics. The distributions are
+        read-only views on buf.
+    """
+    srcip, dstip = ADDR_STRUCT.unpack_from(buf, offset)
+    offset += ADDR_STRUCT.size
+
+    (sport, dport, proto, size, nb_pkt, first_sec, first_micro, duration,
+     nb_pkt_dist) = STATS_STRUCT.unpack_from(buf, offset)
+    offset += STATS_STRUCT.size
+
+    pkt_dist = _array_view(buf, PKT_TYPE, nb_pkt_dist, offset)
+    offset += nb_pkt_dist * PKT_TYPE.itemsize
+
+    nb_arr_dist = LIST_STRUCT.unpack_from(buf, offset)[0]
+    offset += LIST_STRUCT.size
+
+    arr_dist = _array_view(buf, ARR_TYPE, nb_arr_dist, offset)
+    offset += nb_arr_dist * ARR_TYPE.itemsize
+
+    timestamp = datetime.fromtimestamp(first_sec)
+    first = timestamp + timedelta(microseconds=first_micro)
+
+    return offset, (srcip, dstip, sport, dport, proto, size, nb_pkt, first,
+                    duration/float(1000), pkt_dist, arr_dist)
+
+
+def decode_frame(filename):
+    """
+        Read a whole frame file in one buffer and decode all its flows.
+        Addresses are returned as integer.
+    """
+    with open(filename, "rb") as f:
+        buf = f.read()
+
+    flows = []
+    offset = 0
+    while offset < len(buf):
+        offset, flow = decode_flow(buf, offset)
+        flows.append(flow)
+    return flows
+
+
+def is_index_file(filename):
+    return filename.endswith(INDEX_SUFFIX)
+
+
+def build_index(buf):
+    """
+        Walk the flow headers of a frame buffer without decoding the
+        distributions.
+    """
+    entries = []
+    offset = 0
+    while offset < len(buf):
+        start = offset
+        srcip, dstip = ADDR_STRUCT.unpack_from(buf, offset)
+        offset += ADDR_STRUCT.size
+        stats = STATS_STRUCT.unpack_from(buf, offset)
+        sport, dport, proto, nb_pkt_dist = stats[0], stats[1], stats[2], stats[-1]
+        offset += STATS_STRUCT.size + nb_pkt_dist * PKT_TYPE.itemsize
+        nb_arr_dist = LIST_STRUCT.unpack_from(buf, offset)[0]
+        offset += LIST_STRUCT.size + nb_arr_dist * ARR_TYPE.itemsize
+        entries.append((start, srcip, dstip, sport, dport, proto, nb_pkt_dist,
+                        nb_arr_dist))
+    return np.array(entries, dtype=INDEX_TYPE)
+
+
+class MappedFrame(object):
+
+    """
+        Memory-mapped frame file. The offset index of the flows is built once
+        and cached next to the file so the keys or the distributions of one
+        flow can be fetched without reading the rest of the file.
+    """
+
+    def __init__(self, filename, cache_index=True):
+        self.filename = filename
+        self.index_name = filename + INDEX_SUFFIX
+        if os.path.getsize(filename) > 0:
+            self.buf = np.memmap(filename, dtype=np.uint8, mode='r')
+        else:
+            self.buf = np.empty(0, dtype=np.uint8)
+
+        self.index = self._load_index()
+        if self.index is None:
+            self.index = build_index(self.buf)
+            if cache_index:
+                self._save_index()
+        # 5-tuple -> position in the index, built on first lookup
+        self.positions = None
+        # decoded flows, see flows()
+        self.decoded = None
+
+    def _load_index(self):
+        try:
+            if os.path.getmtime(self.index_name) < os.path.getmtime(self.filename):
+                return None
+            with open(self.index_name, 'rb') as fh:
+                index = np.load(fh)
+            if index.dtype != INDEX_TYPE:
+                return None
+            return index
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save_index(self):
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        try:
+            fd, tmpname = tempfile.mkstemp(suffix=INDEX_SUFFIX, dir=dirname)
+            with os.fdopen(fd, 'wb') as fh:
+                np.save(fh, self.index)
+            os.rename(tmpname, self.index_name)
+        except (IOError, OSError):
+            # Read-only dataset, the index stays in memory
+            pass
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for i in xrange(len(self.index)):
+            yield self.flow(i)
+
+    def keys(self):
+        return zip(self.index['srcip'].tolist(), self.index['dstip'].tolist(),
+                   self.index['sport'].tolist(), self.index['dport'].tolist(),
+                   self.index['proto'].tolist())
+
+    def position(self, srcip, dstip, sport, dport, proto):
+        if self.positions is None:
+            self.positions = {k: i for i, k in enumerate(self.keys())}
+        return self.positions.get((srcip, dstip, sport, dport, proto))
+
+    def arrays(self, i):
+        entry = self.index[i]
+        offset = int(entry['offset']) + ADDR_STRUCT.size + STATS_STRUCT.size
+        nb_pkt_dist = int(entry['nb_pkt_dist'])
+        pkt_dist = _array_view(self.buf, PKT_TYPE, nb_pkt_dist, offset)
+        offset += nb_pkt_dist * PKT_TYPE.itemsize + LIST_STRUCT.size
+        arr_dist = _array_view(self.buf, ARR_TYPE, int(entry['nb_arr_dist']),
+                               offset)
+        return pkt_dist, arr_dist
+
+    def flow(self, i):
+        _, flow = decode_flow(self.buf, int(self.index[i]['offset']))
+        return flow
+
+    def flows(self):
+        # The frame is decoded only once, later calls reuse the records
+        decoded = self.decoded
+        if decoded is None:
+            decoded = [self.flow(i) for i in xrange(len(self.index))]
+            self.decoded = decoded
+        return decoded
+
+
+class FrameCache(object):
+
+    """
+        LRU cache of the frames of a run. The look-ahead on the next frame and
+        the redefinition of the flows share the same MappedFrame so each frame
+        file is indexed and decoded once.
+    """
+
+    def __init__(self, size=3):
+        self.size = size
+        self.frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # The next frame can be prefetched from another thread
+        self.lock = RLock()
+
+    def get(self, filename):
+        with self.lock:
+            if filename in self.frames:
+                self.hits += 1
+                frame = self.frames.pop(filename)
+            else:
+                self.misses += 1
+                frame = MappedFrame(filename)
+                if len(self.frames) >= self.size:
+                    self.frames.popitem(last=False)
+            self.frames[filename] = frame
+            return frame
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __str__(self):
+        return "Frame cache: {} hits, {} misses".format(self.hits, self.misses)
@@ -14,14 +14,15 @@ import re
 import cPickle as pickle
 import zlib
 from subprocess import Popen, call, PIPE
-from subprocess import check_output, CalledProcessError
 from flowDAO import FlowRequestPipeWriter
 from flows import FlowLazyGen
 from util import RepeatedTimer
 from util import datetime_to_ms, write_message
 from util import timeout_decorator
-from util import MaxAttemptException
 from util import TimedoutException
+from util import wait_ready, EstablishmentStats
+from endpointPool import EndpointPool
+from replayEngine import flow_schedules
 from mininet.topo import Topo
 from mininet.net import Mininet
 from mininet.clean import cleanup
@@ -50,17 +51,37 @@ setLogLevel("info")
 
 class LocalHandler(object):
 
-    def __init__(self):
+    def __init__(self, engine="process"):
         self.processes = {}
+        # (ip, port) -> server process
+        self.servers = {}
+        self.stats = EstablishmentStats()
+        # Warm workers running the ends instead of a process per end
+        self.pool = EndpointPool() if engine == "pool" else None
 
     def _is_service_running(self, ip, port):
-        logger.debug("Checking if port %s open on host %s", port, ip)
-        res = check_output(["netstat", "-tulpn"])
-        return ":".join([ip, port]) in res
+        # Bookkeeping of the servers started, instead of a netstat run
+        self.stats.checks_replaced += 1
+        proc = self.servers.get((ip, port))
+        return proc is not None and proc.poll() is None
+
+    def wait_endpoint(self, proc, ip, port):
+        # Readiness byte of the endpoint, instead of netstat or lsof polling
+        self.stats.checks_replaced += 1
+        try:
+            if wait_ready(proc.stdout.fileno()):
+                return True
+            logger.debug("Endpoint %s:%s failed to start", ip, port)
+        except TimedoutException as err:
+            logger.debug("Endpoint %s:%s: %s", ip, port, err.msg)
+        return False
 
-    @timeout_decorator()
-    def wait_process_creation(self, ip, port):
-        return self._is_service_running(ip, port)
+    def wait_started(self, proc, ip, port):
+        # A server or client process signals once, its pipe is then closed
+        # to keep a single descriptor per endpoint for the whole run
+        ready = self.wait_endpoint(proc, ip, port)
+        proc.stdout.close()
+        return ready
 
     def _is_client_running(self, ip, port):
         key = (ip, port)
@@ -70,21 +91,6 @@ class LocalHandler(object):
             return poll is None
         return False
 
-    def _is_client_created(self, pid, is_tcp, ip, port):
-        logger.debug("Checking if client port has been bound")
-        if is_tcp:
-            res = check_output(["lsof", "-p", "{}".format(pid)])
-            return "TCP" in res
-        else:
-            res = check_output(["netstat", "-tulpn"])
-            logger.debug(res)
-            return ":".join([ip, port]) in res
-
-    @timeout_decorator()
-    def wait_client_creation(self, pid, is_tcp, ip, port):
-        return self._is_client_created(pid, is_tcp, ip, port)
-
-
     def get_process_pipename(self, ip, port, proto):
         tmpdir = tempfile.gettempdir()
         filename = os.path.join(tmpdir, "{}_{}:{}.flow".format(ip, port, proto))
@@ -108,10 +114,35 @@ class LocalHandler(object):
                 pass
 
     def wait_termination(self):
-        for proc in self.processes.keys():
+        if self.pool is not None:
+            self.pool.close()
+            print self.pool
+        for proc in self.processes.values():
             proc.wait()
+        print self.stats
 
     def establish_conn_client_server(self, flow, src_lock, dst_lock, last=False):
+        start = time.time()
+        if self.pool is not None:
+            res = self._establish_pooled(flow, last)
+        else:
+            res = self._establish(flow, src_lock, dst_lock, last)
+        self.stats.add(time.time() - start, res is not None)
+        return res
+
+    def _establish_pooled(self, flow, last):
+        # No pipe writing thread, the schedules are sent with the ends
+        client, server, client_gen, server_gen = flow_schedules(flow, last)
+        for role, local, peer, gen in (("server", server, client, server_gen),
+                                       ("client", client, server, client_gen)):
+            command = (role, flow.proto, local, peer, gen)
+            if self.pool.open(local + (flow.proto,), None, command) is None:
+                return
+            self.stats.checks_replaced += 1
+        logger.info("Flow %s established", flow)
+        return None, None
+
+    def _establish(self, flow, src_lock, dst_lock, last):
         proto = "tcp" if flow.proto == 6 else "udp"
 
         server_ps = flow.generate_server_pkts(flow.in_nb_pkt)
@@ -164,15 +195,10 @@ class LocalHandler(object):
         if not self._is_service_running(dstip, dport):
             server_proc = Popen(["python", "-u", "server.py", "--addr",
                                  dstip, "--port", dport, "--proto",
-                                 proto, "--pipe", "pipe", "--pipename",
-                                 server_pipe])
-            try:
-                self.wait_process_creation(dstip, dport)
-            except MaxAttemptException as err:
-                logger.debug(err.msg)
-                return
-            except TimedoutException as err:
-                logger.debug(err.msg)
+                                 proto, "--ready", "--pipe", "pipe",
+                                 "--pipename", server_pipe], stdout=PIPE)
+            self.servers[(dstip, dport)] = server_proc
+            if not self.wait_started(server_proc, dstip, dport):
                 return
         else:
             logger.debug("Port %s is already open on host %s", dport, dstip)
@@ -190,16 +216,9 @@ class LocalHandler(object):
             client_proc = Popen(["python", "-u", "client.py", "--saddr",
                                  srcip, "--daddr", dstip, "--sport",
                                  sport, "--dport", dport,
-                                 "--proto", proto, "--pipe", "pipe",
-                                 "--pipename", client_pipe])
-            try:
-                self.wait_client_creation(client_proc.pid, (proto == "tcp"),
-                                          srcip, sport)
-            except MaxAttemptException as err:
-                logger.debug(err.msg)
-                return
-            except TimedoutException as err:
-                logger.debug(err.msg)
+                                 "--proto", proto, "--ready", "--pipe", "pipe",
+                                 "--pipename", client_pipe], stdout=PIPE)
+            if not self.wait_started(client_proc, srcip, sport):
                 return
             # It all ends when clients have done
             self.processes[(srcip, sport)] = client_proc
@@ -303,6 +322,11 @@ class NetworkHandler(object):
         # process_client
         self.processes = {} 
 
+        # (ip, port) -> server process (or endpoint daemon)
+        self.servers = {}
+
+        self.stats = EstablishmentStats()
+
         # capturing process (initialized with run)
         self.capt_popen = None
 
@@ -315,6 +339,15 @@ class NetworkHandler(object):
         self.cli_sw_group_id = 1
         self.srv_sw_group_id = 1
 
+        # endpoint daemon of each host, when the endpoints of a host are run
+        # by a single process (engine "loop")
+        engine = opts.get("engine")
+        self.daemons = {} if engine in ("loop", "pool") else None
+
+        # warm workers entering the namespace of the host of their end,
+        # instead of a daemon per host (engine "pool")
+        self.pool = EndpointPool() if engine == "pool" else None
+
     def _int_to_mac(self):
         return ':'.join(['{}{}'.format(a, b)
                          for a, b
@@ -359,18 +392,29 @@ class NetworkHandler(object):
         return self.cli_sw if is_client else self.srv_sw
 
     def _is_service_running(self, ip, port):
-        host = self._get_host_from_ip(ip)
-        cmd = "netstat -tulpn | grep :%s" % port
-        res = host.cmd(cmd)
-        return (res != None and
-                ("LISTEN" in res or
-                 "ESTABLISHED" in res or
-                 "CONNECTED" in res or
-                 "udp" in res))
+        # Bookkeeping of the servers started, instead of a netstat run on
+        # the host
+        self.stats.checks_replaced += 1
+        proc = self.servers.get((ip, port))
+        return proc is not None and proc.poll() is None
+
+    def wait_endpoint(self, proc, ip, port):
+        # Readiness byte of the endpoint, instead of netstat or lsof polling
+        self.stats.checks_replaced += 1
+        try:
+            if wait_ready(proc.stdout.fileno()):
+                return True
+            logger.debug("Endpoint %s:%s failed to start", ip, port)
+        except TimedoutException as err:
+            logger.debug("Endpoint %s:%s: %s", ip, port, err.msg)
+        return False
 
-    @timeout_decorator()
-    def wait_process_creation(self, ip, port):
-        return self._is_service_running(ip, port)
+    def wait_started(self, proc, ip, port):
+        # A server or client process signals once, its pipe is then closed
+        # to keep a single descriptor per endpoint for the whole run
+        ready = self.wait_endpoint(proc, ip, port)
+        proc.stdout.close()
+        return ready
 
     def _is_client_running(self, ip, port):
         key = (ip, port)
@@ -548,37 +592,40 @@ class NetworkHandler(object):
         filename = os.path.join(tmpdir, "{}_{}:{}.flow".format(ip, port, proto))
         return filename
 
+    def get_endpoint_daemon(self, name):
+        daemon = self.daemons.get(name)
+        if daemon is None or daemon.poll() is not None:
+            host = self.net.get(name)
+            logger.debug("Starting endpoint daemon of host %s", name)
+            daemon = host.popen(["python", "-u", "endpointd.py", "--name",
+                                 name], stdin=PIPE, stdout=PIPE)
+            self.daemons[name] = daemon
+        return daemon
+
+    def send_to_daemon(self, name, role, proto, local, peer, message):
+        """
+            Send the end to the daemon of the host, or to a worker of the
+            pool, return its process once it acknowledged that the end is
+            ready, None if it is not.
+        """
+        command = (role, proto, local, peer, message)
+        if self.pool is not None:
+            self.stats.checks_replaced += 1
+            return self.pool.open(local + (proto,), self.net.get(name).pid,
+                                  command)
+        daemon = self.get_endpoint_daemon(name)
+        data = zlib.compress(pickle.dumps(command))
+        logger.debug("Sending %s %s:%s to endpoint daemon of host %s", role,
+                     local[0], local[1], name)
+        write_message(daemon.stdin.fileno(), data)
+        if self.wait_endpoint(daemon, *local):
+            return daemon
+
     def get_ofport(self, name):
         intf = self.mapping_host_intf[name]
         sw_name, port = intf.split("-eth")
         return port
 
-    def _is_client_created(self, pid, is_tcp, ip, port):
-        logger.debug("Checking if client port has been bound")
-        if is_tcp:
-            try:
-                res = check_output(["lsof", "-p", "{}".format(pid)])
-                return "TCP" in res
-            except CalledProcessError as e:
-                raise RuntimeError("Cmd '{}' return with error (code {}):{}".format(e.cmd,
-                                                                                   e.returncode,
-                                                                                   e.output))
-                                   
-                                                  
-        else:
-            try:
-                res = check_output(["netstat", "-tulpn"])
-                logger.debug(res)
-                return ":".join([ip, port]) in res
-            except CalledProcessError as e:
-                raise RuntimeError("Cmd '{}' return with error (code{}):{}".format(e.cmd,
-                                                                                   e.returncode,
-                                                                                   e.output))
-
-    @timeout_decorator()
-    def wait_client_creation(self, pid, is_tcp, ip, port):
-        return self._is_client_created(pid, is_tcp, ip, port)
-
     @timeout_decorator()
     def is_pipe_created(self, pipename):
         return os.path.exists(pipename)
@@ -595,8 +642,20 @@ class NetworkHandler(object):
         lock.release()
 
     def wait_termination(self):
-        for proc in self.processes.values():
-            proc.wait()
+        if self.pool is not None:
+            self.pool.close()
+            print self.pool
+        elif self.daemons is not None:
+            # Closing the control channel stops the daemon once its ends are
+            # done
+            for name, daemon in self.daemons.items():
+                out, _ = daemon.communicate()
+                logger.info("Endpoint daemon of host %s: %s", name, out.strip())
+        else:
+            for proc in self.processes.values():
+                proc.wait()
+        print self.stats
+        logger.info("%s", self.stats)
 
     def setup_target(self, ip):
 
@@ -728,6 +787,12 @@ class NetworkHandler(object):
             return running
 
     def establish_conn_client_server(self, flow, src_lock, dst_lock, last=False):
+        start = time.time()
+        res = self._establish(flow, src_lock, dst_lock, last)
+        self.stats.add(time.time() - start, res is not None)
+        return res
+
+    def _establish(self, flow, src_lock, dst_lock, last):
         #self.lock.acquire()
 
         logger.info("Trying to establish flow: %s", flow)
@@ -786,8 +851,6 @@ class NetworkHandler(object):
         srv_diff_role = False
         cli_diff_role = False
 
-        client_pid = None
-
         if dstip in self.mapping_ip_host:
             srv = self.mapping_ip_host[dstip]
 
@@ -799,12 +862,22 @@ class NetworkHandler(object):
         added = self.add_host(srv, dstip)
         server = self.net.get(srv)
         server_pipe = self.get_process_pipename(dstip, dport, flow.proto)
-        if not os.path.exists(server_pipe):
+        if self.daemons is None and not os.path.exists(server_pipe):
             logger.debug("Server pipe %s does not exist", server_pipe)
             #self.lock.release()
             return
 
-        if not self._is_service_running(dstip, dport):
+        t_server = None
+        server_running = self._is_service_running(dstip, dport)
+        if self.daemons is not None:
+            daemon = self.send_to_daemon(srv, "server", flow.proto,
+                                         (dstip, dport), (srcip, sport),
+                                         flowstat_server)
+            if daemon is None:
+                return
+            self.servers[(dstip, dport)] = daemon
+
+        if not server_running:
             if added:
                 port_srv = self.get_ofport(srv)
                 server_switch = self._get_switch(False)
@@ -820,34 +893,33 @@ class NetworkHandler(object):
                            dstip, gid))
             server.setHostRoute(srcip, "-".join([srv, "eth0"]))
 
-            cmd = ("python -u server.py --addr %s --port %s --proto %s --pipe pipe --pipename %s"
-                   % (dstip, dport, proto, server_pipe))
+            cmd = ("python -u server.py --addr %s --port %s --proto %s --ready --pipe pipe "
+                   "--pipename %s" % (dstip, dport, proto, server_pipe))
 
-            logger.debug("Running command: %s", cmd)
-            server_popen = server.popen(["python", "-u", "server.py", "--addr",
-                                         dstip, "--port", str(dport), "--proto",
-                                         proto, "--pipe", "pipe", "--pipename", server_pipe])
             if dstip not in self.mapping_server_client:
                 self.mapping_server_client[dstip] = []
 
             if dstip not in self.mapping_involved_connection:
                 self.mapping_involved_connection[dstip] = 0
 
-            try:
-                self.wait_process_creation(dstip, dport)
-            except MaxAttemptException as err:
-                logger.debug(err.msg)
-                #self.lock.release()
-            except TimedoutException as err:
-                logger.debug(err.msg)
-                #self.lock.release()
+            if self.daemons is None:
+                logger.debug("Running command: %s", cmd)
+                server_popen = server.popen(["python", "-u", "server.py", "--addr",
+                                             dstip, "--port", str(dport), "--proto",
+                                             proto, "--ready", "--pipe", "pipe",
+                                             "--pipename", server_pipe], stdout=PIPE)
+                self.servers[(dstip, dport)] = server_popen
+                if not self.wait_started(server_popen, dstip, dport):
+                    #self.lock.release()
+                    return
         else:
             logger.debug("Port %s is already open on host %s", dport, dstip)
-        server_lock.add_thread(str(flow))
-        t_server = threading.Thread(target=self.write_flow_to_pipe,
-                                    args=(str(flow), server_pipe, flowstat_server,
-                                          server_lock))
-        t_server.start()
+        if self.daemons is None:
+            server_lock.add_thread(str(flow))
+            t_server = threading.Thread(target=self.write_flow_to_pipe,
+                                        args=(str(flow), server_pipe, flowstat_server,
+                                              server_lock))
+            t_server.start()
 
         # Creating client
         if srcip in self.mapping_ip_host:
@@ -861,7 +933,7 @@ class NetworkHandler(object):
         added = self.add_host(cli, dstip, srcip)
         client = self.net.get(cli)
         client_pipe = self.get_process_pipename(srcip, sport, flow.proto)
-        if not os.path.exists(client_pipe):
+        if self.daemons is None and not os.path.exists(client_pipe):
             logger.debug("Client pipe %s does not exist", client_pipe)
             #self.lock.release()
             return
@@ -894,33 +966,37 @@ class NetworkHandler(object):
 
             cmd = ("python -u client.py --saddr %s --daddr %s --sport %s --dport %s" %
                    (srcip, dstip, sport, dport) +
-                   "--proto %s --pipe pipe --pipename %s &" % (proto, client_pipe))
-            logger.debug("Running command: %s", cmd)
-            client_popen = client.popen(["python", "-u", "client.py", "--saddr",
-                                         srcip, "--daddr", dstip, "--sport",
-                                         str(sport), "--dport", str(dport), "--proto", proto,
-                                         "--pipe", "pipe", "--pipename", client_pipe])
-            self.processes[(srcip, sport)] = client_popen
-            client_pid = client_popen.pid
-            try:
-                self.wait_client_creation(client_pid, (proto == "tcp"), srcip,
-                                          str(sport))
-
-            except MaxAttemptException as err:
-                logger.debug(err.msg)
-                #self.lock.release()
-            except TimedoutException as err:
-                logger.debug(err.msg)
-                #self.lock.release()
+                   "--proto %s --ready --pipe pipe --pipename %s &" % (proto, client_pipe))
+            if self.daemons is None:
+                logger.debug("Running command: %s", cmd)
+                client_popen = client.popen(["python", "-u", "client.py", "--saddr",
+                                             srcip, "--daddr", dstip, "--sport",
+                                             str(sport), "--dport", str(dport), "--proto", proto,
+                                             "--ready", "--pipe", "pipe", "--pipename",
+                                             client_pipe], stdout=PIPE)
+                self.processes[(srcip, sport)] = client_popen
+                if not self.wait_started(client_popen, srcip, sport):
+                    #self.lock.release()
+                    return
 
             self.mapping_involved_connection[dstip] += 1
         else:
             logger.debug("Port %s is already open on host %s", sport, srcip)
-        t_client = threading.Thread(target=self.write_flow_to_pipe,
-                                    args=(str(flow), client_pipe, flowstat_client,
-                                          client_lock))
-        client_lock.add_thread(str(flow))
-        t_client.start()
+        if self.daemons is None:
+            t_client = threading.Thread(target=self.write_flow_to_pipe,
+                                        args=(str(flow), client_pipe, flowstat_client,
+                                              client_lock))
+            client_lock.add_thread(str(flow))
+            t_client.start()
+        else:
+            t_client = None
+            daemon = self.send_to_daemon(cli, "client", flow.proto,
+                                         (srcip, sport), (dstip, dport),
+                                         flowstat_client)
+            if daemon is None:
+                return
+            # The port stays open in the daemon as long as it runs
+            self.processes[(srcip, sport)] = daemon
         self.mapping_server_client[dstip].append(flow)
 
         if srcip not in self.mapping_involved_connection:
@@ -0,0 +1,765 @@
+"""
+    Replay of the flows of local mode in a single process. The endpoints of
+    all the flows are run by one event loop: each listening socket,
+    connection, packet schedule and receive counter is a generator
+    coroutine instead of a server.py or client.py process with a Sender and
+    a Receiver thread per connection.
+
+    A coroutine yields the event it waits for:
+        (READ, fd), (WRITE, fd): the file descriptor is ready
+        (SLEEP, deadline): time.time() reached deadline, the lag is sent back
+        (WAIT, key): notify(key) was called
+"""
+
+import os
+import errno
+import fcntl
+import heapq
+import logging
+import math
+import select
+import socket
+import struct
+import time
+from collections import deque
+from threading import Thread, Event, Lock
+
+from flows import FlowLazyGen
+from util import datetime_to_ms, lag_percentiles
+
+logger = logging.getLogger()
+
+TCP = 6
+UDP = 17
+
+READ, WRITE, SLEEP, WAIT = range(4)
+
+# Poll events waking the readers and the writers of a file descriptor
+READ_EVENTS = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+WRITE_EVENTS = select.POLLOUT | select.POLLHUP | select.POLLERR
+
+RETRY = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+LENGTH_STRUCT = struct.Struct('>I')
+
+
+class Task(object):
+
+    # Coroutine run by the loop, it can be joined like a thread
+
+    def __init__(self, name):
+        self.name = name
+        self.coro = None
+        self.value = None
+        self.finished = Event()
+        # Set once the socket of the end is bound (listening for a server),
+        # failed tells if it could not be
+        self.ready = Event()
+        self.failed = False
+
+    def is_alive(self):
+        return not self.finished.is_set()
+
+    def join(self, timeout=None):
+        self.finished.wait(timeout)
+
+    def __str__(self):
+        return self.name
+
+
+class EventLoop(object):
+
+    def __init__(self):
+        self.ready = deque()
+        # (deadline, seq, task)
+        self.timers = []
+        self.seq = 0
+        # fd -> tasks waiting for it
+        self.readers = {}
+        self.writers = {}
+        # key -> tasks waiting for notify(key)
+        self.waiters = {}
+        # fd -> registered mask
+        self.masks = {}
+        self.poller = Poller()
+        # Callbacks posted by other threads, the pipe wakes up poll
+        self.inbox = deque()
+        self.inbox_lock = Lock()
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            _set_nonblocking(fd)
+        self.poller.register(self.wake_r, select.POLLIN, False)
+        self.stopping = False
+
+    def spawn(self, coro, task=None):
+        task = task or Task(coro.__name__)
+        task.coro = coro
+        self.ready.append(task)
+        return task
+
+    def call_soon_threadsafe(self, func, *args):
+        with self.inbox_lock:
+            self.inbox.append((func, args))
+        try:
+            os.write(self.wake_w, b'x')
+        except OSError as err:
+            if err.errno not in RETRY:
+                raise
+
+    def stop(self):
+        self.call_soon_threadsafe(setattr, self, "stopping", True)
+
+    def notify(self, key):
+        self.ready.extend(self.waiters.pop(key, ()))
+
+    def close_fd(self, fd):
+        # Waiting tasks are resumed, they find their socket closed
+        self.ready.extend(self.readers.pop(fd, ()))
+        self.ready.extend(self.writers.pop(fd, ()))
+        self._update(fd)
+
+    def _update(self, fd):
+        mask = 0
+        if fd in self.readers:
+            mask |= select.POLLIN | select.POLLPRI
+        if fd in self.writers:
+            mask |= select.POLLOUT
+        old = self.masks.get(fd, 0)
+        if mask == old:
+            return
+        if mask:
+            self.poller.register(fd, mask, old != 0)
+            self.masks[fd] = mask
+        else:
+            self.poller.unregister(fd)
+            del self.masks[fd]
+
+    def _step(self, task):
+        value, task.value = task.value, None
+        try:
+            kind, arg = task.coro.send(value)
+        except StopIteration:
+            task.finished.set()
+            return
+        except Exception:
+            logger.exception("Task %s failed", task)
+            task.finished.set()
+            return
+
+        if kind == READ:
+            self.readers.setdefault(arg, []).append(task)
+            self._update(arg)
+        elif kind == WRITE:
+            self.writers.setdefault(arg, []).append(task)
+            self._update(arg)
+        elif kind == SLEEP:
+            self.seq += 1
+            heapq.heappush(self.timers, (arg, self.seq, task))
+        elif kind == WAIT:
+            self.waiters.setdefault(arg, []).append(task)
+
+    def _drain_inbox(self):
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except OSError as err:
+            if err.errno not in RETRY:
+                raise
+        with self.inbox_lock:
+            callbacks, self.inbox = self.inbox, deque()
+        for func, args in callbacks:
+            func(*args)
+
+    def _wake(self, fd, tasks_of):
+        tasks = tasks_of.pop(fd, None)
+        if tasks:
+            self.ready.extend(tasks)
+            self._update(fd)
+
+    def run_forever(self):
+        while not self.stopping:
+            for _ in xrange(len(self.ready)):
+                self._step(self.ready.popleft())
+
+            if self.ready:
+                timeout = 0
+            elif self.timers:
+                timeout = max(0, self.timers[0][0] - time.time())
+            else:
+                timeout = None
+            for fd, event in self.poller.poll(timeout):
+                if fd == self.wake_r:
+                    self._drain_inbox()
+                    continue
+                if event & READ_EVENTS:
+                    self._wake(fd, self.readers)
+                if event & WRITE_EVENTS:
+                    self._wake(fd, self.writers)
+
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                deadline, _, task = heapq.heappop(self.timers)
+                task.value = now - deadline
+                self.ready.append(task)
+
+
+class Poller(object):
+
+    # epoll where available for its sub-millisecond timeout, poll otherwise
+
+    def __init__(self):
+        self.epoll = select.epoll() if hasattr(select, "epoll") else None
+        self.poll_obj = select.poll() if self.epoll is None else None
+
+    def register(self, fd, mask, modify):
+        if self.epoll is None:
+            self.poll_obj.register(fd, mask)
+        elif modify:
+            self.epoll.modify(fd, mask)
+        else:
+            self.epoll.register(fd, mask)
+
+    def unregister(self, fd):
+        if self.epoll is None:
+            self.poll_obj.unregister(fd)
+        else:
+            self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        # timeout in seconds, None to block
+        if self.epoll is not None:
+            return self.epoll.poll(-1 if timeout is None else timeout)
+        if timeout is not None:
+            timeout = int(math.ceil(timeout * 1000))
+        return self.poll_obj.poll(timeout)
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def flow_schedules(flow, last=False):
+    """
+        Endpoints of the flow, client first, and the FlowLazyGen schedule
+        of each of them, with the same statistics as in LocalHandler.
+    """
+    server_ps = flow.generate_server_pkts(flow.in_nb_pkt)
+    server_ipt = flow.generate_server_arrs(flow.in_nb_pkt)
+    client_ps = flow.generate_client_pkts(flow.nb_pkt)
+    client_ipt = flow.generate_client_arrs(flow.nb_pkt)
+    server_first = datetime_to_ms(flow.in_first)
+    client_first = datetime_to_ms(flow.first)
+
+    src = (str(flow.srcip), int(flow.sport))
+    dst = (str(flow.dstip), int(flow.dport))
+    src_gen = FlowLazyGen(dst[0], dst[1], flow.proto, client_first,
+                          server_first, flow.nb_pkt, flow.in_nb_pkt,
+                          client_ps, client_ipt, last=last)
+    dst_gen = FlowLazyGen(src[0], src[1], flow.proto, server_first,
+                          client_first, flow.in_nb_pkt, flow.nb_pkt,
+                          server_ps, server_ipt, last=last)
+    if flow.is_client_flow:
+        return src, dst, src_gen, dst_gen
+    return dst, src, dst_gen, src_gen
+
+
+class Connection(object):
+
+    # One end of a flow: the frames it has to send and the number of
+    # packets expected from the other end
+
+    def __init__(self, local, peer, proto, sock=None, listener=None):
+        self.local = local
+        self.peer = peer
+        self.proto = proto
+        self.is_tcp = proto == TCP
+        self.sock = sock
+        # Listener of a server end
+        self.listener = listener
+        # Connected (TCP client), accepted (TCP server) or bound (UDP)
+        self.ready = False
+        self.sending = False
+        self.pending = 0
+        self.sent = 0
+        self.expected = 0
+        self.received = 0
+        self.eof = False
+        self.last = False
+        self.closed = False
+
+    def done(self):
+        return (self.last and self.pending == 0 and
+                (self.eof or self.received >= self.expected))
+
+    def __str__(self):
+        return "{}:{}<->{}:{}".format(self.local[0], self.local[1],
+                                      self.peer[0], self.peer[1])
+
+
+class Listener(object):
+
+    # Server endpoint, its connections are indexed by client address
+
+    def __init__(self, sock, proto):
+        self.sock = sock
+        self.is_tcp = proto == TCP
+        self.conns = {}
+        # Clients seen before their server end was opened: accepted socket
+        # (TCP) or number of datagrams received (UDP) by client address
+        self.early = {}
+
+
+class ReplayEngine(object):
+
+    """
+        Drop-in replacement of LocalHandler running all the endpoints in a
+        background event loop. An endpoint daemon runs the ends of its host
+        only, with open_server() and open_client().
+    """
+
+    # Largest packet of a schedule
+    MAX_PKT = 65535
+    # Lags kept before they are summarized, when no frame ends before (the
+    # endpoint daemons)
+    MAX_LAGS = 100000
+
+    def __init__(self):
+        self.loop = EventLoop()
+        # (ip, port, proto) -> Listener
+        self.listeners = {}
+        # (ip, port, proto) -> client Connection
+        self.clients = {}
+        self.payload = os.urandom(ReplayEngine.MAX_PKT)
+        self.nb_flow = 0
+        self.nb_done = 0
+        self.nb_failed = 0
+        self.active = 0
+        self.peak = 0
+        self.sent = 0
+        self.received = 0
+        # Delay between the deadline and the sending of each packet of the
+        # current frame, and (packets, p50, p90, p99) of the previous ones
+        self.lags = []
+        self.lag_frames = []
+        self.idle = Event()
+        self.idle.set()
+        # Client and server ends not closed yet
+        self.ends = 0
+        self.drained = Event()
+        self.drained.set()
+        self.thread = Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def establish_conn_client_server(self, flow, src_lock=None, dst_lock=None,
+                                     last=False):
+        client, server, client_gen, server_gen = flow_schedules(flow, last)
+        client_task = Task("client {}:{}".format(*client))
+        server_task = Task("server {}:{}".format(*server))
+        self.idle.clear()
+        self.loop.call_soon_threadsafe(self._submit, flow.proto, client,
+                                       server, client_gen, server_gen,
+                                       client_task, server_task)
+        logger.info("Flow %s submitted", flow)
+        return client_task, server_task
+
+    def wait_termination(self, timeout=None):
+        self.idle.wait(timeout)
+        self.loop.call_soon_threadsafe(self._close_listeners)
+        self.loop.stop()
+        self.thread.join()
+        print self
+
+    def _socket(self, address, proto):
+        kind = socket.SOCK_STREAM if proto == TCP else socket.SOCK_DGRAM
+        sock = socket.socket(socket.AF_INET, kind)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if proto == TCP:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        sock.setblocking(0)
+        try:
+            sock.bind(address)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def _listen(self, server, proto):
+        listener = Listener(self._socket(server, proto), proto)
+        if listener.is_tcp:
+            listener.sock.listen(socket.SOMAXCONN)
+            self.loop.spawn(self._accept(listener))
+        else:
+            self.loop.spawn(self._receive_udp(listener))
+        self.listeners[server + (proto,)] = listener
+        return listener
+
+    def open_server(self, proto, server, client, gen):
+        """
+            Run the server end of a flow whose client is run by another
+            engine, return its task.
+        """
+        return self._open(proto, server, client, gen, False)
+
+    def open_client(self, proto, client, server, gen):
+        # Client end of a flow whose server is run by another engine
+        self.idle.clear()
+        return self._open(proto, client, server, gen, True)
+
+    def _open(self, proto, local, peer, gen, is_client):
+        role = "client" if is_client else "server"
+        task = Task("{} {}:{}".format(role, *local))
+        self.loop.call_soon_threadsafe(self._submit_end, proto, local, peer,
+                                       gen, task, is_client)
+        return task
+
+    def drain(self, timeout=None):
+        # Wait for the ends submitted so far to be closed
+        self._flush()
+        return self.drained.wait(timeout)
+
+    def close_listeners(self):
+        # Release the server ports, they are opened again if needed
+        self.loop.call_soon_threadsafe(self._close_listeners)
+        self._flush()
+
+    def _flush(self):
+        # Wait for the callbacks posted so far to be run by the loop
+        flushed = Event()
+        self.loop.call_soon_threadsafe(flushed.set)
+        flushed.wait()
+
+    def _server_end(self, proto, server, client):
+        listener = self.listeners.get(server + (proto,))
+        if listener is None:
+            listener = self._listen(server, proto)
+        end = listener.conns.get(client)
+        if end is None:
+            end = Connection(server, client, proto, listener=listener)
+            if not listener.is_tcp:
+                end.sock = listener.sock
+                end.ready = True
+            listener.conns[client] = end
+            self._opened()
+            early = listener.early.pop(client, None)
+            if early is not None:
+                self._adopt(end, early)
+        return end
+
+    def _adopt(self, end, early):
+        # Client of an end opened by another engine came first
+        if end.is_tcp:
+            end.sock = early
+            end.ready = True
+            self.loop.spawn(self._receive_tcp(end))
+        else:
+            end.received += early
+            self.received += early
+
+    def _client_end(self, proto, client, server):
+        conn = self.clients.get(client + (proto,))
+        if conn is None:
+            conn = Connection(client, server, proto,
+                              self._socket(client, proto))
+            self.clients[client + (proto,)] = conn
+            self.loop.spawn(self._connect(conn))
+            self.nb_flow += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self._opened()
+        return conn
+
+    def _opened(self):
+        self.ends += 1
+        self.drained.clear()
+
+    def _submit(self, proto, client, server, client_gen, server_gen,
+                client_task, server_task):
+        try:
+            server_end = self._server_end(proto, server, client)
+            client_end = self._client_end(proto, client, server)
+        except socket.error as err:
+            logger.debug("Unable to open %s:%s -> %s:%s: %s", client[0],
+                         client[1], server[0], server[1], err)
+            self.nb_failed += 1
+            for task in (client_task, server_task):
+                self._fail(task)
+            self._check_idle()
+            return
+        self._schedule(client_end, client_gen, client_task)
+        self._schedule(server_end, server_gen, server_task)
+
+    def _submit_end(self, proto, local, peer, gen, task, is_client):
+        try:
+            if is_client:
+                end = self._client_end(proto, local, peer)
+            else:
+                end = self._server_end(proto, local, peer)
+        except socket.error as err:
+            logger.debug("Unable to open %s:%s for %s:%s: %s", local[0],
+                         local[1], peer[0], peer[1], err)
+            self.nb_failed += 1
+            self._fail(task)
+            self._check_idle()
+            return
+        self._schedule(end, gen, task)
+
+    def _schedule(self, end, gen, task):
+        end.pending += 1
+        end.expected += gen.rem_nbr_pkt
+        end.last = gen.last
+        self.loop.spawn(self._send_frame(end, gen), task)
+        task.ready.set()
+
+    def _fail(self, task):
+        task.failed = True
+        task.ready.set()
+        task.finished.set()
+
+    def _connect(self, conn):
+        if conn.is_tcp:
+            fd = conn.sock.fileno()
+            err = conn.sock.connect_ex(conn.peer)
+            if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                yield (WRITE, fd)
+                if conn.closed:
+                    return
+                err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                logger.debug("Unable to connect %s: %s", conn, os.strerror(err))
+                self._close(conn)
+                return
+            conn.ready = True
+            self.loop.notify(conn)
+            self.loop.spawn(self._receive_tcp(conn))
+        else:
+            conn.ready = True
+            self.loop.notify(conn)
+            self.loop.spawn(self._receive_udp_client(conn))
+
+    def _accept(self, listener):
+        fd = listener.sock.fileno()
+        while True:
+            yield (READ, fd)
+            if listener.sock is None:
+                return
+            try:
+                sock, addr = listener.sock.accept()
+            except socket.error as err:
+                if err.errno not in RETRY:
+                    logger.debug("Accept error: %s", err)
+                continue
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            conn = listener.conns.get(addr)
+            if conn is None and addr not in listener.early:
+                logger.debug("Early connection from %s:%s", *addr)
+                listener.early[addr] = sock
+                continue
+            if conn is None or conn.ready:
+                logger.debug("Unexpected connection from %s:%s", *addr)
+                sock.close()
+                continue
+            conn.sock = sock
+            conn.ready = True
+            self.loop.notify(conn)
+            self.loop.spawn(self._receive_tcp(conn))
+
+    def _send_frame(self, conn, gen):
+        # Frames of a connection are sent in order once it is established
+        while not conn.ready or conn.sending:
+            if conn.closed:
+                return
+            yield (WAIT, conn)
+        conn.sending = True
+        first_arr = 0
+        if gen.first and gen.rem_first and gen.first > gen.rem_first:
+            first_arr = gen.first - gen.rem_first
+        deadline = time.time() + first_arr/1000.0
+        try:
+            for index in xrange(gen.nbr_pkt):
+                lag = yield (SLEEP, deadline)
+                if conn.closed:
+                    return
+                self.lags.append(lag)
+                if len(self.lags) >= ReplayEngine.MAX_LAGS:
+                    self._summarize_lags()
+                size = 0
+                if index < len(gen.pkt_gen):
+                    size = min(int(gen.pkt_gen[index]), ReplayEngine.MAX_PKT)
+                for event in self._write(conn, size):
+                    yield event
+                conn.sent += 1
+                self.sent += 1
+                ipt = gen.arr_gen[index] if index < len(gen.arr_gen) else 0
+                deadline = time.time() + ipt/1000.0
+        except socket.error as err:
+            logger.debug("Socket error on %s: %s", conn, err)
+            self._close(conn)
+            return
+        conn.sending = False
+        conn.pending -= 1
+        self.loop.notify(conn)
+        self._check_done(conn)
+
+    def _write(self, conn, size):
+        fd = conn.sock.fileno()
+        if conn.is_tcp:
+            data = LENGTH_STRUCT.pack(size) + self.payload[:size]
+        else:
+            data = buffer(self.payload, 0, size)
+        while True:
+            try:
+                if conn.is_tcp:
+                    sent = conn.sock.send(data)
+                    data = buffer(data, sent)
+                    if not len(data):
+                        return
+                else:
+                    conn.sock.sendto(data, conn.peer)
+                    return
+            except socket.error as err:
+                if err.errno not in RETRY:
+                    raise
+            yield (WRITE, fd)
+            if conn.closed:
+                raise socket.error(errno.EBADF, "connection closed")
+
+    def _receive_tcp(self, conn):
+        fd = conn.sock.fileno()
+        data = b''
+        while not conn.done():
+            yield (READ, fd)
+            if conn.closed:
+                return
+            try:
+                chunk = conn.sock.recv(65536)
+            except socket.error as err:
+                if err.errno in RETRY:
+                    continue
+                logger.debug("Socket error on %s: %s", conn, err)
+                chunk = b''
+            if not chunk:
+                conn.eof = True
+                break
+            data += chunk
+            offset = 0
+            while len(data) - offset >= LENGTH_STRUCT.size:
+                length = LENGTH_STRUCT.unpack_from(data, offset)[0]
+                if len(data) - offset < LENGTH_STRUCT.size + length:
+                    break
+                offset += LENGTH_STRUCT.size + length
+                conn.received += 1
+                self.received += 1
+            data = data[offset:]
+        self._check_done(conn)
+
+    def _receive_udp(self, listener):
+        fd = listener.sock.fileno()
+        while True:
+            yield (READ, fd)
+            if listener.sock is None:
+                return
+            try:
+                _, addr = listener.sock.recvfrom(65536)
+            except socket.error as err:
+                if err.errno not in RETRY:
+                    logger.debug("Socket error: %s", err)
+                continue
+            conn = listener.conns.get(addr)
+            if conn is not None:
+                conn.received += 1
+                self.received += 1
+                self._check_done(conn)
+            else:
+                listener.early[addr] = listener.early.get(addr, 0) + 1
+
+    def _receive_udp_client(self, conn):
+        fd = conn.sock.fileno()
+        while not conn.done():
+            yield (READ, fd)
+            if conn.closed:
+                return
+            try:
+                conn.sock.recvfrom(65536)
+            except socket.error as err:
+                if err.errno not in RETRY:
+                    logger.debug("Socket error on %s: %s", conn, err)
+                continue
+            conn.received += 1
+            self.received += 1
+        self._check_done(conn)
+
+    def _check_done(self, conn):
+        if conn.done() and not conn.closed:
+            logger.debug("Flow %s done, %d packets sent, %d received", conn,
+                         conn.sent, conn.received)
+            self._close(conn)
+
+    def _close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        self.loop.notify(conn)
+        self.ends -= 1
+        if self.ends == 0:
+            self.drained.set()
+        if conn.listener is None:
+            del self.clients[conn.local + (conn.proto,)]
+            self.active -= 1
+            if conn.done():
+                self.nb_done += 1
+            self._check_idle()
+        else:
+            del conn.listener.conns[conn.peer]
+        # The server ends of UDP flows share the socket of their listener
+        if conn.sock is not None and (conn.listener is None or conn.is_tcp):
+            self.loop.close_fd(conn.sock.fileno())
+            conn.sock.close()
+
+    def _check_idle(self):
+        if self.active == 0:
+            self.idle.set()
+
+    def _close_listeners(self):
+        for listener in self.listeners.values():
+            if listener.is_tcp:
+                for sock in listener.early.values():
+                    sock.close()
+            self.loop.close_fd(listener.sock.fileno())
+            listener.sock.close()
+            listener.sock = None
+        self.listeners = {}
+
+    def _summarize_lags(self):
+        # Percentiles of the lags of the frame, which are dropped
+        lags, self.lags = self.lags, []
+        summary = [len(lags)] + lag_percentiles(lags)
+        if lags:
+            self.lag_frames.append(summary)
+        return summary
+
+    def lag_percentiles(self):
+        # In milliseconds, the worst p50, p90 and p99 of the frames
+        summaries = self.lag_frames
+        if self.lags:
+            summaries = summaries + [[len(self.lags)] +
+                                     lag_percentiles(self.lags)]
+        if not summaries:
+            return [0.0, 0.0, 0.0]
+        return [max(summary[i] for summary in summaries) for i in (1, 2, 3)]
+
+    def frame_lags(self):
+        # Lag percentiles of the packets sent since the previous call
+        count, p50, p90, p99 = self._summarize_lags()
+        return ("Scheduling lag: {} packets, p50 {:.3f}ms p90 {:.3f}ms p99 "
+                "{:.3f}ms".format(count, p50, p90, p99))
+
+    def __str__(self):
+        p50, p90, p99 = self.lag_percentiles()
+        return ("Replay engine: {} flows ({} done, {} failed, at most {} "
+                "concurrent), {} packets sent, {} received, worst frame lag "
+                "p50 {:.3f}ms p90 {:.3f}ms p99 {:.3f}ms".format(
+                    self.nb_flow, self.nb_done, self.nb_failed, self.peak,
+                    self.sent, self.received, p50, p90, p99))
@@ -20,12 +20,15 @@ from traceback import format_exception
 from traceback import print_exc
 from util import Sender, Receiver
 from util import get_tcp_info, create_logger
+from util import signal_ready_once
 import flowDAO as flowDAO
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--addr", type=str, dest="ip", action="store", help="ip address of the host")
 parser.add_argument("--port", type=int, dest="port", action="store", help="port of the service")
 parser.add_argument("--proto", type=str, dest="proto", action="store", help="protocol used for the flow")
+parser.add_argument("--ready", action="store_true",
+                    help="write a byte to stdout once the socket is bound")
 group = parser.add_mutually_exclusive_group(required=True)
 group.add_argument("--pipe", action="store_true")
 group.add_argument("--sock", action="store_true")
@@ -144,7 +147,11 @@ class TCPFlowRequestHandler(SocketServer.StreamRequestHandler):
         tries = 0
         while tries < 3:
             try:
-                gen = self.server.map_client[self.client_address].get(timeout=0.5)
+                # The client can connect before its flow is read from the pipe
+                queue = self.server.map_client.get(self.client_address)
+                if queue is None:
+                    raise Queue.Empty
+                gen = queue.get(timeout=0.5)
                 if gen:
                     return gen
                 else:
@@ -230,9 +237,8 @@ class TCPFlowRequestHandler(SocketServer.StreamRequestHandler):
         self.nbr_pkt = nbr_pkt
         self.rem_nbr_pkt = rem_nbr_pkt
 
-    def wait_sender(self, sender, timeout=0.005):
-        while not sender.done:
-            time.sleep(timeout)
+    def wait_sender(self, sender):
+        sender.wait_frame()
 
     def create_receiver(self, rem_nbr_pkt, rem_ip, rem_port, last):
 
@@ -299,9 +305,7 @@ class TCPFlowRequestHandler(SocketServer.StreamRequestHandler):
             self.wait_sender(sender)
 
             if s.last:
-                sender.queue.put(True)
-                if sender.is_alive():
-                    sender.join()
+                sender.stop()
                 if receiver.is_alive():
                     receiver.join()
                 self.logger.debug("Flow generation completely done for %s", self.client_address)
@@ -310,9 +314,12 @@ class TCPFlowRequestHandler(SocketServer.StreamRequestHandler):
 
 class FlowTCPServer(ThreadPoolMixIn, SocketServer.TCPServer):
 
+    # The port can be in TIME_WAIT after the previous server or run
+    allow_reuse_address = True
+
     def __init__(self, server_address, is_pipe_entry, pipename=None,
                  handler_class=TCPFlowRequestHandler, sock_ip=None,
-                 sock_port=None):
+                 sock_port=None, ready=False):
         logger.debug("Initializing TCP server")
 
         self.map_client = {}
@@ -320,6 +327,8 @@ class FlowTCPServer(ThreadPoolMixIn, SocketServer.TCPServer):
 
         ThreadPoolMixIn.__init__(self)
         SocketServer.TCPServer.__init__(self, server_address, handler_class)
+        if ready:
+            signal_ready_once()
 
         if is_pipe_entry:
             logger.debug("Initializing pipe")
@@ -357,13 +366,16 @@ class FlowTCPServer(ThreadPoolMixIn, SocketServer.TCPServer):
                 msg = self.reader.read()
                 try:
                     gen = pickle.loads(zlib.decompress(msg))
-                    client_addr = (gen.rem_ip, gen.rem_port)
+                    # Same key as the address of the connection, the port
+                    # can be sent as a string
+                    client_addr = (gen.rem_ip, int(gen.rem_port))
                     logger.debug("Message for %s put in map", client_addr)
                     if client_addr in self.map_client:
                         self.map_client[client_addr].put_nowait(gen)
                     else:
-                        self.map_client[client_addr] = Queue.Queue(maxsize=20)
-                        self.map_client[client_addr].put_nowait(gen)
+                        queue = Queue.Queue(maxsize=20)
+                        queue.put_nowait(gen)
+                        self.map_client[client_addr] = queue
 
                 except Queue.Full:
                     pass
@@ -468,8 +480,8 @@ class UDPFlowRequestHandler(SocketServer.BaseRequestHandler):
 
             logger.debug("All packet %d have been received from %s", j,
                          self.client_address)
-            if sender.is_alive():
-                sender.join()
+            sender.wait_frame()
+            sender.stop()
             error = False
 
         except socket.error as msg:
@@ -492,13 +504,18 @@ class UDPFlowRequestHandler(SocketServer.BaseRequestHandler):
 
 class FlowUDPServer(ThreadPoolMixIn, SocketServer.UDPServer):
 
+    # The port can be in TIME_WAIT after the previous server or run
+    allow_reuse_address = True
+
     def __init__(self, server_address, is_pipe_entry, pipename=None,
                  handler_class=UDPFlowRequestHandler, sock_ip=None,
-                 sock_port=None):
+                 sock_port=None, ready=False):
 
         logger.debug("Initializing UDP server")
         ThreadPoolMixIn.__init__(self)
         SocketServer.UDPServer.__init__(self, server_address, handler_class)
+        if ready:
+            signal_ready_once()
 
         if is_pipe_entry:
             logger.debug("Initializing pipe")
@@ -580,16 +597,18 @@ if __name__ == "__main__":
     if proto == "tcp":
     # instantiate the server, and bind to localhost on port 9999
         if args.pipe:
-            server = FlowTCPServer((ip, port), args.pipe, pipename=args.pipename)
+            server = FlowTCPServer((ip, port), args.pipe, pipename=args.pipename,
+                                   ready=args.ready)
         else:
             server = FlowTCPServer((ip, port), args.pipe, sock_ip=args.sock_ip,
-                                   sock_port=args.sock_port)
+                                   sock_port=args.sock_port, ready=args.ready)
     elif proto == "udp":
         if args.pipe:
-            server = FlowUDPServer((ip, port), args.pipe, pipename=args.pipename)
+            server = FlowUDPServer((ip, port), args.pipe, pipename=args.pipename,
+                                   ready=args.ready)
         else:
             server = FlowUDPServer((ip, port), args.pipe, sock_ip=args.sock_ip,
-                                   sock_port=args.sock_port)
+                                   sock_port=args.sock_port, ready=args.ready)
     # activate the server
     # this will keep running until Ctrl-C
     if server:
@@ -0,0 +1,86 @@
+"""
+    Approximate clustering of the flows for traces too large for the full
+    distance matrix. Each inter-arrival sample is summarized by a vector of
+    quantiles of its normalized values, the vectors are bucketed with
+    locality-sensitive hashing (random projections) and the exact distance
+    is only computed between flows sharing a bucket. The clusters are the
+    single linkage on these candidate pairs.
+"""
+
+import numpy as np
+
+from distances import DistanceEngine, normalize_sample, GRID_SIZE
+from clustering import UnionFind
+
+# Number of quantiles of a sketch
+SKETCH_SIZE = 32
+# Number of hash tables, a pair is a candidate if it collides in one table
+LSH_TABLES = 8
+# Number of projections concatenated in the hash of a table
+LSH_HASHES = 4
+# Width of the buckets of a projection
+LSH_WIDTH = 0.5
+
+
+def quantile_sketch(sample, size=SKETCH_SIZE):
+    data = normalize_sample(sample)
+    if len(data) == 0:
+        return np.zeros(size)
+    return np.percentile(data, np.linspace(0, 100, size))
+
+
+def sketches(samples, size=SKETCH_SIZE):
+    return np.array([quantile_sketch(s, size) for s in samples])
+
+
+def lsh_candidates(vectors, tables=LSH_TABLES, hashes=LSH_HASHES,
+                   width=LSH_WIDTH, seed=0):
+    """
+        Return the pairs (i, j), i < j, of vectors sharing a bucket in at
+        least one table, as two arrays.
+    """
+    rand = np.random.RandomState(seed)
+    nb, dim = vectors.shape
+    pairs = [np.empty(0, dtype=np.int64)]
+    for _ in xrange(tables):
+        proj = rand.normal(size=(dim, hashes))
+        offset = rand.uniform(0, width, hashes)
+        codes = np.floor((np.dot(vectors, proj) + offset) / width).astype(np.int64)
+        _, bucket = np.unique(codes, axis=0, return_inverse=True)
+        order = np.argsort(bucket, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(bucket[order])) + 1
+        for members in np.split(order, bounds):
+            if len(members) < 2:
+                continue
+            a, b = np.triu_indices(len(members), 1)
+            # Members are sorted, so a pair is encoded with i < j
+            pairs.append(members[a] * nb + members[b])
+    pairs = np.unique(np.concatenate(pairs))
+    return pairs // nb, pairs % nb
+
+
+def approximate_clustering(samples, n, dist, metric="ks",
+                           grid_size=GRID_SIZE, **lsh):
+    """
+        Single linkage of the samples restricted to the candidate pairs,
+        return the list of clusters as lists of index.
+    """
+    rows, cols = lsh_candidates(sketches(samples), **lsh)
+    engine = DistanceEngine(samples, metric, grid_size)
+    dists = engine.pairs(rows, cols)
+
+    uf = UnionFind(len(samples))
+    nb_cluster = len(samples)
+    for k in np.argsort(dists, kind='mergesort'):
+        if nb_cluster <= n or dists[k] >= dist:
+            break
+        root_a = uf.find(rows[k])
+        root_b = uf.find(cols[k])
+        if root_a != root_b:
+            uf.union(root_a, root_b)
+            nb_cluster -= 1
+
+    members = {}
+    for i, root in enumerate(uf.roots()):
+        members.setdefault(root, []).append(i)
+    return [members[root] for root in sorted(members)]
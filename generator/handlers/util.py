@@ -8,6 +8,7 @@ import errno
 import socket
 import select
 import re
+import heapq
 import logging
 from logging.handlers import RotatingFileHandler
 import threading
@@ -28,6 +29,9 @@ _SQRT2 = np.sqrt(2)
 
 epoch = datetime.datetime.utcfromtimestamp(0)
 
+# Errors of a non-blocking send to retry once the socket is writable
+RETRY = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
 def get_tcp_info(sock):
     return tcp_info.TcpInfo.from_socket(sock)
     
@@ -173,17 +177,19 @@ def send_msg_tcp(socket, data):
 
 def _recvall(socket, n):
     data = b''
+    addr = None
     while len(data) < n:
         packet, addr = socket.recvfrom(n - len(data))
         if not packet:
-            return None
+            return None, addr
         data += packet
     return data, addr
 
 def recv_msg_tcp(socket):
-    raw_msglen, _ = _recvall(socket, 4)
+    # (message, address), the message is None once the peer has closed
+    raw_msglen, addr = _recvall(socket, 4)
     if not raw_msglen:
-        return None
+        return None, addr
     msglen = struct.unpack('>I', raw_msglen)[0]
     return _recvall(socket, msglen)
 
@@ -221,7 +227,8 @@ class Receiver(Thread):
         first = True
         frame_index = 0
 
-        while True:
+        closed = False
+        while not closed:
             j = 0
             error = True
             self.done = False
@@ -245,6 +252,14 @@ class Receiver(Thread):
                         if data:
                             j += 1
                         self.lock.release()
+                        if data is None and self.is_tcp:
+                            closed = True
+                            break
+                if closed:
+                    logger.debug("Receiver: %s:%s closed the connection after "
+                                 "%d/%d packets", self.ip, self.port, j,
+                                 self.rem_nbr_pkt)
+                    continue
                 logger.debug("All packet %d have been received from %s:%s", j,
                              self.ip, self.port)
                 self.done = True
@@ -279,14 +294,86 @@ class Receiver(Thread):
                     pass
         logger.debug("Flow Receiver completely done %s:%s", self.ip, self.port)
 
-class Sender(Thread):
+class SendScheduler(Thread):
+
+    """
+        Central scheduler of the Senders of a process, instead of a thread
+        sleeping until the next packet of each flow. The senders are kept in
+        a heap by the time of their next packet, the thread wakes up at the
+        earliest one, sends every packet due and requeues each sender with
+        its next inter-packet time.
+    """
+
+    # Seconds before retrying a packet whose socket or lock was busy
+    TICK = 0.001
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        # Scheduler of the process, started with its first sender
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def __init__(self):
+        Thread.__init__(self, name="send-scheduler")
+        self.daemon = True
+        # (wake up time, sequence, sender)
+        self.heap = []
+        self.seq = 0
+        self.lock = threading.Lock()
+        # Written to when a sender is scheduled before the current wake up
+        self.wake_r, self.wake_w = os.pipe()
+
+    def schedule(self, sender, when):
+        with self.lock:
+            first = self._push(sender, when)
+        if first:
+            os.write(self.wake_w, b'W')
+
+    def _push(self, sender, when):
+        self.seq += 1
+        heapq.heappush(self.heap, (when, self.seq, sender))
+        return self.heap[0][1] == self.seq
+
+    def run(self):
+        while True:
+            with self.lock:
+                timeout = None
+                if self.heap:
+                    timeout = max(0, self.heap[0][0] - time.time())
+            readable, _, _ = select.select([self.wake_r], [], [], timeout)
+            if readable:
+                os.read(self.wake_r, 4096)
+            now = time.time()
+            due = []
+            with self.lock:
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[2])
+            for sender in due:
+                when = sender.send_due(now)
+                if when is not None:
+                    with self.lock:
+                        self._push(sender, when)
+
+class Sender(object):
+
+    """
+        Packets sent to a remote end, one frame after the other. A frame is
+        started by start then by reset_params, its packets are sent by the
+        SendScheduler of the process.
+    """
+
     def __init__(self, name, nbr_pkt, arr_gen, pkt_gen, first_arr, sock, lock,
                  ip,
                  port,
                  is_tcp,
                  logname,
                  step=0.005):
-        Thread.__init__(self)
         self.name = name
         self.nbr_pkt = nbr_pkt
         self.arr_gen = arr_gen
@@ -301,9 +388,18 @@ class Sender(Thread):
         self.ps_index = 0
         self.ipt_index = 0
         self.logname = logname
-        self.queue = Queue.Queue(maxsize=1)
-        self.done = False
-        threading.currentThread().setName("-".join([name, "sender"]))
+        self.scheduler = SendScheduler.get()
+        self.frame_index = 0
+        # Packets sent in the current frame, and the time the next is due
+        self.index = 0
+        self.cur_size = None
+        self.deadline = None
+        # Bytes of the current packet not written yet
+        self.pending = None
+        # Delay between the deadline and the sending of each packet
+        self.lags = []
+        self.frame_done = threading.Event()
+        self.stopped = threading.Event()
 
     def _generate_until(self):
         while True:
@@ -323,6 +419,9 @@ class Sender(Thread):
             self.ipt_index += 1
             return ipt/1000.0
 
+    def start(self):
+        self._start_frame()
+
     def reset_params(self, nbr_pkt, arr_gen, pkt_gen, first_arr):
         self.nbr_pkt = nbr_pkt
         self.arr_gen = arr_gen
@@ -330,79 +429,110 @@ class Sender(Thread):
         self.first_arr = first_arr
         self.ps_index = 0
         self.ipt_index = 0
-        self.done = False
-        try:
-            self.queue.put_nowait(False)
-        except Queue.Full:
-            pass
+        self._start_frame()
 
-    def run(self):
+    def _start_frame(self):
         logger = logging.getLogger(self.logname)
-        run = False
-        frame_index = 0
-        while True:
-            if run:
-                try:
-                    finish = self.queue.get(block=True, timeout=1)
-                    if finish:
-                        break
-                except Queue.Empty:
-                    continue
+        logger.debug("Sending in frame index %s for %s:%s", self.frame_index,
+                     self.ip, self.port)
+        self.frame_done.clear()
+        self.index = 0
+        self.lags = []
+        self.pending = None
+        if len(self.pkt_gen) > 0:
+            self.cur_size = self.generate_ps()
+        if self.stopped.is_set() or self.index >= self.nbr_pkt:
+            self._end_frame()
+            return
+        self.deadline = time.time() + self.first_arr/1000.0
+        self.scheduler.schedule(self, self.deadline)
+
+    def send_due(self, now):
+        """
+            Send the packet due, called by the scheduler. Return when the
+            scheduler should call again, None once the frame is sent or the
+            sender stopped.
+        """
+        if self.stopped.is_set():
+            return
+        # Busy lock, the other flows are not held up
+        if not self.lock.acquire(False):
+            return now + SendScheduler.TICK
+        try:
+            if self.pending is None:
+                self.pending = create_packet(self.cur_size)
+                if self.is_tcp:
+                    self.pending = struct.pack('>I', len(self.pending)) + \
+                                   self.pending
+            # Never blocks the scheduler, the rest of a packet which did not
+            # fit in the socket buffer is sent on the next tick
+            if self.is_tcp:
+                sent = self.socket.send(self.pending, socket.MSG_DONTWAIT)
+                self.pending = buffer(self.pending, sent)
+                if len(self.pending):
+                    return now + SendScheduler.TICK
             else:
-                run = True
+                self.socket.sendto(self.pending, socket.MSG_DONTWAIT,
+                                   (self.ip, self.port))
+        except socket.error as err:
+            if err.errno in RETRY:
+                return now + SendScheduler.TICK
+            self._fail(err)
+            return
+        except Exception as err:
+            self._fail(err)
+            return
+        finally:
+            self.lock.release()
+        self.pending = None
+        self.lags.append(now - self.deadline)
+        self.index += 1
+        if self.index >= self.nbr_pkt:
+            self._end_frame()
+            return
+        cur_arr = self.generate_ipt() or 0
+        self.cur_size = self.generate_ps()
+        self.deadline = time.time() + cur_arr
+        return self.deadline
+
+    def _fail(self, err):
+        # The frame is ended so that its waiters are not blocked, and the
+        # next frames are ended as soon as they start
+        logger = logging.getLogger(self.logname)
+        logger.debug("Sender: Socket error: %s", err)
+        if getattr(err, "errno", None) == errno.EPIPE:
+            logger.debug("Stopping")
+        self.stopped.set()
+        self._end_frame()
 
-            cur_time = time.time()
-            cur_arr = self.first_arr/1000.0
-            if len(self.pkt_gen) > 0:
-                cur_size = self.generate_ps()
-            index = 0
-            try:
-                logger.debug("Sending in frame index %s for %s:%s", frame_index,
-                             self.ip, self.port)
-                while index < self.nbr_pkt:
-                    send_time = cur_time + cur_arr
-                    now = time.time()
-                    diff = send_time - now
-                    if diff <= 0:
-                        msg = create_packet(cur_size)
-                        _, writable, _ = select.select([], [self.socket], [], 1)
-                        if writable:
-                            self.lock.acquire()
-                            if self.is_tcp:
-                                res = send_msg_tcp(self.socket, msg)
-                            else:
-                                res = send_msg_udp(self.socket, msg, self.ip, self.port)
-                            self.lock.release()
-                            if res:
-                                cur_time = time.time()
-                                cur_arr = self.generate_ipt()
-                                cur_size = self.generate_ps()
-                                index += 1
-                    else:
-                        time.sleep(diff)
-                logger.debug("All %d packets have been sent to %s:%s",
-                             self.nbr_pkt, self.ip, self.port)
-                frame_index += 1
-                self.done = True
-            except socket.timeout:
-                logger.debug("Socket operation has timeout")
-            except socket.error as err:
-                logger.debug("Sender: Socket error: %s", err)
-                if err.errno == errno.EPIPE:
-                    logger.debug("Stopping")
-            except Exception:
-                logger.exception(print_exc())
-            finally:
-                # Release lock in case it was acquired before crashing
-                try:
-                    self.lock.release()
-                except ThreadError:
-                    pass
-                except RuntimeError:
-                    pass
+    def _end_frame(self):
+        logger = logging.getLogger(self.logname)
+        p50, p90, p99 = lag_percentiles(self.lags)
+        logger.debug("%d of %d packets have been sent to %s:%s, scheduling "
+                     "lag p50 %.3fms p90 %.3fms p99 %.3fms", self.index,
+                     self.nbr_pkt, self.ip, self.port, p50, p90, p99)
+        self.frame_index += 1
+        self.frame_done.set()
+
+    def wait_frame(self, timeout=None):
+        return self.frame_done.wait(timeout)
+
+    def stop(self):
+        # No packet is sent afterwards, the frame pending is abandoned
+        logger = logging.getLogger(self.logname)
+        self.stopped.set()
+        self.frame_done.set()
         logger.debug("Flow Sender completely done %s:%s", self.ip, self.port)
 
+def lag_percentiles(lags, percentiles=(50, 90, 99)):
+    # In milliseconds
+    if not lags:
+        return [0.0 for _ in percentiles]
+    return list(np.percentile(np.array(lags) * 1000, percentiles))
+
 def get_pmf(data):
+    if isinstance(data, np.ndarray):
+        data = data.tolist()
     C = Counter(data)
     total = float(sum(C.values()))
     for key in C:
@@ -410,6 +540,10 @@ def get_pmf(data):
     return C
 
 
+def dist_sum(data):
+    # Sum in double precision, distributions can be float32 arrays
+    return float(np.sum(data, dtype=np.float64))
+
 def compute_axis_scale(data):
 
     low = min(data)
@@ -492,6 +626,72 @@ def timeout_decorator(timeout=1, step=0.005, max_attempt=200):
         return wrapper
     return decorator
 
+# Readiness byte written by an endpoint once its socket is bound
+READY = b'R'
+FAILED = b'F'
+# Written by a pool worker once its ends are closed after their last frame
+DONE = b'D'
+
+def signal_ready(ready=True, fd=1):
+    os.write(fd, READY if ready else FAILED)
+
+def signal_ready_once(ready=True):
+    """
+        Signal the readiness of a server or client process. The handler then
+        closes its end of the pipe, later writes to stdout go to /dev/null.
+    """
+    signal_ready(ready)
+    sys.stdout.flush()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+def signal_done(fd=1):
+    os.write(fd, DONE)
+
+def read_signal(fd, timeout=1):
+    # Next byte written by the endpoint, empty if it exited. poll has no
+    # limit on the value of fd, unlike select
+    poller = select.poll()
+    poller.register(fd, select.POLLIN | select.POLLHUP | select.POLLERR)
+    if not poller.poll(None if timeout is None else
+                       int(math.ceil(timeout * 1000))):
+        raise TimedoutException("No ready signal after %ss" % timeout)
+    return os.read(fd, 1)
+
+def wait_ready(fd, timeout=1):
+    """
+        Wait for the readiness byte of the endpoint writing to fd, return
+        False if it failed or exited before.
+    """
+    return read_signal(fd, timeout) == READY
+
+class EstablishmentStats(object):
+
+    # Establishment time of the flows, and netstat or lsof checks replaced
+    # by the bookkeeping of the endpoints and their readiness signal
+
+    def __init__(self):
+        self.durations = []
+        self.failed = 0
+        # Checks, each of them ran netstat or lsof once or more when polling
+        self.checks_replaced = 0
+
+    def add(self, duration, success=True):
+        if success:
+            self.durations.append(duration)
+        else:
+            self.failed += 1
+
+    def __str__(self):
+        p50, p90, p99 = (np.percentile(np.array(self.durations) * 1000,
+                                       (50, 90, 99))
+                         if self.durations else (0.0, 0.0, 0.0))
+        return ("Establishment: {} flows ({} failed), p50 {:.3f}ms p90 "
+                "{:.3f}ms p99 {:.3f}ms, {} netstat or lsof checks "
+                "replaced".format(len(self.durations), self.failed, p50, p90,
+                                 p99, self.checks_replaced))
+
 def main():
     pass
 